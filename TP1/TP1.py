@@ -1,10 +1,16 @@
 import urllib
 import urllib.robotparser
 import re
-import json
+import argparse
+import os
 import time
-from collections import deque
 from bs4 import BeautifulSoup
+from TP1.checkpoint import *
+from TP1.extraction import extract_components
+from TP1.frontier import *
+from TP1.sorted_output import *
+
+ROBOTS_TTL = 24 * 3600  # Seconds before the robots.txt of a host is read again
 
 
 def print_html_all(url: str):
@@ -23,6 +29,16 @@ def get_html_components(url: str) -> dict:
     """
     with urllib.request.urlopen(url) as f:
         html_doc = f.read()
+    return parse_html_components(url, html_doc)
+
+
+def parse_html_components(url: str, html_doc, selective: bool = False) -> dict:
+    """
+    Extracts all the components needed (title, description and links) from the html of a page already downloaded.
+    With 'selective' = True, only these components are parsed, without building the tree of the page (same result).
+    """
+    if selective:
+        return extract_components(url, html_doc)
     soup = BeautifulSoup(html_doc, "html.parser")
 
     title = soup.title
@@ -72,69 +88,127 @@ def is_allowed(
     return rp.can_fetch(useragent, url)
 
 
-def update_queue(
-    queue: deque, visited: set, new_urls: list, rp: urllib.robotparser.RobotFileParser
-) -> deque:
+class RobotsCache:
     """
-    Gives the updated queue.
+    Robots.txt rules of every host met during a crawl, each one read again after 'ttl' seconds.
     """
-    for url in new_urls:
-        if (
-            is_allowed(url, rp) and not url in visited
-        ):  # We check if the page can be parsed and if it has not already been
-            o = urllib.parse.urlparse(url)
-            if "product" in o.path:  # To priorize pages with 'product' token
-                queue.appendleft(url)
-            else:
-                queue.append(url)
-    return queue
-
 
-def crawler(url: str, path_out: str, n_max: int = 50):
+    def __init__(self, ttl: float = ROBOTS_TTL, useragent: str = "*"):
+        self.ttl = ttl
+        self.useragent = useragent
+        self._robots = {}  # Host -> (rules, time they were read)
+
+    def get(self, url: str) -> urllib.robotparser.RobotFileParser:
+        """
+        Gives the robots.txt rules of the host of a url, read if they are not cached or have expired.
+        """
+        host = get_host(url)
+        cached = self._robots.get(host)
+        if cached is None or time.monotonic() - cached[1] > self.ttl:
+            rp = urllib.robotparser.RobotFileParser(get_robots_url(url))
+            try:
+                rp.read()
+            except OSError:  # No robots.txt could be read, like a 404
+                rp.allow_all = True
+            cached = (rp, time.monotonic())
+            self._robots[host] = cached
+        return cached[0]
+
+    def is_allowed(self, url: str) -> bool:
+        return is_allowed(url, self.get(url), self.useragent)
+
+
+def update_queue(frontier: Frontier, new_urls: list, robots: RobotsCache) -> Frontier:
     """
-    Crawls a number of pages starting from a given url.
+    Gives the updated queue: the new urls are added once (canonical form), if robots.txt allows them.
     """
-    i = 0
-    data = []
-    queue = deque([url])
-    visited = set()
-
-    robot_url = get_robots_url(url)
-    rp = urllib.robotparser.RobotFileParser()
-    rp.set_url(robot_url)
-    rp.read()
+    # We check if the page can be parsed and if it has not already been queued
+    frontier.extend(new_urls, robots.is_allowed)
+    return frontier
 
-    with open(path_out, "w", encoding="utf-8") as f:
-        while i < n_max and queue:  # We only want to extract n_max pages
-            current_url = queue.popleft()  # We remove the first url from the queue
-            if (
-                current_url in visited
-            ):  # If the page has already been crawled, we skip it
-                continue
 
-            visited.add(current_url)
-            new = get_html_components(
-                current_url
-            )  # We get the data we need from the page
-            ligne = json.dumps(new, ensure_ascii=False)
-            f.write(ligne + "\n")
-            init = i == 0
-            queue = update_queue(queue, visited, new["links"], rp)
-            time.sleep(0.5)  # To avoid overload
-            print(f"Page {i+1}/{n_max} has been crawled!")
-            i += 1
+def crawler(
+    url: str,
+    path_out: str,
+    n_max: int = 50,
+    resume: bool = False,
+    checkpoint_every: int = CHECKPOINT_EVERY,
+    run_size: int = RUN_SIZE,
+):
+    """
+    Crawls a number of pages starting from a given url, the output being sorted by url (see SortedWriter).
+    The queue, the visited pages and the state of the output are saved every 'checkpoint_every' pages and when
+    the crawl stops, so that 'resume' = True continues it where it stopped.
+    """
+    path_checkpoint = checkpoint_path(path_out)
+    if resume and os.path.exists(path_checkpoint):
+        state, seen = load_checkpoint(path_checkpoint)
+        i = state["pages"]
+        queue = Frontier(state["frontier"], seen)
+        output = state["output"]
+        print(f"Resuming the crawl after {i} pages...")
+    else:
+        i = 0
+        queue = Frontier([url])
+        output = None
+    robots = RobotsCache()  # The rules of each host, read when one of its pages is met
+
+    with SortedWriter(path_out, run_size, output) as writer:
+        current_url = None
+        try:
+            while i < n_max and queue:  # We only want to extract n_max pages
+                current_url = queue.popleft()  # We remove the first url from the queue
+                if not robots.is_allowed(
+                    current_url
+                ):  # The first url, or expired rules
+                    current_url = None
+                    continue
+
+                new = get_html_components(
+                    current_url
+                )  # We get the data we need from the page
+                writer.write(new)
+                current_url = None
+                queue = update_queue(queue, new["links"], robots)
+                print(f"Page {i+1}/{n_max} has been crawled!")
+                i += 1
+                if i % checkpoint_every == 0:
+                    save_crawl(path_checkpoint, writer, i, queue, queue.seen)
+                time.sleep(0.5)  # To avoid overload
+            writer.finish()
+        finally:
+            # A page interrupted while being crawled is put back in the queue
+            if current_url is not None:
+                queue.appendleft(current_url)
+            save_crawl(path_checkpoint, writer, i, queue, queue.seen)
 
 
 if __name__ == "__main__":
-    url = "https://web-scraping.dev/products"
-    path_out = "TP1/output/products.jsonl"
-    n_max = 50
-    crawler(url, path_out, n_max)
-
-    with open(path_out, "r", encoding="utf-8") as f:
-        data = [json.loads(line) for line in f if line.strip()]
-
-    data.sort(key=lambda x: x.get("url", ""))
-
-    with open(path_out, "w", encoding="utf-8") as f:
-        f.writelines(json.dumps(d, ensure_ascii=False) + "\n" for d in data)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url", nargs="?", default="https://web-scraping.dev/products")
+    parser.add_argument("path_out", nargs="?", default="TP1/output/products.jsonl")
+    parser.add_argument("--n-max", type=int, default=50)
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the crawl from the checkpoint of 'path_out'",
+    )
+    parser.add_argument(
+        "--run-size",
+        type=int,
+        default=RUN_SIZE,
+        help="Pages kept in memory before being sorted and written to a run file",
+    )
+    args = parser.parse_args()
+
+    try:
+        crawler(
+            args.url,
+            args.path_out,
+            args.n_max,
+            resume=args.resume,
+            run_size=args.run_size,
+        )
+    except KeyboardInterrupt:
+        print("Crawl interrupted, run again with --resume to continue it.")
+        raise SystemExit(1)
@@ -0,0 +1,464 @@
+import argparse
+import asyncio
+import http.client
+import os
+import threading
+import time
+import urllib.parse
+import urllib.robotparser
+from concurrent.futures import ThreadPoolExecutor
+from TP1.TP1 import ROBOTS_TTL, get_robots_url, parse_html_components
+from TP1.checkpoint import *
+from TP1.frontier import *
+from TP1.recrawl import *
+from TP1.sorted_output import *
+
+USER_AGENT = "*"
+DEFAULT_DELAY = 0.5  # Seconds between two requests to a host without crawl-delay
+MAX_REDIRECTS = 5
+
+
+class ConnectionPool:
+    """
+    Keep-alive connections, reused for the following requests to the same host.
+    """
+
+    def __init__(self, timeout: float = 10):
+        self.timeout = timeout
+        self.n_opened = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _get(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop()
+            self.n_opened += 1
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _release(self, scheme: str, netloc: str, conn: http.client.HTTPConnection):
+        with self._lock:
+            self._idle.setdefault((scheme, netloc), []).append(conn)
+
+    def request(self, url: str, headers: dict = None) -> tuple[int, dict, bytes]:
+        """
+        Sends a GET request (blocking) and gives the status, the headers and the body of the response.
+        """
+        o = urllib.parse.urlparse(url)
+        path = o.path or "/"
+        if o.query:
+            path += "?" + o.query
+        headers = {"User-Agent": "TP1-crawler", **(headers or {})}
+
+        # An idle connection may have been closed by the server, it is then retried once
+        for attempt in range(2):
+            conn = self._get(o.scheme, o.netloc)
+            try:
+                conn.request("GET", path, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, ConnectionError):
+                conn.close()
+                if attempt == 1:
+                    raise
+                continue
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(o.scheme, o.netloc, conn)
+            return response.status, dict(response.getheaders()), body
+
+    def fetch(self, url: str, headers: dict = None) -> tuple[int, dict, bytes]:
+        """
+        Sends a GET request following redirections, like urllib.request.urlopen.
+        """
+        for _ in range(MAX_REDIRECTS):
+            status, response_headers, body = self.request(url, headers)
+            location = response_headers.get("Location")
+            if status not in [301, 302, 303, 307, 308] or location is None:
+                break
+            url = urllib.parse.urljoin(url, location)
+        return status, response_headers, body
+
+    def close(self):
+        """
+        Closes every idle connection.
+        """
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle = {}
+
+
+class TokenBucket:
+    """
+    Politeness limiter of a host: 'rate' requests per second, with bursts of at most 'capacity' requests.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """
+        Waits until a request can be sent to the host.
+        """
+        async with self._lock:  # Waiting requests are served in order
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.last) * self.rate
+                )
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncCrawler:
+    """
+    Crawler fetching several pages at once, with a per-host politeness limiter following robots.txt.
+
+    Fetches run in threads on keep-alive connections of a ConnectionPool, and the requests to a
+    host are spaced by its robots.txt crawl-delay (or 'default_delay') with a TokenBucket, so that
+    several hosts are crawled in parallel while each one is requested at its own rate.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 8,
+        default_delay: float = DEFAULT_DELAY,
+        burst: float = 1,
+        pool: ConnectionPool = None,
+        selective: bool = False,
+        robots_ttl: float = ROBOTS_TTL,
+    ):
+        self.concurrency = concurrency
+        self.selective = selective
+        self.default_delay = default_delay
+        self.burst = burst
+        self.pool = pool if pool is not None else ConnectionPool()
+        self.robots_ttl = robots_ttl
+        self.robots = {}
+        self.buckets = {}
+        self._robots_read = {}  # Host -> time its robots.txt was read
+        self._robots_locks = {}
+
+    async def _fetch(self, url: str, headers: dict = None) -> tuple[int, dict, bytes]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.pool.fetch, url, headers)
+
+    async def get_robots(self, url: str) -> urllib.robotparser.RobotFileParser:
+        """
+        Gives the robots.txt rules of the host of a url, read once per host and again after 'robots_ttl' seconds.
+        """
+        host = get_host(url)
+        lock = self._robots_locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            if (
+                host not in self.robots
+                or time.monotonic() - self._robots_read[host] > self.robots_ttl
+            ):
+                rp = urllib.robotparser.RobotFileParser(get_robots_url(url))
+                try:
+                    status, _, body = await self._fetch(rp.url)
+                except OSError:
+                    status, body = 404, b""
+                if status in [401, 403]:
+                    rp.disallow_all = True
+                elif status >= 400:
+                    rp.allow_all = True
+                else:
+                    rp.parse(body.decode("utf-8", errors="ignore").splitlines())
+                self.robots[host] = rp
+                self._robots_read[host] = time.monotonic()
+                if (
+                    host in self.buckets
+                ):  # Rules read again, same bucket with the new rate
+                    self.buckets[host].rate = 1 / self.get_delay(rp)
+                else:
+                    self.buckets[host] = TokenBucket(
+                        1 / self.get_delay(rp), capacity=self.burst
+                    )
+        return self.robots[host]
+
+    def get_delay(self, rp: urllib.robotparser.RobotFileParser) -> float:
+        """
+        Gives the time between two requests to a host, from its robots.txt.
+        """
+        delay = rp.crawl_delay(USER_AGENT)
+        rate = rp.request_rate(USER_AGENT)
+        if delay is None and rate is not None:
+            delay = rate.seconds / rate.requests
+        if delay is None:
+            delay = self.default_delay
+        return max(float(delay), 1e-3)
+
+    async def crawl(
+        self,
+        url: str,
+        path_out: str,
+        n_max: int = 50,
+        resume: bool = False,
+        checkpoint_every: int = CHECKPOINT_EVERY,
+        validators_path: str = None,
+        recrawl: bool = False,
+        run_size: int = RUN_SIZE,
+    ) -> dict:
+        """
+        Crawls a number of pages starting from a given url, and writes them as they are fetched to 'path_out',
+        sorted by url at the end (see SortedWriter).
+        A checkpoint is saved every 'checkpoint_every' pages and when the crawl stops, 'resume' = True continues from it.
+        The validators of the pages are appended to a log saved with the checkpoints (see validators_log_path), and merged
+        into 'validators_path' when the crawl stops. With 'recrawl' = True, the pages are requested with the validators
+        of the previous crawl, and only the new or changed pages are written (delta file).
+        """
+        previous = load_validators(validators_path) if validators_path else {}
+        path_checkpoint = checkpoint_path(path_out)
+        if resume and os.path.exists(path_checkpoint):
+            state, seen = load_checkpoint(path_checkpoint)
+            queue = Frontier(state["frontier"], seen)
+            output = state["output"]
+            print(f"Resuming the crawl after {state['pages']} pages...")
+        else:
+            state = {"pages": 0}
+            queue = Frontier([url])
+            output = None
+        log = None
+        if validators_path:
+            # Cut back to its size at the checkpoint, like the output
+            log = open_output(validators_log_path(path_out), state.get("validators"))
+        # Pages being crawled, already out of the queue
+        in_flight = set()
+        counts = {"pages": state["pages"], "errors": 0, "in_flight": 0}
+        counts.update({"skipped": 0, "not_modified": 0, "bytes_saved": 0})
+        wake_up = asyncio.Event()
+        start = time.perf_counter()
+
+        def save(writer):
+            # The pages in flight are crawled again on resume
+            frontier = list(in_flight) + list(queue)
+            save_crawl(
+                path_checkpoint, writer, counts["pages"], frontier, queue.seen, log
+            )
+
+        async def worker(writer):
+            while True:
+                if counts["pages"] + counts["in_flight"] >= n_max:
+                    return
+                if not queue:
+                    if counts["in_flight"] == 0:
+                        return  # Nothing left to crawl
+                    wake_up.clear()
+                    await wake_up.wait()  # Until a page in flight brings new links
+                    continue
+
+                current_url = queue.popleft()  # Never queued twice
+                in_flight.add(current_url)
+
+                counts["in_flight"] += 1
+                try:
+                    rp = await self.get_robots(current_url)
+                    if not rp.can_fetch(USER_AGENT, current_url):
+                        in_flight.discard(current_url)
+                        continue
+                    await self.buckets[get_host(current_url)].acquire()
+                    previous_page = previous.get(current_url) if recrawl else None
+                    status, headers, body = await self._fetch(
+                        current_url, conditional_headers(previous_page)
+                    )
+                    if status == 304 and previous_page is not None:
+                        # Not modified, the body was not even sent
+                        new = None
+                        validators = previous_page
+                        counts["not_modified"] += 1
+                        counts["bytes_saved"] += previous_page["length"]
+                    elif status >= 400:
+                        raise OSError(f"HTTP {status}")
+                    elif (
+                        previous_page is not None
+                        and body_hash(body) == previous_page["hash"]
+                    ):
+                        # Same content, the page is not parsed again
+                        new = None
+                        validators = get_validators(
+                            headers, body, previous_page["links"]
+                        )
+                    else:
+                        new = parse_html_components(
+                            current_url, body, selective=self.selective
+                        )
+                        validators = get_validators(headers, body, new["links"])
+                except (OSError, http.client.HTTPException) as e:
+                    in_flight.discard(current_url)
+                    counts["errors"] += 1
+                    print(f"Could not crawl {current_url}: {e}")
+                    continue
+                finally:
+                    counts["in_flight"] -= 1
+                    wake_up.set()
+
+                if new is None:
+                    counts["skipped"] += 1
+                else:
+                    writer.write(new)
+                in_flight.discard(current_url)  # Only once written
+                if log is not None:
+                    log_validators(log, current_url, validators)
+                counts["pages"] += 1
+                queue.extend(validators["links"])
+                print(f"Page {counts['pages']}/{n_max} has been crawled!")
+                if counts["pages"] % checkpoint_every == 0:
+                    save(writer)
+
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            with SortedWriter(path_out, run_size, output) as writer:
+                try:
+                    await asyncio.gather(
+                        *[worker(writer) for _ in range(self.concurrency)]
+                    )
+                    writer.finish()
+                finally:
+                    save(writer)
+        finally:
+            self._executor.shutdown()
+            self.pool.close()
+            if log is not None:
+                log.close()
+                current = load_validators(validators_log_path(path_out))
+                save_validators(validators_path, {**previous, **current})
+
+        seconds = time.perf_counter() - start
+        pages = counts["pages"] - state["pages"]
+        return {
+            "pages": pages,
+            "errors": counts["errors"],
+            "seconds": seconds,
+            "pages_per_second": pages / seconds if seconds else 0.0,
+            "connections": self.pool.n_opened,
+            "skipped": counts["skipped"],
+            "not_modified": counts["not_modified"],
+            "bytes_saved": counts["bytes_saved"],
+        }
+
+
+def async_crawler(
+    url: str,
+    path_out: str,
+    n_max: int = 50,
+    concurrency: int = 8,
+    default_delay: float = DEFAULT_DELAY,
+    resume: bool = False,
+    validators_path: str = VALIDATORS_PATH,
+    recrawl: bool = False,
+    selective: bool = False,
+    run_size: int = RUN_SIZE,
+) -> dict:
+    """
+    Crawls a number of pages starting from a given url, with 'concurrency' fetches at once.
+    """
+    crawler = AsyncCrawler(
+        concurrency=concurrency, default_delay=default_delay, selective=selective
+    )
+    return asyncio.run(
+        crawler.crawl(
+            url,
+            path_out,
+            n_max,
+            resume=resume,
+            validators_path=validators_path,
+            recrawl=recrawl,
+            run_size=run_size,
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url", nargs="?", default="https://web-scraping.dev/products")
+    parser.add_argument("path_out", nargs="?", default=None)
+    parser.add_argument("--n-max", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--delay",
+        type=float,
+        default=DEFAULT_DELAY,
+        help="Seconds between two requests to a host without robots.txt crawl-delay",
+    )
+    parser.add_argument(
+        "--local",
+        action="store_true",
+        help="Crawl a local shop (TP1.local_site) instead of 'url'",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the crawl from the checkpoint of 'path_out'",
+    )
+    parser.add_argument(
+        "--recrawl",
+        action="store_true",
+        help="Send conditional requests and only write the new or changed pages",
+    )
+    parser.add_argument("--validators", default=None)
+    parser.add_argument(
+        "--run-size",
+        type=int,
+        default=RUN_SIZE,
+        help="Pages kept in memory before being sorted and written to a run file",
+    )
+    parser.add_argument(
+        "--selective",
+        action="store_true",
+        help="Extract the fields with the streaming parser of TP1.extraction instead of BeautifulSoup",
+    )
+    args = parser.parse_args()
+
+    url = args.url
+    prefix = "TP1/output/"
+    if args.local:
+        from TP1.local_site import PORT, start_site
+
+        # A fixed port, so that the urls of a resumed crawl stay the same
+        server, url = start_site(port=PORT)
+        prefix += "local_"
+    path_out = args.path_out or (
+        prefix + ("products_delta.jsonl" if args.recrawl else "products.jsonl")
+    )
+    validators_path = args.validators or prefix + "validators.jsonl"
+    try:
+        summary = async_crawler(
+            url,
+            path_out,
+            args.n_max,
+            args.concurrency,
+            args.delay,
+            resume=args.resume,
+            validators_path=validators_path,
+            recrawl=args.recrawl,
+            selective=args.selective,
+            run_size=args.run_size,
+        )
+    except KeyboardInterrupt:
+        print("Crawl interrupted, run again with --resume to continue it.")
+        raise SystemExit(1)
+    print(
+        f"{summary['pages']} pages in {summary['seconds']:.2f}s "
+        f"({summary['pages_per_second']:.1f} pages/s, "
+        f"{summary['connections']} connections, {summary['errors']} errors)"
+    )
+    if args.recrawl:
+        print(
+            f"{summary['pages'] - summary['skipped']} changed pages written to {path_out}, "
+            f"{summary['skipped']} unchanged pages skipped "
+            f"({summary['not_modified']} not modified, {summary['bytes_saved']} bytes saved)"
+        )
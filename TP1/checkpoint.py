@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+from array import array
+
+CHECKPOINT_EVERY = 100  # Pages crawled between two checkpoints
+
+
+def url_hash(url: str) -> int:
+    """
+    Gives a 64-bit hash of a url.
+    """
+    return int.from_bytes(
+        hashlib.blake2b(url.encode("utf-8"), digest_size=8).digest(), "little"
+    )
+
+
+class VisitedSet:
+    """
+    Set of visited urls, storing a 64-bit hash of each url instead of the url itself.
+
+    'url in visited' and 'visited.add(url)' work like with a set of urls, but the memory
+    does not depend on the length of the urls and the set is saved as 8 bytes per url.
+    """
+
+    def __init__(self, hashes=()):
+        self._hashes = set(hashes)
+
+    def add(self, url: str):
+        self._hashes.add(url_hash(url))
+
+    def discard(self, url: str):
+        self._hashes.discard(url_hash(url))
+
+    def __contains__(self, url: str) -> bool:
+        return url_hash(url) in self._hashes
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def to_bytes(self) -> bytes:
+        return array("Q", sorted(self._hashes)).tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "VisitedSet":
+        hashes = array("Q")
+        hashes.frombytes(data)
+        return cls(hashes)
+
+
+def checkpoint_path(path_out: str) -> str:
+    """
+    Gives the path of the checkpoint of a crawl from the path of its output file.
+    """
+    return path_out + ".checkpoint"
+
+
+def save_checkpoint(path: str, state: dict, visited: VisitedSet):
+    """
+    Saves the state of a crawl (first line, as JSON) followed by its visited set, replacing the previous checkpoint atomically.
+
+    The state holds the frontier, the number of pages crawled and the state of the output ('output', see SortedWriter).
+    """
+    path_tmp = path + ".tmp"
+    with open(path_tmp, "wb") as f:
+        f.write(json.dumps(state, ensure_ascii=False).encode("utf-8") + b"\n")
+        f.write(visited.to_bytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path_tmp, path)
+
+
+def save_crawl(
+    path: str,
+    writer,
+    pages: int,
+    frontier: list,
+    visited: VisitedSet,
+    validators_log=None,
+):
+    """
+    Saves a checkpoint of a crawl, after making the pages given to its output 'writer' (a SortedWriter) durable,
+    and the validators appended to 'validators_log' if given (its size is saved as 'validators').
+    """
+    state = {"pages": pages, "output": writer.checkpoint(), "frontier": list(frontier)}
+    if validators_log is not None:
+        validators_log.flush()
+        os.fsync(validators_log.fileno())
+        state["validators"] = validators_log.tell()
+    save_checkpoint(path, state, visited)
+
+
+def load_checkpoint(path: str) -> tuple[dict, VisitedSet]:
+    """
+    Loads the state and the visited set saved by save_checkpoint.
+    """
+    with open(path, "rb") as f:
+        state = json.loads(f.readline())
+        visited = VisitedSet.from_bytes(f.read())
+    return state, visited
+
+
+def open_output(path_out: str, offset: int = None):
+    """
+    Opens a file of a crawl in binary mode: a new file, or the file of a resumed crawl cut after
+    the last page saved by its checkpoint (the pages written after it will be crawled again).
+    """
+    if offset is None:
+        return open(path_out, "wb")
+    f = open(path_out, "r+b")
+    f.truncate(offset)
+    f.seek(offset)
+    return f
@@ -0,0 +1,321 @@
+import argparse
+import glob
+import os
+import re
+import statistics
+import time
+from html.parser import HTMLParser
+from bs4.dammit import EntitySubstitution, UnicodeDammit
+
+# Same rules as BeautifulSoup with "html.parser", so that both extractions give the same fields
+VOID_ELEMENTS = {
+    "area",
+    "base",
+    "basefont",
+    "bgsound",
+    "br",
+    "col",
+    "command",
+    "embed",
+    "frame",
+    "hr",
+    "image",
+    "img",
+    "input",
+    "isindex",
+    "keygen",
+    "link",
+    "menuitem",
+    "meta",
+    "nextid",
+    "param",
+    "source",
+    "spacer",
+    "track",
+    "wbr",
+}
+# Text inside these tags is not returned by get_text
+HIDDEN_TEXT_ELEMENTS = {"rp", "rt", "script", "style", "template"}
+PRESERVE_WHITESPACE_ELEMENTS = {"pre", "textarea"}
+ASCII_SPACES = str.maketrans("", "", "\x20\x0a\x09\x0c\x0d")
+DESCRIPTION_CLASS = "product-description"
+NUMERIC_REFERENCE = {
+    10: re.compile("^([0-9]+)(.*)"),
+    16: re.compile("^([0-9a-f]+)(.*)"),
+}
+
+
+class ComponentsParser(HTMLParser):
+    """
+    Streaming parser keeping only the title, the product description and the absolute links of a page.
+
+    No tree is built: the parser only tracks the names of the open tags, the children of the first
+    <title> (to give the same result as BeautifulSoup's 'title.string') and the text of the first
+    <p class="product-description">.
+    """
+
+    def __init__(self):
+        # Character references are converted like BeautifulSoup does
+        super().__init__(convert_charrefs=False)
+        self.links = []
+        self.title = None  # Children of the title, as nested lists of strings
+        self.description = None  # Strings of the description
+        self._open = []  # Names of the open tags
+        self._text = []  # Text since the last tag, comment...
+        self._title_stack = (
+            None  # Open tags of the title, each one being its list of children
+        )
+        self._description_depth = None  # Position of the description in self._open
+        self._hidden = 0
+        self._preserve = 0
+        self._already_closed = (
+            []
+        )  # Void tags closed at their start, whose end tag is ignored
+
+    def _end_text(self, kind: str = "text"):
+        # Like BeautifulSoup.endData, a whitespace-only string becomes "\n" or " "
+        if not self._text:
+            return
+        data = "".join(self._text)
+        self._text = []
+        if not self._preserve and data.translate(ASCII_SPACES) == "":
+            data = "\n" if "\n" in data else " "
+        if self._title_stack is not None:
+            self._title_stack[-1].append(data)
+        # get_text keeps the text (not hidden in a script, a template...) and the CDATA sections
+        if self._description_depth is not None and (
+            kind == "cdata" or (kind == "text" and not self._hidden)
+        ):
+            self.description.append(data)
+
+    def handle_starttag(self, tag: str, attrs: list, handle_empty_element: bool = True):
+        self._end_text()
+        attrs = {key: value if value is not None else "" for key, value in attrs}
+        if attrs.get("href", "").startswith("http"):
+            self.links.append(attrs["href"])
+
+        if self._title_stack is not None:
+            child = []
+            self._title_stack[-1].append(child)
+            self._title_stack.append(child)
+        elif tag == "title" and self.title is None:
+            self.title = []
+            self._title_stack = [self.title]
+
+        if (
+            tag == "p"
+            and self.description is None
+            and DESCRIPTION_CLASS in attrs.get("class", "").split()
+        ):
+            self.description = []
+            self._description_depth = len(self._open)
+
+        self._open.append(tag)
+        self._hidden += tag in HIDDEN_TEXT_ELEMENTS
+        self._preserve += tag in PRESERVE_WHITESPACE_ELEMENTS
+
+        if handle_empty_element and tag in VOID_ELEMENTS:
+            self._pop_to(tag)
+            self._already_closed.append(tag)
+
+    def handle_startendtag(self, tag: str, attrs: list):
+        self.handle_starttag(tag, attrs, handle_empty_element=False)
+        self._end_text()
+        self._pop_to(tag)
+
+    def handle_endtag(self, tag: str):
+        if tag in self._already_closed:
+            self._already_closed.remove(tag)
+            return
+        self._end_text()
+        self._pop_to(tag)
+
+    def _pop_to(self, tag: str):
+        # Closes the last open 'tag' and the tags still open inside it, an end tag without start tag is ignored
+        if tag not in self._open:
+            return
+        while True:
+            name = self._open.pop()
+            self._hidden -= name in HIDDEN_TEXT_ELEMENTS
+            self._preserve -= name in PRESERVE_WHITESPACE_ELEMENTS
+            if self._title_stack is not None:
+                self._title_stack.pop()
+                if not self._title_stack:
+                    self._title_stack = None
+            if self._description_depth == len(self._open):
+                self._description_depth = None
+            if name == tag:
+                return
+
+    def handle_charref(self, name: str):
+        base = 10
+        if name[:1] in ["x", "X"]:
+            name, base = name[1:], 16
+        try:
+            number, extra_data = int(name, base), ""
+        except ValueError:
+            # The data following the digits of a reference without ";" is kept as text
+            match = NUMERIC_REFERENCE[base].search(name)
+            if match is None:
+                self.handle_data(name)
+                return
+            number, extra_data = int(match.group(1), base), match.group(2)
+        character, _ = UnicodeDammit.numeric_character_reference(number)
+        self.handle_data(character + extra_data)
+
+    def handle_entityref(self, name: str):
+        character = EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name)
+        self.handle_data(character if character is not None else "&" + name)
+
+    def handle_data(self, data: str):
+        self._text.append(data)
+
+    def handle_comment(self, data: str):
+        self._end_text()
+        self._text.append(data)
+        self._end_text("comment")
+
+    def handle_decl(self, decl: str):
+        self._end_text()
+        self._text.append(decl[len("DOCTYPE ") :])
+        self._end_text("declaration")
+
+    def unknown_decl(self, data: str):
+        self._end_text()
+        if data.upper().startswith("CDATA["):
+            self._text.append(data[len("CDATA[") :])
+            self._end_text("cdata")
+        else:
+            self._text.append(data)
+            self._end_text("declaration")
+
+    def handle_pi(self, data: str):
+        self._end_text()
+        self._text.append(data)
+        self._end_text("pi")
+
+    def close(self):
+        super().close()
+        self._end_text()
+
+
+def get_string(children: list):
+    """
+    Gives the single string of an element from its children, like the 'string' property of BeautifulSoup.
+    """
+    if len(children) != 1:
+        return None
+    if isinstance(children[0], str):
+        return children[0]
+    return get_string(children[0])
+
+
+def extract_components(url: str, html_doc) -> dict:
+    """
+    Extracts the title, the description and the links of a page like parse_html_components, without building its tree.
+    """
+    if isinstance(html_doc, bytes):
+        # Same decoding as BeautifulSoup
+        html_doc = UnicodeDammit(html_doc, is_html=True).unicode_markup
+    parser = ComponentsParser()
+    parser.feed(html_doc)
+    parser.close()
+
+    title = get_string(parser.title) if parser.title is not None else ""
+    description = "".join(parser.description) if parser.description is not None else ""
+    return {
+        "url": url,
+        "title": title,
+        "description": description,
+        "links": parser.links,
+    }
+
+
+def load_pages(folder: str = None) -> dict:
+    """
+    Gives saved pages (every .html file of 'folder', the file name being the url) or, if 'folder' is None,
+    the pages of the local shop (see TP1.local_site).
+    """
+    if folder is not None:
+        pages = {}
+        for path in sorted(glob.glob(os.path.join(folder, "*.html"))):
+            with open(path, "rb") as f:
+                pages[os.path.basename(path)] = f.read()
+        return pages
+
+    from TP1.local_site import N_PRODUCTS, PAGE_SIZE, listing_page, product_page
+
+    base = "http://127.0.0.1:8001"
+    pages = {
+        f"{base}/product/{i}": product_page(base, i, N_PRODUCTS).encode("utf-8")
+        for i in range(1, N_PRODUCTS + 1)
+    }
+    for page in range(1, N_PRODUCTS // PAGE_SIZE + 1):
+        pages[f"{base}/products?page={page}"] = listing_page(
+            base, page, N_PRODUCTS
+        ).encode("utf-8")
+    return pages
+
+
+def check_extraction(pages: dict) -> list[str]:
+    """
+    Compares extract_components with the BeautifulSoup extraction on pages (url -> html).
+
+    :return: Urls of the pages with a different result.
+    """
+    from TP1.TP1 import parse_html_components
+
+    return [
+        url
+        for url, html_doc in pages.items()
+        if extract_components(url, html_doc)
+        != parse_html_components(url, html_doc, selective=False)
+    ]
+
+
+def benchmark(pages: dict, repeat: int = 5) -> dict:
+    """
+    Measures the parse time per page of both extractions (median of 'repeat' runs over all the pages).
+
+    :return: Dict with the time per page in milliseconds of each extraction.
+    """
+    from TP1.TP1 import parse_html_components
+
+    results = {}
+    for name, parse in [
+        ("soup", lambda url, html: parse_html_components(url, html, selective=False)),
+        ("selective", extract_components),
+    ]:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for url, html_doc in pages.items():
+                parse(url, html_doc)
+            times.append((time.perf_counter() - start) / len(pages))
+        results[name] = statistics.median(times) * 1000
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "folder",
+        nargs="?",
+        default=None,
+        help="Folder of saved .html pages, default is the pages of the local shop",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    pages = load_pages(args.folder)
+    different = check_extraction(pages)
+    print(f"{len(pages) - len(different)}/{len(pages)} pages with the same fields")
+    for url in different:
+        print(f"- different: {url}")
+
+    results = benchmark(pages, args.repeat)
+    print(
+        f"Parse time per page: BeautifulSoup {results['soup']:.3f} ms, "
+        f"selective {results['selective']:.3f} ms "
+        f"(x{results['soup'] / results['selective']:.1f})"
+    )
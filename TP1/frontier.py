@@ -0,0 +1,98 @@
+import urllib.parse
+from collections import deque
+from TP1.checkpoint import VisitedSet
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+# Query parameters changing the content of a product page (see extract_product_variant in TP2)
+PRODUCT_PARAMS = {"variant"}
+
+
+def get_host(url: str) -> str:
+    """
+    Gives the scheme and the host of a url.
+    """
+    o = urllib.parse.urlparse(url)
+    return f"{o.scheme}://{o.netloc}"
+
+
+def split_canonical(url: str) -> urllib.parse.SplitResult:
+    """
+    Splits a url in its canonical form (see canonicalize_url).
+    """
+    o = urllib.parse.urlsplit(url.strip())
+    scheme = o.scheme.lower()
+    netloc = o.netloc.lower()
+    if o.port is not None and DEFAULT_PORTS.get(scheme) == o.port:
+        netloc = netloc.rsplit(":", 1)[0]
+    path = o.path or "/"
+
+    params = urllib.parse.parse_qsl(o.query)
+    if path.startswith("/product/"):
+        # Other parameters (tracking, sorting...) give the same product
+        params = [(key, value) for key, value in params if key in PRODUCT_PARAMS]
+    query = urllib.parse.urlencode(sorted(set(params)))
+    return urllib.parse.SplitResult(scheme, netloc, path, query, "")
+
+
+def canonicalize_url(url: str) -> str:
+    """
+    Gives the canonical form of a url, so that the urls of a same page are crawled once: lowercase scheme and host,
+    no default port nor fragment, sorted query parameters without duplicates or empty values, and only the
+    variant in the query of a product page.
+    """
+    return urllib.parse.urlunsplit(split_canonical(url))
+
+
+class Frontier:
+    """
+    Queue of the urls to crawl, product pages first, where each canonical url is put only once.
+
+    'seen' holds the hashes of all the urls ever added (queued, being crawled or crawled), so that a url
+    linked from many pages is only checked in O(1) and the queue grows with the unique urls, not the links.
+    """
+
+    def __init__(self, urls=(), seen: VisitedSet = None):
+        self.seen = seen if seen is not None else VisitedSet()
+        self._queue = deque()
+        for url in urls:  # Already ordered, as saved by a checkpoint
+            url = canonicalize_url(url)
+            self.seen.add(url)
+            self._queue.append(url)
+
+    def add(self, url: str, is_allowed=None) -> bool:
+        """
+        Queues a url if its canonical form was never added and 'is_allowed(url)' (if given) is True.
+
+        :return: True if the url was queued.
+        """
+        o = split_canonical(url)
+        url = urllib.parse.urlunsplit(o)
+        if url in self.seen:
+            return False
+        self.seen.add(url)  # A forbidden url is not checked again
+        if is_allowed is not None and not is_allowed(url):
+            return False
+        if "product" in o.path:  # To priorize pages with 'product' token
+            self._queue.appendleft(url)
+        else:
+            self._queue.append(url)
+        return True
+
+    def extend(self, urls: list, is_allowed=None):
+        for url in urls:
+            self.add(url, is_allowed)
+
+    def popleft(self) -> str:
+        return self._queue.popleft()
+
+    def appendleft(self, url: str):
+        """
+        Puts back at the front a url already added, whose crawl was interrupted.
+        """
+        self._queue.appendleft(url)
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def __iter__(self):
+        return iter(self._queue)
@@ -0,0 +1,151 @@
+import argparse
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+N_PRODUCTS = 200
+LAST_MODIFIED = "Mon, 05 Jan 2026 10:00:00 GMT"
+PORT = 8001
+PAGE_SIZE = 10  # Products per listing page
+
+
+def product_page(base: str, product_id: int, n_products: int, version: int = 0) -> str:
+    """
+    Gives the html of a product page, linking to the next products and to its listing page.
+    """
+    links = "".join(
+        f'<a href="{base}/product/{(product_id + step - 1) % n_products + 1}">Product</a>'
+        for step in [1, 2, 3]
+    )
+    page = (product_id - 1) // PAGE_SIZE + 1
+    return (
+        f"<html><head><title>web-scraping.dev product {product_id}</title>"
+        f'<link rel="stylesheet" href="{base}/assets/css/main.css"></head>'
+        f'<body><h3>Product {product_id}</h3><p class="product-description">'
+        f"Description of the product {product_id}, a box of chocolate &amp; candy"
+        f"{f' (version {version})' if version else ''}.</p>"
+        f'{links}<a href="{base}/products?page={page}">Back</a>'
+        f'<a href="/relative">Relative</a></body></html>'
+    )
+
+
+def listing_page(base: str, page: int, n_products: int) -> str:
+    """
+    Gives the html of a listing page, linking to its products and to the next listing page.
+    """
+    first = (page - 1) * PAGE_SIZE + 1
+    last = min(first + PAGE_SIZE - 1, n_products)
+    links = "".join(
+        f'<a href="{base}/product/{i}">Product {i}</a>' for i in range(first, last + 1)
+    )
+    if last < n_products:
+        links += f'<a href="{base}/products?page={page + 1}">Next</a>'
+    return f"<html><head><title>Products page {page}</title></head><body>{links}</body></html>"
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+    """
+    Handler of the local shop, with keep-alive connections (HTTP/1.1).
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.n_connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: str, content_type: str = "text/html"):
+        data = body.encode("utf-8")
+        if status == 200 and self.server.validators:
+            # The pages have validators, and are only sent again if they changed
+            etag = f'"{hashlib.sha1(data).hexdigest()[:16]}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self.send_response(status)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", LAST_MODIFIED)
+        else:
+            self.send_response(status)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.n_requests += 1
+        base = f"http://{self.headers['Host']}"
+        path, _, query = self.path.partition("?")
+        n_products = self.server.n_products
+
+        if path == "/robots.txt":
+            robots = "User-agent: *\nDisallow: /private\n"
+            if self.server.crawl_delay:
+                robots += f"Crawl-delay: {self.server.crawl_delay}\n"
+            self._send(200, robots, "text/plain")
+        elif path == "/products":
+            page = int(query.split("=")[1]) if query.startswith("page=") else 1
+            self._send(200, listing_page(base, page, n_products))
+        elif path.startswith("/product/") and path[9:].isdigit():
+            product_id = int(path[9:])
+            if 1 <= product_id <= n_products:
+                version = self.server.versions.get(product_id, 0)
+                self._send(200, product_page(base, product_id, n_products, version))
+            else:
+                self._send(404, "Not found")
+        else:
+            self._send(404, "Not found")
+
+
+def make_site(
+    port: int = 0,
+    n_products: int = N_PRODUCTS,
+    crawl_delay: float = None,
+    validators: bool = True,
+) -> ThreadingHTTPServer:
+    """
+    Creates a local shop serving product and listing pages like web-scraping.dev, and counting its connections.
+    A product page changes when its version is increased in 'server.versions' (product id -> version).
+    Without 'validators', the pages have no ETag nor Last-Modified header.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), SiteHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.n_products = n_products
+    server.crawl_delay = crawl_delay
+    server.validators = validators
+    server.versions = {}
+    server.n_connections = 0
+    server.n_requests = 0
+    return server
+
+
+def start_site(**kwargs) -> tuple[ThreadingHTTPServer, str]:
+    """
+    Starts a local shop in a background thread, and gives its server and its listing url.
+    """
+    server = make_site(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/products"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--n-products", type=int, default=N_PRODUCTS)
+    parser.add_argument("--crawl-delay", type=float, default=None)
+    args = parser.parse_args()
+
+    server = make_site(args.port, args.n_products, args.crawl_delay)
+    print(f"Serving http://127.0.0.1:{args.port}/products")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,79 @@
+import hashlib
+import json
+import os
+
+VALIDATORS_PATH = "TP1/output/validators.jsonl"
+
+
+def body_hash(body: bytes) -> str:
+    """
+    Gives the SHA-1 of the body of a page.
+    """
+    return hashlib.sha1(body).hexdigest()
+
+
+def load_validators(path: str) -> dict:
+    """
+    Loads the validators saved by a previous crawl, as a dict url -> validators (empty if there is no file).
+    """
+    validators = {}
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    validators.update(json.loads(line))
+    return validators
+
+
+def validators_log_path(path_out: str) -> str:
+    """
+    Gives the path of the log of the validators of a crawl in progress, kept with its checkpoint.
+    """
+    return path_out + ".validators.checkpoint"
+
+
+def log_validators(log, url: str, validators: dict):
+    """
+    Appends the validators of a crawled page to the log of a crawl (opened in binary mode, see open_output),
+    in the format read by load_validators.
+    """
+    log.write(json.dumps({url: validators}, ensure_ascii=False).encode("utf-8") + b"\n")
+
+
+def save_validators(path: str, validators: dict):
+    """
+    Saves the validators of the crawled pages (one url per line), replacing the previous file atomically.
+    """
+    path_tmp = path + ".tmp"
+    with open(path_tmp, "w", encoding="utf-8") as f:
+        for url in sorted(validators):
+            f.write(json.dumps({url: validators[url]}, ensure_ascii=False) + "\n")
+    os.replace(path_tmp, path)
+
+
+def get_validators(headers: dict, body: bytes, links: list) -> dict:
+    """
+    Gives the validators of a downloaded page: its ETag and Last-Modified headers, the hash and the size of its
+    body, and its links (needed to go on crawling from the page when it is not downloaded again).
+    """
+    headers = {key.lower(): value for key, value in headers.items()}
+    return {
+        "etag": headers.get("etag"),
+        "last_modified": headers.get("last-modified"),
+        "hash": body_hash(body),
+        "length": len(body),
+        "links": links,
+    }
+
+
+def conditional_headers(validators: dict) -> dict:
+    """
+    Gives the headers of a conditional request from the validators of the previous crawl of a page.
+    """
+    headers = {}
+    if validators is not None:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
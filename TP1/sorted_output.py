@@ -0,0 +1,158 @@
+import glob
+import heapq
+import json
+import os
+import shutil
+from TP1.checkpoint import open_output
+
+RUN_SIZE = 10000  # Pages kept in memory before being sorted and written to a run file
+MAX_OPEN_RUNS = 64  # Runs merged at once, more runs are first merged by groups
+
+
+def runs_dir(path_out: str) -> str:
+    """
+    Gives the folder of the run files of an output file.
+    """
+    return path_out + ".runs"
+
+
+def page_url(line: bytes) -> str:
+    return json.loads(line).get("url", "")
+
+
+def merge_runs(paths: list[str], f_out):
+    """
+    k-way merges sorted run files into 'f_out', pages with the same url staying in run order.
+    """
+    files = [open(path, "rb") for path in paths]
+    try:
+        f_out.writelines(heapq.merge(*files, key=page_url))
+    finally:
+        for f in files:
+            f.close()
+
+
+class SortedWriter:
+    """
+    Writer of the crawled pages giving an output file sorted by url, with a bounded memory and a single final write.
+
+    The pages are kept in memory and appended to a log file (so that a checkpoint only has to record its size).
+    At a checkpoint, once there are 'run_size' pages in memory, they are sorted and written to a run file, and a
+    new log is started. 'finish' k-way merges the runs and the pages in memory into the output file.
+    """
+
+    def __init__(self, path_out: str, run_size: int = RUN_SIZE, state: dict = None):
+        """
+        'state' is the state given by 'checkpoint' to resume a crawl, None for a new crawl.
+        """
+        self.path_out = path_out
+        self.run_size = run_size
+        self.dir = runs_dir(path_out)
+        self.buffer = []  # (url, line) of the pages not in a run yet
+        self.sorted = False
+
+        if state is None:
+            shutil.rmtree(self.dir, ignore_errors=True)
+            os.makedirs(self.dir)
+            self.n_runs, offset = 0, None
+        elif state.get("sorted"):
+            # Finished crawl, its sorted output is the first run of the new one
+            os.makedirs(self.dir, exist_ok=True)
+            os.replace(path_out, self._run_path(0))
+            self.n_runs, offset = 1, None
+        else:
+            # The runs and logs written after the checkpoint are removed
+            self.n_runs, offset = state["runs"], state["offset"]
+            for path in glob.glob(os.path.join(self.dir, "*.jsonl")):
+                if path != self._log_path(self.n_runs) and (
+                    not path.endswith(".run.jsonl")
+                    or int(os.path.basename(path)[:6]) >= self.n_runs
+                ):
+                    os.remove(path)
+        self.log = open_output(self._log_path(self.n_runs), offset)
+        if offset:
+            with open(self._log_path(self.n_runs), "rb") as f:
+                self.buffer = [(page_url(line), line) for line in f]
+
+    def _run_path(self, n: int) -> str:
+        return os.path.join(self.dir, f"{n:06d}.run.jsonl")
+
+    def _log_path(self, n: int) -> str:
+        return os.path.join(self.dir, f"{n:06d}.log.jsonl")
+
+    def write(self, page: dict):
+        """
+        Adds a page to the output.
+        """
+        line = (json.dumps(page, ensure_ascii=False) + "\n").encode("utf-8")
+        self.log.write(line)
+        self.buffer.append((page.get("url", ""), line))
+
+    def spill(self):
+        """
+        Writes the pages in memory, sorted by url, to a new run file and starts a new log.
+        """
+        self.buffer.sort(key=lambda page: page[0])
+        with open(self._run_path(self.n_runs), "wb") as f:
+            f.writelines(line for _, line in self.buffer)
+        self.buffer = []
+        self.log.close()
+        # The previous log is only needed by a checkpoint older than the last one
+        if os.path.exists(self._log_path(self.n_runs - 1)):
+            os.remove(self._log_path(self.n_runs - 1))
+        self.n_runs += 1
+        self.log = open_output(self._log_path(self.n_runs))
+
+    def checkpoint(self) -> dict:
+        """
+        Makes the pages written so far durable, and gives the state needed to resume from this point.
+        """
+        if self.sorted:
+            return {"sorted": True}
+        if len(self.buffer) >= self.run_size:
+            self.spill()
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        return {"runs": self.n_runs, "offset": self.log.tell()}
+
+    def finish(self):
+        """
+        Writes the output file, sorted by url: k-way merge of the runs and of the pages in memory.
+        """
+        self.buffer.sort(key=lambda page: page[0])
+        with open(self._run_path(self.n_runs), "wb") as f:
+            f.writelines(line for _, line in self.buffer)
+        self.buffer = []
+        runs = [self._run_path(n) for n in range(self.n_runs + 1)]
+
+        # Consecutive runs are merged by groups so that not too many files are open at once
+        n_merged = 0
+        while len(runs) > MAX_OPEN_RUNS:
+            merged_runs = []
+            for start in range(0, len(runs), MAX_OPEN_RUNS):
+                path = os.path.join(self.dir, f"{n_merged:06d}.merged")
+                n_merged += 1
+                with open(path, "wb") as f:
+                    merge_runs(runs[start : start + MAX_OPEN_RUNS], f)
+                merged_runs.append(path)
+            runs = merged_runs
+
+        path_tmp = self.path_out + ".tmp"
+        with open(path_tmp, "wb") as f:
+            merge_runs(runs, f)
+        os.replace(path_tmp, self.path_out)
+        self.sorted = True
+
+    def close(self):
+        """
+        Closes the log, and removes the run files once the output is written.
+        """
+        self.log.close()
+        if self.sorted:
+            shutil.rmtree(self.dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,484 @@
+import functools
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+from collections.abc import Mapping
+import numpy as np
+
+# File layout (little-endian):
+#   header
+#   url offsets (n_docs + 1 x u64) + url blob            -> doc id to url table
+#   term offsets (n_terms + 1 x u64) + term blob         -> sorted term dictionary
+#   postings offsets (n_terms + 1 x u64)                 -> postings of each term
+#   doc frequencies (n_terms x u32)
+#   postings blob
+# The postings of a term are varints: for each document, the delta with the previous doc id,
+# then, if the index has positions, the number of positions and the position deltas.
+MAGIC = b"TPIX"
+VERSION = 1
+FLAG_POSITIONS = 1
+HEADER = struct.Struct("<4sHHIIQQQQQ")
+POSTINGS_CACHE_SIZE = 4096  # Terms whose decoded postings are kept by a BinaryIndex
+
+
+def encode_varint(value: int, out: bytearray):
+    """
+    Appends the varint encoding of a non-negative int to 'out' (7 bits per byte, high bit set if another byte follows).
+
+    :param value: Int to encode.
+    :type value: int
+    :param out: Buffer to append to.
+    :type out: bytearray
+    """
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varints(data: bytes) -> list[int]:
+    """
+    Decodes a sequence of varints.
+
+    :param data: Bytes containing only complete varints.
+    :type data: bytes
+    :return: List of decoded ints.
+    :rtype: list[int]
+    """
+    values = []
+    value = 0
+    shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = 0
+            shift = 0
+    return values
+
+
+def decode_varint_array(data: np.ndarray) -> np.ndarray:
+    """
+    Decodes a sequence of varints with array operations, like decode_varints.
+
+    :param data: Array of bytes (uint8) containing only complete varints.
+    :type data: np.ndarray
+    :return: Array of decoded ints.
+    :rtype: np.ndarray
+    """
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64)
+    is_last = data < 0x80
+    starts = np.concatenate(([0], np.flatnonzero(is_last)[:-1] + 1))
+    # Rank of each byte in its varint, giving the shift of its 7 bits
+    varint = np.concatenate(([0], np.cumsum(is_last)[:-1]))
+    shifts = ((np.arange(len(data)) - starts[varint]) * 7).astype(np.uint64)
+    values = (data & 0x7F).astype(np.uint64) << shifts
+    return np.add.reduceat(values, starts).astype(np.int64)
+
+
+def _iter_postings(postings) -> list[tuple[str, list[int]]]:
+    # Accepts the TP2 layout ([{url: positions}, ...] or [url, ...])
+    # and the TP3 layout ({url: positions, ...})
+    if isinstance(postings, dict):
+        return list(postings.items())
+    pairs = []
+    for entry in postings:
+        if isinstance(entry, dict):
+            pairs += list(entry.items())
+        else:
+            pairs.append((entry, None))
+    return pairs
+
+
+def encode_postings(
+    pairs: list[tuple[int, list[int]]], has_positions: bool, out: bytearray
+):
+    """
+    Appends the encoding of the postings of a term to 'out'.
+
+    :param pairs: List of (doc id, positions) pairs, sorted by doc id.
+    :type pairs: list[tuple[int, list[int]]]
+    :param has_positions: True if the positions are saved, False otherwise.
+    :type has_positions: bool
+    :param out: Buffer to append to.
+    :type out: bytearray
+    """
+    previous = 0
+    for doc_id, positions in pairs:
+        encode_varint(doc_id - previous, out)
+        previous = doc_id
+        if has_positions:
+            positions = sorted(positions or [])
+            encode_varint(len(positions), out)
+            last = 0
+            for pos in positions:
+                encode_varint(pos - last, out)
+                last = pos
+
+
+def string_table(strings: list[str]) -> tuple[bytes, bytes]:
+    """
+    Encodes strings as an offsets table (n + 1 x u64) and a blob of UTF-8 bytes.
+
+    :param strings: Strings to encode.
+    :type strings: list[str]
+    :return: Offsets table and blob.
+    :rtype: tuple[bytes, bytes]
+    """
+    blob = bytearray()
+    offsets = [0]
+    for s in strings:
+        blob += str(s).encode("utf-8")
+        offsets.append(len(blob))
+    return np.array(offsets, dtype="<u8").tobytes(), bytes(blob)
+
+
+def write_binary_index(
+    path_out: str,
+    has_positions: bool,
+    n_docs: int,
+    n_terms: int,
+    sections: list,
+):
+    """
+    Writes the header and the sections of a binary index. The file is replaced atomically, so a BinaryIndex
+    opened on the previous version keeps reading it until it is reloaded.
+
+    :param path_out: Path of the binary file.
+    :type path_out: str
+    :param has_positions: True if the postings contain positions, False otherwise.
+    :type has_positions: bool
+    :param n_docs: Number of documents.
+    :type n_docs: int
+    :param n_terms: Number of terms.
+    :type n_terms: int
+    :param sections: The 7 sections in file order (url offsets, url blob, term offsets, term blob, postings offsets, doc frequencies, postings), as bytes or as the path of a file holding them.
+    :type sections: list
+    """
+
+    def size(section) -> int:
+        return len(section) if isinstance(section, bytes) else os.path.getsize(section)
+
+    starts = []
+    position = HEADER.size
+    for section in sections:
+        starts.append(position)
+        position += size(section)
+
+    header = HEADER.pack(
+        MAGIC,
+        VERSION,
+        FLAG_POSITIONS if has_positions else 0,
+        n_docs,
+        n_terms,
+        starts[0],  # url offsets
+        starts[2],  # term offsets
+        starts[4],  # postings offsets
+        starts[5],  # doc frequencies
+        starts[6],  # postings
+    )
+    # Written aside then renamed: a reader still mapping the previous file keeps its inode
+    path_tmp = path_out + ".tmp"
+    with open(path_tmp, "wb") as f:
+        f.write(header)
+        for section in sections:
+            if isinstance(section, bytes):
+                f.write(section)
+            else:
+                with open(section, "rb") as f_section:
+                    shutil.copyfileobj(f_section, f)
+    os.replace(path_tmp, path_out)
+
+
+def save_index_to_binary(index: dict, path_out: str, urls: list[str] = None):
+    """
+    Saves an inverted index in the binary format read by BinaryIndex.
+
+    :param index: Inverted index, with or without positions, in the TP2 or TP3 layout.
+    :type index: dict
+    :param path_out: Path of the binary file.
+    :type path_out: str
+    :param urls: Urls in the order of the doc ids (e.g. the catalog order). If None, the order of first appearance is used.
+    :type urls: list[str]
+    """
+    terms = sorted(index.keys(), key=lambda t: str(t).encode("utf-8"))
+    all_postings = {term: _iter_postings(index[term]) for term in terms}
+
+    doc_ids = {} if urls is None else {url: i for i, url in enumerate(urls)}
+    for pairs in all_postings.values():
+        for url, _ in pairs:
+            if url not in doc_ids:
+                doc_ids[url] = len(doc_ids)
+    has_positions = any(
+        positions is not None
+        for pairs in all_postings.values()
+        for _, positions in pairs
+    )
+
+    postings_blob = bytearray()
+    postings_offsets = [0]
+    doc_freqs = []
+    for term in terms:
+        pairs = sorted(
+            (doc_ids[url], positions) for url, positions in all_postings[term]
+        )
+        encode_postings(pairs, has_positions, postings_blob)
+        postings_offsets.append(len(postings_blob))
+        doc_freqs.append(len(all_postings[term]))
+
+    url_offsets, url_blob = string_table(sorted(doc_ids, key=doc_ids.get))
+    term_offsets, term_blob = string_table(terms)
+
+    sections = [
+        url_offsets,
+        url_blob,
+        term_offsets,
+        term_blob,
+        np.array(postings_offsets, dtype="<u8").tobytes(),
+        np.array(doc_freqs, dtype="<u4").tobytes(),
+        bytes(postings_blob),
+    ]
+    write_binary_index(path_out, has_positions, len(doc_ids), len(terms), sections)
+
+    print(f"The file has been saved to: {path_out}!")
+
+
+class BinaryIndex(Mapping):
+    """
+    Read-only inverted index stored in the binary format, opened with mmap.
+
+    Opening only reads the header, and the postings of a term are decoded when it is looked up
+    (the last POSTINGS_CACHE_SIZE terms looked up are kept), so only the pages of the terms used
+    are read from disk. Behaves like the TP3 JSON indexes:
+    'index[token]' is {url: positions} for an index with positions, a list of urls otherwise.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: Path of the binary file written by save_index_to_binary.
+        :type path: str
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (
+            magic,
+            version,
+            flags,
+            self.n_docs,
+            self.n_terms,
+            url_start,
+            term_start,
+            postings_offsets_start,
+            doc_freq_start,
+            self._postings_start,
+        ) = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"'{path}' is not a binary index (version {VERSION}).")
+        self.has_positions = bool(flags & FLAG_POSITIONS)
+
+        def table(start: int, count: int, dtype: str) -> np.ndarray:
+            return np.frombuffer(self._mm, dtype=dtype, count=count, offset=start)
+
+        self._url_offsets = table(url_start, self.n_docs + 1, "<u8")
+        self._url_blob = url_start + 8 * (self.n_docs + 1)
+        self._term_offsets = table(term_start, self.n_terms + 1, "<u8")
+        self._term_blob = term_start + 8 * (self.n_terms + 1)
+        self._postings_offsets = table(postings_offsets_start, self.n_terms + 1, "<u8")
+        self.doc_freqs = table(doc_freq_start, self.n_terms, "<u4")
+        # Postings decoded by lookups, e.g. the positions of a term read for several documents
+        self._decoded = functools.lru_cache(maxsize=POSTINGS_CACHE_SIZE)(self._decode)
+
+    def _string(self, blob: int, offsets: np.ndarray, i: int) -> bytes:
+        return self._mm[blob + int(offsets[i]) : blob + int(offsets[i + 1])]
+
+    def term(self, i: int) -> str:
+        """
+        Gives the term of rank 'i' in the sorted term dictionary.
+        """
+        return self._string(self._term_blob, self._term_offsets, i).decode("utf-8")
+
+    def url(self, doc_id: int) -> str:
+        """
+        Gives the url of a doc id.
+        """
+        return self._string(self._url_blob, self._url_offsets, doc_id).decode("utf-8")
+
+    def find(self, token: str) -> int:
+        """
+        Gives the rank of a term in the term dictionary (binary search).
+
+        :param token: Term to look up.
+        :type token: str
+        :return: Rank of the term, -1 if it is not in the index.
+        :rtype: int
+        """
+        key = str(token).encode("utf-8")
+        low, high = 0, self.n_terms
+        while low < high:
+            middle = (low + high) // 2
+            if self._string(self._term_blob, self._term_offsets, middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if (
+            low < self.n_terms
+            and self._string(self._term_blob, self._term_offsets, low) == key
+        ):
+            return low
+        return -1
+
+    def postings(self, i: int) -> list[tuple[int, list[int]]]:
+        """
+        Decodes the postings of the term of rank 'i'.
+
+        :param i: Rank of the term.
+        :type i: int
+        :return: List of (doc id, positions) pairs, positions being None for an index without positions.
+        :rtype: list[tuple[int, list[int]]]
+        """
+        start = self._postings_start + int(self._postings_offsets[i])
+        end = self._postings_start + int(self._postings_offsets[i + 1])
+        values = decode_varints(self._mm[start:end])
+
+        pairs = []
+        doc_id = 0
+        j = 0
+        while j < len(values):
+            doc_id += values[j]
+            j += 1
+            positions = None
+            if self.has_positions:
+                count = values[j]
+                positions = []
+                pos = 0
+                for delta in values[j + 1 : j + 1 + count]:
+                    pos += delta
+                    positions.append(pos)
+                j += 1 + count
+            pairs.append((doc_id, positions))
+        return pairs
+
+    def _strings(self, blob: int, offsets: np.ndarray) -> list[str]:
+        offsets = offsets.tolist()
+        data = self._mm[blob : blob + offsets[-1]]
+        return [
+            data[start:end].decode("utf-8")
+            for start, end in zip(offsets[:-1], offsets[1:])
+        ]
+
+    def urls(self) -> list[str]:
+        """
+        Gives the urls of all the doc ids.
+        """
+        return self._strings(self._url_blob, self._url_offsets)
+
+    def terms(self) -> list[str]:
+        """
+        Gives all the terms, in the order of their rank.
+        """
+        return self._strings(self._term_blob, self._term_offsets)
+
+    def arrays(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Decodes the postings of every term at once with array operations, without building the
+        postings of each term (see postings).
+
+        :return: 'indptr', doc ids and number of positions (1 for an index without positions): the postings of the term of rank 'i' are the items 'indptr[i]' to 'indptr[i + 1]' of the two other arrays.
+        :rtype: tuple[np.ndarray, np.ndarray, np.ndarray]
+        """
+        size = int(self._postings_offsets[-1])
+        data = np.frombuffer(
+            self._mm, dtype=np.uint8, count=size, offset=self._postings_start
+        )
+        values = decode_varint_array(data)
+        if self.has_positions:
+            # Each posting is (doc id delta, n, n position deltas): only its start is walked
+            counts = values.tolist()
+            starts = []
+            append = starts.append
+            j, n = 0, len(counts)
+            while j < n:
+                append(j)
+                j += 2 + counts[j + 1]
+            starts = np.array(starts, dtype=np.int64)
+            deltas = values[starts]
+            n_positions = values[starts + 1]
+        else:
+            deltas = values
+            n_positions = np.ones(len(values), dtype=np.int64)
+
+        indptr = np.zeros(self.n_terms + 1, dtype=np.int64)
+        np.cumsum(self.doc_freqs, out=indptr[1:])
+        # The doc ids restart from 0 for each term
+        doc_ids = np.cumsum(deltas)
+        before = np.concatenate(([0], doc_ids))[indptr[:-1]]
+        doc_ids -= np.repeat(before, np.diff(indptr))
+        return indptr, doc_ids, n_positions
+
+    def _decode(self, i: int):
+        pairs = self.postings(i)
+        if self.has_positions:
+            return {self.url(doc_id): positions for doc_id, positions in pairs}
+        return [self.url(doc_id) for doc_id, _ in pairs]
+
+    def __getitem__(self, token: str):
+        i = self.find(token)
+        if i < 0:
+            raise KeyError(token)
+        return self._decoded(i)
+
+    def __contains__(self, token) -> bool:
+        return self.find(token) >= 0
+
+    def __iter__(self):
+        for i in range(self.n_terms):
+            yield self.term(i)
+
+    def __len__(self) -> int:
+        return self.n_terms
+
+    def close(self):
+        """
+        Releases the memory map.
+        """
+        # The arrays reading the map must be released first
+        self._decoded.cache_clear()
+        self._url_offsets = self._term_offsets = None
+        self._postings_offsets = self.doc_freqs = None
+        self._mm.close()
+
+
+def load_json_index(path_in: str) -> dict:
+    """
+    Loads an index saved as JSONL (TP2, one term per line) or as JSON (TP3).
+
+    :param path_in: Path of the index file.
+    :type path_in: str
+    :return: The index as a dict.
+    :rtype: dict
+    """
+    with open(path_in, "r", encoding="utf-8") as f:
+        if path_in.endswith(".jsonl"):
+            index = {}
+            for line in f:
+                if line.strip():
+                    index.update(json.loads(line))
+            return index
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    # Conversion of an existing JSON(L) index: python -m TP2.binary_index in.json out.bin
+    if len(sys.argv) != 3:
+        print(
+            "Usage: python -m TP2.binary_index path/to/index.json(l) path/to/index.bin"
+        )
+        sys.exit(1)
+    save_index_to_binary(load_json_index(sys.argv[1]), sys.argv[2])
@@ -1,48 +1,139 @@
-import sys
+import argparse
 import os
 from TP2.processing import *
+from TP2.parallel import build_parallel
+from TP2.streaming import build_streaming
+from TP2.tracing import TRACER, print_summary, save_trace, span, summarize
 
+FORMATS = ["json", "binary", "both"]
 
-def main(path_in: str, path_out: str):
-    print("Loading data...")
-    df = load_jsonl_as_df(path_in=path_in)
 
-    print("Building title indexes...")
-    title_index = build_inverted_index(df, "title", with_position=True)
-    description_index = build_inverted_index(df, "description", with_position=True)
+def main(
+    path_in: str,
+    path_out: str,
+    index_format: str = "both",
+    batch_size: int = BATCH_SIZE,
+    n_process: int = 1,
+    memory_limit: float = None,
+    n_workers: int = None,
+    cache_path: str = TOKEN_CACHE_PATH,
+    cache_size: float = TOKEN_CACHE_SIZE,
+    trace_path: str = None,
+):
+    # Texts already tokenized by a previous build are read from the cache
+    cache = None
+    if cache_path:
+        cache = TokenCache(cache_path, model_name=MODEL_NAME, max_size=cache_size)
 
-    print("Building feature indexes...")
-    brand_index = build_feature_index(df, "brand")
-    origin_index = build_feature_index(df, "origin")
-    flavors_index = build_feature_index(df, "flavors")
-    colors_index = build_feature_index(df, "colors")
+    if trace_path:
+        TRACER.enable()
 
-    print("Building reviews index...")
-    reviews_index = build_review_index(df)
-
-    print(f"Saving indexes to {path_out}/...")
-    save_index_to_json(title_index, f"{path_out}/title_index.jsonl")
-    save_index_to_json(description_index, f"{path_out}/description_index.jsonl")
-    save_index_to_json(brand_index, f"{path_out}/brand_index.jsonl")
-    save_index_to_json(origin_index, f"{path_out}/origin_index.jsonl")
-    save_index_to_json(flavors_index, f"{path_out}/flavors_index.jsonl")
-    save_index_to_json(colors_index, f"{path_out}/colors_index.jsonl")
-    save_index_to_json(reviews_index, f"{path_out}/reviews_index.jsonl")
+    with span("build", streaming=memory_limit is not None):
+        if memory_limit is not None:
+            # Bounded memory: the catalog is streamed and the postings are spilled to disk
+            print(f"Streaming build with a memory limit of {memory_limit} MB...")
+            summary = build_streaming(
+                path_in,
+                path_out,
+                memory_limit=int(memory_limit * 2**20),
+                index_format=index_format,
+                batch_size=batch_size,
+                n_process=n_process,
+                cache=cache,
+            )
+            print(
+                f"{summary['documents']} documents, runs per index: {summary['runs']}"
+            )
+        else:
+            # The products are parsed once and the indexes are built in parallel
+            build_parallel(
+                path_in,
+                path_out,
+                index_format=index_format,
+                batch_size=batch_size,
+                n_process=n_process,
+                n_workers=n_workers,
+                cache=cache,
+            )
 
+    if cache is not None:
+        stats = cache.stats
+        print(
+            f"Token cache: {stats['hits']} hits, {stats['misses']} misses "
+            f"(hit rate {stats['hit_rate']:.1%})"
+        )
+        cache.close()
+    if trace_path:
+        save_trace(trace_path)
+        print_summary(summarize(TRACER.events))
     print("Done!")
 
 
 if __name__ == "__main__":
-    input_path = "TP2/input/products.jsonl"
-    output_path = "TP2/output"
-
-    if len(sys.argv) > 1:
-        input_path = sys.argv[1]
-
-    if len(sys.argv) > 2:
-        output_path = sys.argv[2]
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_path", nargs="?", default="TP2/input/products.jsonl")
+    parser.add_argument("output_path", nargs="?", default="TP2/output")
+    parser.add_argument(
+        "--format",
+        choices=FORMATS,
+        default="both",
+        help="JSONL (readable, for debugging), binary (compact, read with mmap) or both",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=BATCH_SIZE,
+        help="Number of texts given to spaCy at once",
+    )
+    parser.add_argument(
+        "--n-process",
+        type=int,
+        default=1,
+        help="Number of tokenization processes, -1 for one per CPU",
+    )
+    parser.add_argument(
+        "--memory-limit",
+        type=float,
+        default=None,
+        help="Memory for the postings in MB: streams the catalog and merges sorted runs from disk",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of processes building the indexes (default is one per CPU)",
+    )
+    parser.add_argument(
+        "--token-cache",
+        default=TOKEN_CACHE_PATH,
+        help="sqlite file caching the tokens between builds, empty to disable",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=float,
+        default=TOKEN_CACHE_SIZE,
+        help="Maximum size of the cached tokens in MB",
+    )
+    parser.add_argument(
+        "--trace",
+        help="JSON lines file saving the time of each stage of the build, "
+        "a Chrome trace is saved next to it",
+    )
+    args = parser.parse_args()
 
+    output_path = args.output_path
     if not os.path.exists(output_path):
         os.makedirs(output_path)
         print(f"Created directory: {output_path}")
-    main(path_in=input_path, path_out=output_path)
+    main(
+        path_in=args.input_path,
+        path_out=output_path,
+        index_format=args.format,
+        batch_size=args.batch_size,
+        n_process=args.n_process,
+        memory_limit=args.memory_limit,
+        n_workers=args.workers,
+        cache_path=args.token_cache,
+        cache_size=args.cache_size,
+        trace_path=args.trace,
+    )
@@ -0,0 +1,276 @@
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from TP2.processing import *
+from TP2.binary_index import save_index_to_binary
+from TP2.tracing import TRACER, span
+
+try:
+    import resource
+except ImportError:  # Not available on Windows, the peak memory is not measured
+    resource = None
+
+POSITION_FIELDS = ["title", "description"]
+FEATURE_FIELDS = ["brand", "origin", "flavors", "colors"]
+
+# Urls and field data of a build, inherited by the forked workers instead of being sent with each index
+_BUILD_STATE = {}
+
+
+def peak_rss() -> int:
+    """
+    Gives the peak resident memory of this process, in bytes.
+
+    :return: Peak memory in bytes, None if it cannot be measured.
+    :rtype: int
+    """
+    if resource is None:
+        return None
+    unit = 1 if sys.platform == "darwin" else 1024  # ru_maxrss is in KB on Linux
+    return unit * resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def parse_products(
+    path_in: str,
+    batch_size: int = BATCH_SIZE,
+    n_process: int = 1,
+    cache: TokenCache = None,
+) -> dict:
+    """
+    Reads the catalog and tokenizes the titles and descriptions in a single spaCy pass.
+
+    :param path_in: Path of the JSONL catalog.
+    :type path_in: str
+    :param batch_size: Number of documents given to spaCy at once.
+    :type batch_size: int
+    :param n_process: Number of processes tokenizing the documents (-1 for one per CPU).
+    :type n_process: int
+    :param cache: Cache of the tokens, None to tokenize every text.
+    :type cache: TokenCache
+    :return: Dict with the urls, the tokens of each positional field, the features and the reviews of the products, in catalog order.
+    :rtype: dict
+    """
+    with span("load catalog"):
+        df = load_jsonl_as_df(path_in=path_in)
+    n_docs = len(df)
+
+    # The titles and the descriptions go through the same nlp.pipe call
+    texts = []
+    for field in POSITION_FIELDS:
+        texts += df[field].to_list()
+    with span("tokenize", texts=len(texts)):
+        tokens = get_clean_tokens_batch(
+            texts, batch_size=batch_size, n_process=n_process, cache=cache
+        )
+
+    parsed = {
+        "urls": df["url"].to_list(),
+        "features": df["product_features"].to_list(),
+        "reviews": df["product_reviews"].to_list(),
+    }
+    for i, field in enumerate(POSITION_FIELDS):
+        parsed[field] = tokens[i * n_docs : (i + 1) * n_docs]
+    return parsed
+
+
+def save_index(index: dict, name: str, path_out: str, index_format: str, urls: list):
+    """
+    Writes an inverted index to 'path_out', as JSONL and/or binary.
+
+    :param index: Inverted index.
+    :type index: dict
+    :param name: Name of the index, used in the file names.
+    :type name: str
+    :param path_out: Output folder.
+    :type path_out: str
+    :param index_format: 'json', 'binary' or 'both'.
+    :type index_format: str
+    :param urls: Urls in catalog order, used as doc ids of the binary index.
+    :type urls: list
+    """
+    if index_format in ["json", "both"]:
+        with span("write index", name=name, format="json"):
+            save_index_to_json(index, f"{path_out}/{name}_index.jsonl")
+    if index_format in ["binary", "both"]:
+        with span("write index", name=name, format="binary"):
+            save_index_to_binary(index, f"{path_out}/{name}_index.bin", urls=urls)
+
+
+def build_and_save(
+    name: str, urls: list, data: list, path_out: str, index_format: str
+) -> dict:
+    """
+    Builds one index from its field data and writes it. Runs in a worker of the pool.
+
+    :param name: Name of the index ('title', 'description', a feature or 'reviews').
+    :type name: str
+    :param urls: Urls in catalog order.
+    :type urls: list
+    :param data: Field data of each product: tokens, 'product_features' or 'product_reviews'.
+    :type data: list
+    :param path_out: Output folder.
+    :type path_out: str
+    :param index_format: 'json', 'binary' or 'both'.
+    :type index_format: str
+    :return: Dict with the name, the document frequencies (None for reviews), the wall time in seconds and the peak resident memory of the process in bytes (see peak_rss).
+    :rtype: dict
+    """
+    start = time.perf_counter()
+    with span("build index", name=name):
+        if name == "reviews":
+            reviews = index_reviews(urls, data)
+            with span("write index", name=name, format="json"):
+                save_index_to_json(reviews, f"{path_out}/reviews_index.jsonl")
+            doc_freq = None
+        else:
+            if name in POSITION_FIELDS:
+                index = index_tokens(urls, data, with_position=True)
+            else:
+                index = index_features(urls, data, name)
+            save_index(index, name, path_out, index_format, urls)
+            doc_freq = {token: len(postings) for token, postings in index.items()}
+
+    return {
+        "name": name,
+        "doc_freq": doc_freq,
+        "seconds": time.perf_counter() - start,
+        "peak_memory": peak_rss(),
+    }
+
+
+def _init_worker(urls: list, tasks: dict):
+    # Without fork, the build state is sent once to each worker
+    _BUILD_STATE.update(urls=urls, tasks=tasks)
+
+
+def build_in_worker(trace: bool, name: str, path_out: str, index_format: str) -> dict:
+    """
+    Runs build_and_save in a worker of the pool, on the urls and the field data of _BUILD_STATE.
+    The spans recorded by the worker are added to its report.
+
+    :param trace: True if tracing is enabled in the main process.
+    :type trace: bool
+    :param name: Name of the index.
+    :type name: str
+    :param path_out: Output folder.
+    :type path_out: str
+    :param index_format: 'json', 'binary' or 'both'.
+    :type index_format: str
+    :return: Report of build_and_save, with the events of the worker under 'trace'.
+    :rtype: dict
+    """
+    # A forked worker inherits the events and the open spans of the main process
+    TRACER.reset()
+    if trace:
+        TRACER.enable()
+    urls, data = _BUILD_STATE["urls"], _BUILD_STATE["tasks"][name]
+    report = build_and_save(name, urls, data, path_out, index_format)
+    report["trace"] = TRACER.take(os.getpid())
+    return report
+
+
+def build_parallel(
+    path_in: str,
+    path_out: str,
+    index_format: str = "both",
+    batch_size: int = BATCH_SIZE,
+    n_process: int = 1,
+    n_workers: int = None,
+    cache: TokenCache = None,
+) -> list[dict]:
+    """
+    Builds every index of the catalog: the products are parsed and tokenized once, then the
+    independent indexes are built in a process pool, each one written as soon as it is complete.
+    The files are the same as the ones of the in-memory functions (build_inverted_index, index_features,
+    index_reviews and build_stats) saved with save_index_to_json and save_index_to_binary.
+
+    :param path_in: Path of the JSONL catalog.
+    :type path_in: str
+    :param path_out: Output folder.
+    :type path_out: str
+    :param index_format: 'json', 'binary' or 'both'.
+    :type index_format: str
+    :param batch_size: Number of documents given to spaCy at once.
+    :type batch_size: int
+    :param n_process: Number of processes tokenizing the documents (-1 for one per CPU).
+    :type n_process: int
+    :param n_workers: Number of processes building the indexes, 1 to build them in this process (default is one per CPU).
+    :type n_workers: int
+    :param cache: Cache of the tokens, None to tokenize every text.
+    :type cache: TokenCache
+    :return: Report of each index (see build_and_save), in completion order, then the one of the statistics.
+    :rtype: list[dict]
+    """
+    print("Loading and tokenizing data...")
+    with span("parse products"):
+        parsed = parse_products(
+            path_in, batch_size=batch_size, n_process=n_process, cache=cache
+        )
+    urls = parsed["urls"]
+
+    tasks = {name: parsed[name] for name in POSITION_FIELDS}
+    tasks.update({name: parsed["features"] for name in FEATURE_FIELDS})
+    tasks["reviews"] = parsed["reviews"]
+    n_workers = n_workers or min(len(tasks), os.cpu_count() or 1)
+
+    print(f"Building {len(tasks)} indexes with {n_workers} process(es)...")
+    reports = []
+    if n_workers == 1:
+        for name, data in tasks.items():
+            reports.append(build_and_save(name, urls, data, path_out, index_format))
+            print_report(reports[-1])
+    else:
+        _BUILD_STATE.update(urls=urls, tasks=tasks)
+        if "fork" in multiprocessing.get_all_start_methods():
+            pool = ProcessPoolExecutor(
+                max_workers=n_workers, mp_context=multiprocessing.get_context("fork")
+            )
+        else:
+            pool = ProcessPoolExecutor(
+                max_workers=n_workers, initializer=_init_worker, initargs=(urls, tasks)
+            )
+        try:
+            with pool:
+                futures = [
+                    pool.submit(
+                        build_in_worker, TRACER.enabled, name, path_out, index_format
+                    )
+                    for name in tasks
+                ]
+                for future in as_completed(futures):
+                    reports.append(future.result())
+                    TRACER.merge(reports[-1].pop("trace"))
+                    print_report(reports[-1])
+        finally:
+            _BUILD_STATE.clear()
+
+    # The statistics need the document frequencies of every index
+    start = time.perf_counter()
+    with span("stats"):
+        doc_freqs = {report["name"]: report["doc_freq"] for report in reports}
+        stats = {"N": len(urls)}
+        for name in POSITION_FIELDS + FEATURE_FIELDS:
+            if name in POSITION_FIELDS:
+                lengths = [len(tokens) for tokens in parsed[name]]
+            else:
+                # A feature is a single value, so it counts as one token
+                lengths = [1] * len(urls)
+            stats[name] = get_field_stats(urls, lengths, doc_freqs[name])
+        save_index_to_json(stats, f"{path_out}/stats.jsonl")
+    reports.append(
+        {"name": "stats", "seconds": time.perf_counter() - start, "peak_memory": None}
+    )
+    print_report(reports[-1])
+
+    return reports
+
+
+def print_report(report: dict):
+    """
+    Prints the wall time and the peak memory of an index build.
+    """
+    peak = report["peak_memory"]
+    memory = f", peak memory {peak / 2**20:.1f} MB" if peak is not None else ""
+    print(f"- {report['name']}: {report['seconds']:.3f}s{memory}")
@@ -5,9 +5,25 @@ import spacy
 import string
 import numpy as np
 from tqdm import tqdm
+from TP2.token_cache import TOKEN_CACHE_PATH, TOKEN_CACHE_SIZE, TokenCache
+from TP2.tracing import count, span
 
-tqdm.pandas()
-nlp = spacy.load("en_core_web_md", disable=["parser"])
+MODEL_NAME = "en_core_web_md"
+BATCH_SIZE = 256  # Number of texts given to spaCy at once
+_nlp = None
+
+
+def get_nlp():
+    """
+    Gives the spaCy model, loaded the first time it is needed (a build served by the token cache never loads it).
+
+    :return: The spaCy model.
+    :rtype: spacy.Language
+    """
+    global _nlp
+    if _nlp is None:
+        _nlp = spacy.load(MODEL_NAME, disable=["parser"])
+    return _nlp
 
 
 def load_jsonl_as_df(path_in: str) -> pd.DataFrame:
@@ -60,27 +76,111 @@ def extract_product_variant(url: str) -> list[str]:
     return variant
 
 
-def get_clean_tokens(doc: str) -> list[str]:
+def clean_text(doc: str) -> str:
     """
-    Gives the tokenized version of the given 'doc', without stopwords and punctuation.
+    Lowercases the given 'doc' and replaces its punctuation by spaces, before tokenization.
 
     :param doc: Document we want to process.
     :type doc: str
-    :return: List of cleant tokens corresponding.
-    :rtype: list[str]
+    :return: Cleant text.
+    :rtype: str
     """
     text = doc.lower().translate(
         str.maketrans(string.punctuation, " " * len(string.punctuation))
     )
-    text = nlp(text.lower())
-    tokens = [
+    return text.lower()
+
+
+def filter_tokens(text) -> list[str]:
+    """
+    Keeps the tokens of a spaCy document which are not stopwords, punctuation or spaces.
+
+    :param text: Document tokenized by spaCy.
+    :type text: spacy.tokens.Doc
+    :return: List of cleant tokens.
+    :rtype: list[str]
+    """
+    return [
         token.text
         for token in text
         if not token.is_stop and not token.is_punct and not token.is_space
     ]
+
+
+def get_clean_tokens(doc: str) -> list[str]:
+    """
+    Gives the tokenized version of the given 'doc', without stopwords and punctuation.
+
+    :param doc: Document we want to process.
+    :type doc: str
+    :return: List of cleant tokens corresponding.
+    :rtype: list[str]
+    """
+    text = get_nlp()(clean_text(doc))
+    tokens = filter_tokens(text)
     return tokens
 
 
+def get_clean_tokens_batch(
+    docs: list[str],
+    batch_size: int = BATCH_SIZE,
+    n_process: int = 1,
+    progress: bool = True,
+    cache: TokenCache = None,
+) -> list[list[str]]:
+    """
+    Gives the tokenized version of every document of 'docs', like get_clean_tokens, but streams them through spaCy by batches.
+
+    The tokens only need the tokenizer (stopwords and punctuation are lexical attributes),
+    so every component of the pipeline is disabled.
+
+    :param docs: Documents we want to process.
+    :type docs: list[str]
+    :param batch_size: Number of documents given to spaCy at once.
+    :type batch_size: int
+    :param n_process: Number of processes tokenizing the documents (-1 for one per CPU).
+    :type n_process: int
+    :param progress: True to show a progress bar, False otherwise.
+    :type progress: bool
+    :param cache: Cache of the tokens, only the documents missing from it go through spaCy. If None, every document does.
+    :type cache: TokenCache
+    :return: List of cleant tokens of each document, in the same order as 'docs'.
+    :rtype: list[list[str]]
+    """
+    if cache is not None:
+        with span("token cache", texts=len(docs)):
+            all_tokens = cache.get_many(docs)
+        missing = [i for i, tokens in enumerate(all_tokens) if tokens is None]
+        count("token_cache_hits", len(docs) - len(missing))
+        if missing:
+            missing_docs = [docs[i] for i in missing]
+            new_tokens = get_clean_tokens_batch(
+                missing_docs,
+                batch_size=batch_size,
+                n_process=n_process,
+                progress=progress,
+            )
+            cache.put_many(missing_docs, new_tokens)
+            for i, tokens in zip(missing, new_tokens):
+                all_tokens[i] = tokens
+        return all_tokens
+
+    if not docs:
+        return []
+    with span("load model"):
+        nlp = get_nlp()
+    with span("spacy", texts=len(docs)):
+        count("tokenized_texts", len(docs))
+        texts = (clean_text(doc) for doc in docs)
+        tokenized = nlp.pipe(
+            texts, batch_size=batch_size, n_process=n_process, disable=nlp.pipe_names
+        )
+        return [
+            filter_tokens(text)
+            for text in tqdm(tokenized, total=len(docs), disable=not progress)
+        ]
+
+
 def get_token_position(token: str, doc: list[str]) -> list[int]:
     """
     Gives the list of positions of a token in a document.
@@ -101,7 +201,11 @@ def get_token_position(token: str, doc: list[str]) -> list[int]:
 
 
 def build_inverted_index(
-    df: pd.DataFrame, column_name: str, with_position: bool = False
+    df: pd.DataFrame,
+    column_name: str,
+    with_position: bool = False,
+    batch_size: int = BATCH_SIZE,
+    n_process: int = 1,
 ) -> dict:
     """
     Creates the inverted index for all tokens of 'column_name', and their positions if 'with_position' = True.
@@ -112,6 +216,10 @@ def build_inverted_index(
     :type column_name: str
     :param with_position: True if we also want the token position in each document, False otherwise.
     :type column_name: bool
+    :param batch_size: Number of documents given to spaCy at once.
+    :type batch_size: int
+    :param n_process: Number of processes tokenizing the documents (-1 for one per CPU).
+    :type n_process: int
     :return: Dict with all possible tokens of column 'column_name' as keys and the list of urls containing it as values.
     :rtype: dict
     """
@@ -121,19 +229,43 @@ def build_inverted_index(
         raise ValueError("'column_name' should take value in ['title', 'description'].")
 
     processed = f"processed_{column_name}"
-    df[processed] = df[column_name].progress_apply(get_clean_tokens)
+    df[processed] = get_clean_tokens_batch(
+        df[column_name].to_list(), batch_size=batch_size, n_process=n_process
+    )
 
+    return index_tokens(df["url"], df[processed], with_position=with_position)
+
+
+def index_tokens(
+    urls: list[str], all_tokens: list[list[str]], with_position: bool = False
+) -> dict:
+    """
+    Creates the inverted index of tokenized documents.
+
+    :param urls: Urls of the documents.
+    :type urls: list[str]
+    :param all_tokens: Tokens of each document, in the order of 'urls'.
+    :type all_tokens: list[list[str]]
+    :param with_position: True if we also want the token position in each document, False otherwise.
+    :type with_position: bool
+    :return: Dict with all tokens as sorted keys and their postings as values.
+    :rtype: dict
+    """
     inverted_index = {}
 
-    for _, row in df.iterrows():
-        current_url = row["url"]
-        unique_tokens = set(row[processed])
+    # Each document is read once: the positions of all its tokens are gathered
+    # in a single pass, then appended to the postings of the tokens
+    for current_url, tokens in zip(urls, all_tokens):
+        doc_positions = {}
+        for position, token in enumerate(tokens):
+            if token not in doc_positions:
+                doc_positions[token] = []
+            doc_positions[token].append(position)
 
-        for token in unique_tokens:
+        for token, positions in doc_positions.items():
             if token not in inverted_index:
                 inverted_index[token] = []
             if with_position:
-                positions = get_token_position(token, row[processed])
                 inverted_index[token].append({current_url: positions})
             else:
                 inverted_index[token].append(current_url)
@@ -141,18 +273,15 @@ def build_inverted_index(
     return {k: inverted_index[k] for k in sorted(inverted_index.keys())}
 
 
-def build_feature_index(df: pd.DataFrame, feature_name: str) -> dict:
+def get_feature_key(feature_name: str) -> str:
     """
-    Docstring pour build_feature_index
+    Gives the key of a feature in the 'product_features' of a product.
 
-    :param df: Dataframe with urls and their corresponding features.
-    :type df: pd.DataFrame
-    :param feature_name: Name of the feature we want to extract.
+    :param feature_name: Name of the feature ('brand', 'origin', 'colors' or 'flavors').
     :type feature_name: str
-    :return: Dict with all possible features of 'features_name' as keys and the list of urls containing it as values.
-    :rtype: dict
+    :return: Key of the feature.
+    :rtype: str
     """
-
     if not isinstance(feature_name, str):
         raise TypeError("'feature_name' should be a str instance.")
     if feature_name not in ["brand", "origin", "colors", "flavors"]:
@@ -161,20 +290,68 @@ def build_feature_index(df: pd.DataFrame, feature_name: str) -> dict:
         )
 
     if feature_name == "origin":
-        column_name = "made in"
+        return "made in"
+    return feature_name
+
+
+def get_review_stats(all_reviews: list[dict]) -> dict:
+    """
+    Gives the reviews count, mean rating and last rating of a product.
+
+    :param all_reviews: Reviews of the product.
+    :type all_reviews: list[dict]
+    :return: Dict with 'total_reviews', 'mean_marks' and 'last_rating'.
+    :rtype: dict
+    """
+    all_ratings = [r["rating"] for r in all_reviews]
+
+    stats = {}
+    stats["total_reviews"] = len(all_reviews)
+    if len(all_reviews) > 0:
+        stats["mean_marks"] = np.mean(all_ratings)
+        stats["last_rating"] = all_ratings[-1]
     else:
-        column_name = feature_name
+        stats["mean_marks"] = None
+        stats["last_rating"] = None
+    return stats
+
+
+def build_feature_index(df: pd.DataFrame, feature_name: str) -> dict:
+    """
+    Docstring pour build_feature_index
+
+    :param df: Dataframe with urls and their corresponding features.
+    :type df: pd.DataFrame
+    :param feature_name: Name of the feature we want to extract.
+    :type feature_name: str
+    :return: Dict with all possible features of 'features_name' as keys and the list of urls containing it as values.
+    :rtype: dict
+    """
+    return index_features(df["url"], df["product_features"], feature_name)
 
-    df[feature_name] = df["product_features"].progress_apply(
-        lambda x: x[column_name] if column_name in x.keys() else None
-    )
+
+def index_features(
+    urls: list[str], all_features: list[dict], feature_name: str
+) -> dict:
+    """
+    Creates the inverted index of a feature, without modifying the products.
+
+    :param urls: Urls of the products.
+    :type urls: list[str]
+    :param all_features: 'product_features' of each product, in the order of 'urls'.
+    :type all_features: list[dict]
+    :param feature_name: Name of the feature we want to extract.
+    :type feature_name: str
+    :return: Dict with all values of the feature as keys and the list of urls having it as values.
+    :rtype: dict
+    """
+    column_name = get_feature_key(feature_name)
 
     inverted_index = {}
 
-    for _, row in df.iterrows():
-        current_url = row["url"]
-        if column_name in row["product_features"]:
-            feature = row["product_features"][column_name].lower()
+    for current_url, features in zip(urls, all_features):
+        if column_name in features:
+            feature = features[column_name].lower()
             if feature not in inverted_index:
                 inverted_index[feature] = []
             inverted_index[feature].append(current_url)
@@ -191,23 +368,77 @@ def build_review_index(df: pd.DataFrame) -> dict:
     :return: Dict with all urls as keys and a doct of their reviews count, mean ratings and last ratings as values.
     :rtype: dict
     """
+    return index_reviews(df["url"], df["product_reviews"])
+
+
+def index_reviews(urls: list[str], all_reviews: list[list[dict]]) -> dict:
+    """
+    Creates the reviews index of products.
+
+    :param urls: Urls of the products.
+    :type urls: list[str]
+    :param all_reviews: 'product_reviews' of each product, in the order of 'urls'.
+    :type all_reviews: list[list[dict]]
+    :return: Dict with all urls as keys and a dict of their reviews count, mean ratings and last ratings as values.
+    :rtype: dict
+    """
     index = {}
 
-    for _, row in df.iterrows():
-        current_url = row["url"]
-        all_reviews = row["product_reviews"]
-        all_ratings = [r["rating"] for r in all_reviews]
+    for current_url, reviews in zip(urls, all_reviews):
+        index[current_url] = get_review_stats(reviews)
+
+    return index
+
+
+def build_stats(df: pd.DataFrame, indexes: dict) -> dict:
+    """
+    Computes the collection statistics needed by BM25 for each indexed field.
 
-        index[current_url] = {}
-        index[current_url]["total_reviews"] = len(all_reviews)
-        if len(all_reviews) > 0:
-            index[current_url]["mean_marks"] = np.mean(all_ratings)
-            index[current_url]["last_rating"] = all_ratings[-1]
+    :param df: Dataframe used to build the indexes, with the 'processed_title' and 'processed_description' columns.
+    :type df: pd.DataFrame
+    :param indexes: Dict with the field names as keys and their inverted index as values.
+    :type indexes: dict
+    :return: Dict with the number of documents 'N' and, for each field, the length of every document, the average length and the document frequency of every token.
+    :rtype: dict
+    """
+    stats = {"N": len(df)}
+
+    for field, index in indexes.items():
+        processed = f"processed_{field}"
+        if processed in df.columns:
+            # Number of indexed tokens of the field
+            lengths = [len(tokens) for tokens in df[processed]]
         else:
-            index[current_url]["mean_marks"] = None
-            index[current_url]["last_rating"] = None
+            # A feature is a single value, so it counts as one token
+            lengths = [1] * len(df)
 
-    return index
+        stats[field] = get_field_stats(
+            df["url"],
+            lengths,
+            {token: len(postings) for token, postings in index.items()},
+        )
+
+    return stats
+
+
+def get_field_stats(urls: list[str], lengths: list[int], doc_freq: dict) -> dict:
+    """
+    Gathers the statistics of one field, in the format of build_stats.
+
+    :param urls: Urls of the documents.
+    :type urls: list[str]
+    :param lengths: Number of tokens of the field in each document, in the order of 'urls'.
+    :type lengths: list[int]
+    :param doc_freq: Document frequency of every token of the field.
+    :type doc_freq: dict
+    :return: Dict with the average length, the length of every document and the document frequencies.
+    :rtype: dict
+    """
+    return {
+        "avg_length": float(np.mean(lengths)) if lengths else 0.0,
+        "doc_length": dict(zip(urls, lengths)),
+        "doc_freq": doc_freq,
+    }
 
 
 def save_index_to_json(data: dict, path_out: str):
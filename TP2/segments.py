@@ -0,0 +1,601 @@
+import argparse
+import glob
+import json
+import os
+import shutil
+import threading
+import time
+import pandas as pd
+from TP2.binary_index import BinaryIndex, save_index_to_binary
+
+# Layout of a segmented index folder:
+#   segments.json                  -> manifest: live segments, in order, and their tombstones
+#   seg_<id>/urls.json             -> urls of the segment, in doc id order
+#   seg_<id>/seqs.json             -> catalog sequence number of each url, in doc id order
+#   seg_<id>/products.jsonl        -> raw products of the segment
+#   seg_<id>/<field>_index.bin     -> inverted indexes of the segment (see binary_index.py)
+#   seg_<id>/reviews_index.json    -> reviews index of the segment
+# A segment is never modified once written: a replaced or deleted url is only listed in the
+# 'deleted' tombstones of its segment, and the manifest is replaced atomically.
+# A url gets a sequence number when it is first indexed and keeps it when it is re-crawled, so the
+# live documents sorted by sequence number are in the order of the catalog.
+MANIFEST = "segments.json"
+POSITION_FIELDS = ["title", "description"]
+FEATURE_FIELDS = ["brand", "origin", "flavors", "colors"]
+MERGE_FACTOR = 4  # Number of segments of the same tier merged together
+LOAD_RETRIES = 3
+
+
+def read_manifest(path: str) -> dict:
+    """
+    Reads the manifest of a segmented index folder.
+
+    :param path: Folder of the segmented index.
+    :type path: str
+    :return: Manifest, with the id of the next segment, the next sequence number and the list of live segments.
+    :rtype: dict
+    """
+    manifest_path = os.path.join(path, MANIFEST)
+    if not os.path.exists(manifest_path):
+        return {"next_id": 0, "next_seq": 0, "segments": []}
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_manifest(path: str, manifest: dict):
+    """
+    Replaces the manifest of a segmented index folder atomically.
+
+    :param path: Folder of the segmented index.
+    :type path: str
+    :param manifest: New manifest.
+    :type manifest: dict
+    """
+    tmp_path = os.path.join(path, MANIFEST + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, os.path.join(path, MANIFEST))
+
+
+def write_segment(
+    segment_path: str,
+    products: list[dict],
+    seqs: list[int],
+    indexes: dict,
+    reviews_index: dict,
+):
+    """
+    Writes the files of a segment.
+
+    :param segment_path: Folder of the segment, created if needed.
+    :type segment_path: str
+    :param products: Raw products of the segment, in doc id order.
+    :type products: list[dict]
+    :param seqs: Catalog sequence number of each product.
+    :type seqs: list[int]
+    :param indexes: Dict with the field names as keys and their inverted index (TP2 or TP3 layout) as values.
+    :type indexes: dict
+    :param reviews_index: Reviews index of the products.
+    :type reviews_index: dict
+    """
+    os.makedirs(segment_path, exist_ok=True)
+    urls = [product["url"] for product in products]
+    with open(os.path.join(segment_path, "urls.json"), "w", encoding="utf-8") as f:
+        json.dump(urls, f, ensure_ascii=False)
+    with open(os.path.join(segment_path, "seqs.json"), "w", encoding="utf-8") as f:
+        json.dump(seqs, f)
+    with open(os.path.join(segment_path, "products.jsonl"), "w", encoding="utf-8") as f:
+        for product in products:
+            f.write(json.dumps(product, ensure_ascii=False) + "\n")
+    for name, index in indexes.items():
+        save_index_to_binary(
+            index, os.path.join(segment_path, f"{name}_index.bin"), urls=urls
+        )
+    with open(
+        os.path.join(segment_path, "reviews_index.json"), "w", encoding="utf-8"
+    ) as f:
+        json.dump(reviews_index, f, ensure_ascii=False)
+
+
+def read_segment_files(path: str, name: str) -> dict:
+    """
+    Reads all the documents of a segment, tombstones included.
+
+    :param path: Folder of the segmented index.
+    :type path: str
+    :param name: Name of the segment.
+    :type name: str
+    :return: Dict with the 'products', their sequence numbers 'seqs', each inverted index (TP3 layout) and the 'reviews'.
+    :rtype: dict
+    """
+    segment_path = os.path.join(path, name)
+    with open(os.path.join(segment_path, "products.jsonl"), "r", encoding="utf-8") as f:
+        products = [json.loads(line) for line in f if line.strip()]
+    with open(os.path.join(segment_path, "seqs.json"), "r", encoding="utf-8") as f:
+        seqs = json.load(f)
+    with open(
+        os.path.join(segment_path, "reviews_index.json"), "r", encoding="utf-8"
+    ) as f:
+        reviews = json.load(f)
+
+    data = {"products": products, "seqs": seqs, "reviews": reviews, "indexes": {}}
+    for field in POSITION_FIELDS + FEATURE_FIELDS:
+        index = BinaryIndex(os.path.join(segment_path, f"{field}_index.bin"))
+        urls = index.urls()
+        full = {}
+        for i, term in enumerate(index.terms()):
+            if index.has_positions:
+                full[term] = {
+                    urls[doc_id]: positions for doc_id, positions in index.postings(i)
+                }
+            else:
+                full[term] = [urls[doc_id] for doc_id, _ in index.postings(i)]
+        index.close()
+        data["indexes"][field] = full
+    return data
+
+
+def segment_version(path: str, name: str) -> tuple:
+    """
+    Gives what identifies the files of a segment on disk, to tell a cached segment from a new one with the same name.
+    """
+    stat = os.stat(os.path.join(path, name, "urls.json"))
+    return (stat.st_ino, stat.st_mtime_ns)
+
+
+def read_segment(path: str, segment: dict, cache: dict = None) -> dict:
+    """
+    Reads the live documents of a segment.
+
+    :param path: Folder of the segmented index.
+    :type path: str
+    :param segment: Entry of the segment in the manifest.
+    :type segment: dict
+    :param cache: Segments already read (see read_segment_files), by name, updated with this one. A segment is never modified, so it is only read once.
+    :type cache: dict
+    :return: Dict with the live 'products' and their sequence numbers 'seqs', the live part of each inverted index (TP3 layout) and the live 'reviews'.
+    :rtype: dict
+    """
+    name = segment["name"]
+    version = segment_version(path, name)
+    if cache is not None and name in cache and cache[name][0] == version:
+        data = cache[name][1]
+    else:
+        data = read_segment_files(path, name)
+        if cache is not None:
+            cache[name] = (version, data)
+
+    deleted = set(segment["deleted"])
+    if not deleted:
+        return data
+    live = {
+        "products": [],
+        "seqs": [],
+        "reviews": {url: r for url, r in data["reviews"].items() if url not in deleted},
+        "indexes": {},
+    }
+    for product, seq in zip(data["products"], data["seqs"]):
+        if product["url"] not in deleted:
+            live["products"].append(product)
+            live["seqs"].append(seq)
+    for field, index in data["indexes"].items():
+        live_index = {}
+        for token, postings in index.items():
+            if isinstance(postings, dict):
+                postings = {
+                    url: positions
+                    for url, positions in postings.items()
+                    if url not in deleted
+                }
+            else:
+                postings = [url for url in postings if url not in deleted]
+            if postings:
+                live_index[token] = postings
+        live["indexes"][field] = live_index
+    return live
+
+
+def merge_segments(path: str, segments: list[dict], cache: dict = None) -> dict:
+    """
+    Merges the live documents of several segments, in catalog order (by sequence number).
+
+    :param path: Folder of the segmented index.
+    :type path: str
+    :param segments: Entries of the segments in the manifest.
+    :type segments: list[dict]
+    :param cache: Segments already read, by name (see read_segment).
+    :type cache: dict
+    :return: Same format as read_segment.
+    :rtype: dict
+    """
+    merged = {"indexes": {}}
+    for name in POSITION_FIELDS + FEATURE_FIELDS:
+        merged["indexes"][name] = {}
+
+    docs = []
+    reviews = {}
+    for segment in segments:
+        data = read_segment(path, segment, cache)
+        docs += zip(data["seqs"], data["products"])
+        reviews.update(data["reviews"])
+        for name, index in data["indexes"].items():
+            merged_index = merged["indexes"][name]
+            for token, postings in index.items():
+                if isinstance(postings, dict):
+                    merged_index.setdefault(token, {}).update(postings)
+                else:
+                    merged_index.setdefault(token, []).extend(postings)
+
+    # A re-crawled product keeps its place in the catalog, whatever the segment of its last version
+    docs.sort(key=lambda doc: doc[0])
+    merged["seqs"] = [seq for seq, _ in docs]
+    merged["products"] = [product for _, product in docs]
+    merged["reviews"] = {
+        product["url"]: reviews[product["url"]]
+        for product in merged["products"]
+        if product["url"] in reviews
+    }
+    return merged
+
+
+def load_live_segments(path: str, cache: dict = None) -> tuple[dict, dict]:
+    """
+    Reads the manifest and merges all the live segments of a segmented index folder.
+
+    :param path: Folder of the segmented index.
+    :type path: str
+    :param cache: Segments already read, by name (see read_segment). The segments that are no longer live are removed from it.
+    :type cache: dict
+    :return: Manifest that was read, and merged live documents (see read_segment).
+    :rtype: tuple[dict, dict]
+    """
+    for attempt in range(LOAD_RETRIES):
+        manifest = read_manifest(path)
+        try:
+            merged = merge_segments(path, manifest["segments"], cache)
+            if cache is not None:
+                names = {segment["name"] for segment in manifest["segments"]}
+                for name in list(cache):
+                    if name not in names:
+                        del cache[name]
+            return manifest, merged
+        except FileNotFoundError:
+            # A merge removed a segment after the manifest was read
+            if attempt == LOAD_RETRIES - 1:
+                raise
+
+
+def segment_tier(segment: dict, merge_factor: int = MERGE_FACTOR) -> int:
+    """
+    Gives the size tier of a segment: segments with less than 'merge_factor' live documents are in tier 0,
+    less than 'merge_factor'^2 in tier 1, and so on.
+
+    :param segment: Entry of the segment in the manifest.
+    :type segment: dict
+    :param merge_factor: Number of segments of the same tier merged together.
+    :type merge_factor: int
+    :return: Tier of the segment.
+    :rtype: int
+    """
+    live = segment["docs"] - len(segment["deleted"])
+    tier = 0
+    while live >= merge_factor:
+        live //= merge_factor
+        tier += 1
+    return tier
+
+
+class SegmentedIndex:
+    """
+    Incremental index made of immutable segments.
+
+    New or changed products are indexed into a new small segment, and their previous version is
+    marked with a tombstone in its segment. Consecutive segments of the same size tier are merged
+    into one, which only keeps the live documents. The live documents, in the order of the
+    segments, sorted by sequence number, are exactly the catalog a full rebuild would index.
+
+    A folder should only be updated by one SegmentedIndex at a time, which can be shared by threads.
+    """
+
+    def __init__(self, path: str, merge_factor: int = MERGE_FACTOR):
+        """
+        :param path: Folder of the segmented index, created if needed.
+        :type path: str
+        :param merge_factor: Number of segments of the same tier merged together.
+        :type merge_factor: int
+        """
+        self.path = path
+        self.merge_factor = merge_factor
+        os.makedirs(path, exist_ok=True)
+        self.manifest = read_manifest(path)
+        self._lock = threading.Lock()
+        self._merging = set()  # Names of the segments being merged
+        # Segment holding the live version of each url, and its sequence number
+        self._owner = {}
+        self._seq = {}
+        for segment in self.manifest["segments"]:
+            deleted = set(segment["deleted"])
+            urls, seqs = self._segment_urls(segment["name"])
+            for url, seq in zip(urls, seqs):
+                if url not in deleted:
+                    self._owner[url] = segment["name"]
+                    self._seq[url] = seq
+
+    def _segment_urls(self, name: str) -> tuple[list[str], list[int]]:
+        segment_path = os.path.join(self.path, name)
+        with open(os.path.join(segment_path, "urls.json"), "r", encoding="utf-8") as f:
+            urls = json.load(f)
+        with open(os.path.join(segment_path, "seqs.json"), "r", encoding="utf-8") as f:
+            return urls, json.load(f)
+
+    def _segment(self, name: str) -> dict:
+        for segment in self.manifest["segments"]:
+            if segment["name"] == name:
+                return segment
+
+    def _new_name(self) -> str:
+        # Called with the lock held
+        name = f"seg_{self.manifest['next_id']:06d}"
+        self.manifest["next_id"] += 1
+        return name
+
+    def _delete(self, url: str):
+        # Called with the lock held: the live version of 'url' becomes a tombstone
+        self._seq.pop(url, None)
+        name = self._owner.pop(url, None)
+        if name is not None:
+            self._segment(name)["deleted"].append(url)
+
+    def _commit(self):
+        # Called with the lock held: segments without live documents are dropped
+        dropped = [
+            s["name"]
+            for s in self.manifest["segments"]
+            if len(s["deleted"]) >= s["docs"] and s["name"] not in self._merging
+        ]
+        self.manifest["segments"] = [
+            s for s in self.manifest["segments"] if s["name"] not in dropped
+        ]
+        write_manifest(self.path, self.manifest)
+        for name in dropped:
+            shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+    @property
+    def size(self) -> int:
+        """
+        Number of live documents.
+        """
+        return len(self._owner)
+
+    def add_products(self, df: pd.DataFrame) -> str:
+        """
+        Indexes new or changed products into a new segment, replacing their previous version.
+
+        :param df: Dataframe of products, with the same columns as products.jsonl.
+        :type df: pd.DataFrame
+        :return: Name of the new segment, None if 'df' is empty.
+        :rtype: str
+        """
+        # spaCy is only needed to build a segment, not to read one
+        from TP2.processing import (
+            build_feature_index,
+            build_inverted_index,
+            build_review_index,
+        )
+
+        if len(df) == 0:
+            return None
+        # The last version of a product given twice wins
+        df = df.drop_duplicates(subset="url", keep="last").reset_index(drop=True)
+        products = json.loads(df.to_json(orient="records", force_ascii=False))
+
+        indexes = {}
+        for name in POSITION_FIELDS:
+            indexes[name] = build_inverted_index(df, name, with_position=True)
+        for name in FEATURE_FIELDS:
+            indexes[name] = build_feature_index(df, name)
+        reviews_index = build_review_index(df)
+
+        with self._lock:
+            name = self._new_name()
+            # A re-crawled url keeps its sequence number, a new one is added at the end of the catalog
+            seqs = []
+            for url in df["url"]:
+                seq = self._seq.get(url)
+                if seq is None:
+                    seq = self.manifest["next_seq"]
+                    self.manifest["next_seq"] = seq + 1
+                seqs.append(seq)
+        write_segment(
+            os.path.join(self.path, name), products, seqs, indexes, reviews_index
+        )
+
+        with self._lock:
+            for url, seq in zip(df["url"], seqs):
+                self._delete(url)
+                self._owner[url] = name
+                self._seq[url] = seq
+            self.manifest["segments"].append(
+                {"name": name, "docs": len(products), "deleted": []}
+            )
+            self._commit()
+        return name
+
+    def delete_urls(self, urls: list[str]) -> int:
+        """
+        Removes products from the index.
+
+        :param urls: Urls of the products to remove.
+        :type urls: list[str]
+        :return: Number of products removed.
+        :rtype: int
+        """
+        with self._lock:
+            removed = 0
+            for url in urls:
+                if url in self._owner:
+                    self._delete(url)
+                    removed += 1
+            if removed:
+                self._commit()
+        return removed
+
+    def find_merge(self) -> list[dict]:
+        """
+        Finds segments to merge with the size-tiered policy: the first run of 'merge_factor'
+        consecutive segments of the same tier.
+
+        :return: Entries of the segments to merge, empty if there is nothing to merge.
+        :rtype: list[dict]
+        """
+        run = []
+        for segment in self.manifest["segments"]:
+            if segment["name"] in self._merging:
+                run = []
+                continue
+            tier = segment_tier(segment, self.merge_factor)
+            if run and segment_tier(run[-1], self.merge_factor) != tier:
+                run = []
+            run.append(segment)
+            if len(run) == self.merge_factor:
+                return run
+        return []
+
+    def merge_once(self) -> str:
+        """
+        Merges one run of segments chosen by find_merge. Products can be added or deleted
+        while the merge is running.
+
+        :return: Name of the merged segment, None if there was nothing to merge.
+        :rtype: str
+        """
+        with self._lock:
+            sources = self.find_merge()
+            if not sources:
+                return None
+            names = [s["name"] for s in sources]
+            self._merging.update(names)
+            # Tombstones known when the merge starts, the merged segment only keeps the other documents
+            snapshot = [dict(s, deleted=list(s["deleted"])) for s in sources]
+            name = self._new_name()
+
+        try:
+            merged = merge_segments(self.path, snapshot)
+            write_segment(
+                os.path.join(self.path, name),
+                merged["products"],
+                merged["seqs"],
+                merged["indexes"],
+                merged["reviews"],
+            )
+        except Exception:
+            with self._lock:
+                self._merging.difference_update(names)
+            raise
+
+        with self._lock:
+            # Products replaced or deleted during the merge are tombstones of the merged segment
+            deleted = []
+            for old, current in zip(snapshot, sources):
+                deleted += current["deleted"][len(old["deleted"]) :]
+            entry = {"name": name, "docs": len(merged["products"]), "deleted": deleted}
+            for product in merged["products"]:
+                if self._owner.get(product["url"]) in names:
+                    self._owner[product["url"]] = name
+
+            segments = self.manifest["segments"]
+            start = segments.index(sources[0])
+            segments[start : start + len(sources)] = [entry]
+            self._merging.difference_update(names)
+            self._commit()
+        for old_name in names:
+            shutil.rmtree(os.path.join(self.path, old_name), ignore_errors=True)
+        return name
+
+    def merge(self) -> list[str]:
+        """
+        Merges segments until the size-tiered policy finds nothing to merge.
+
+        :return: Names of the merged segments.
+        :rtype: list[str]
+        """
+        merged = []
+        while True:
+            name = self.merge_once()
+            if name is None:
+                return merged
+            merged.append(name)
+
+
+def merge_in_background(index: SegmentedIndex, interval: float) -> threading.Thread:
+    """
+    Starts a background thread merging the segments of an index.
+
+    :param index: Segmented index to merge.
+    :type index: SegmentedIndex
+    :param interval: Time between two merge passes, in seconds.
+    :type interval: float
+    :return: The started thread.
+    :rtype: threading.Thread
+    """
+
+    def merge():
+        while True:
+            for name in index.merge():
+                print(f"Merged segment: {name}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=merge, daemon=True)
+    thread.start()
+    return thread
+
+
+def watch_folder(index: SegmentedIndex, folder: str, interval: float):
+    """
+    Indexes every new JSONL file of 'folder' into a segment, while merging in the background.
+    A file is renamed with a '.done' suffix once indexed.
+
+    :param index: Segmented index to update.
+    :type index: SegmentedIndex
+    :param folder: Folder where the crawler drops JSONL files of new or changed products.
+    :type folder: str
+    :param interval: Time between two checks of the folder, in seconds.
+    :type interval: float
+    """
+    merge_in_background(index, interval)
+    while True:
+        for path_in in sorted(glob.glob(os.path.join(folder, "*.jsonl"))):
+            df = pd.read_json(path_in, lines=True)
+            name = index.add_products(df)
+            os.replace(path_in, path_in + ".done")
+            print(f"Indexed {len(df)} products of {path_in} into {name}")
+        time.sleep(interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index-path", default="TP2/segments")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add = commands.add_parser("add", help="Index new or changed products")
+    add.add_argument("input_path")
+    delete = commands.add_parser("delete", help="Remove products")
+    delete.add_argument("urls", nargs="+")
+    commands.add_parser("merge", help="Merge segments with the size-tiered policy")
+    watch = commands.add_parser(
+        "watch", help="Index the JSONL files dropped in a folder"
+    )
+    watch.add_argument("folder")
+    watch.add_argument("--interval", type=float, default=60)
+    args = parser.parse_args()
+
+    index = SegmentedIndex(args.index_path)
+    if args.command == "add":
+        name = index.add_products(pd.read_json(args.input_path, lines=True))
+        print(f"Indexed into {name}, {index.size} live products")
+        index.merge()
+    elif args.command == "delete":
+        print(f"Removed {index.delete_urls(args.urls)} products")
+    elif args.command == "merge":
+        print(f"Merged segments: {index.merge()}")
+    elif args.command == "watch":
+        watch_folder(index, args.folder, args.interval)
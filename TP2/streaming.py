@@ -0,0 +1,461 @@
+import heapq
+import json
+import mmap
+import os
+import tempfile
+from array import array
+import numpy as np
+from tqdm import tqdm
+from TP2.processing import *
+from TP2.binary_index import encode_postings, string_table, write_binary_index
+from TP2.tracing import count, span
+
+POSITION_FIELDS = ["title", "description"]
+FEATURE_FIELDS = ["brand", "origin", "flavors", "colors"]
+CHUNK_SIZE = 1000  # Number of products tokenized at once
+# Approximate size in memory of a buffered posting and of a position, used for the memory limit
+POSTING_BYTES = 120
+POSITION_BYTES = 36
+MAX_OPEN_RUNS = 256  # Runs merged at once, more runs are first merged by groups
+
+
+def iter_products(path_in: str):
+    """
+    Reads a JSONL file of products line by line.
+
+    :param path_in: Path of the JSONL file.
+    :type path_in: str
+    :return: Generator of the products, as dicts.
+    """
+    with open(path_in, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_chunks(items, size: int):
+    """
+    Groups the items of an iterable into lists of 'size' items (the last one can be shorter).
+
+    :param items: Iterable to group.
+    :param size: Number of items of a chunk.
+    :type size: int
+    :return: Generator of lists of items.
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class RunBuffer:
+    """
+    Entries of one index (key -> list of items) gathered in memory and spilled to sorted run files.
+
+    Items are added in document order, so the runs are in document order too, and merging them
+    run after run for a key gives its items in document order.
+    """
+
+    def __init__(self, tmp_dir: str, name: str):
+        """
+        :param tmp_dir: Folder of the run files.
+        :type tmp_dir: str
+        :param name: Name of the index, used in the names of the run files.
+        :type name: str
+        """
+        self.tmp_dir = tmp_dir
+        self.name = name
+        self.entries = {}
+        self.runs = []
+        self.n_runs = 0  # Number of runs written
+
+    def add(self, key: str, item):
+        """
+        Adds an item to the entry of a key.
+        """
+        if key not in self.entries:
+            self.entries[key] = []
+        self.entries[key].append(item)
+
+    def spill(self):
+        """
+        Writes the entries in memory, sorted by key, to a new run file and empties the buffer.
+        """
+        if not self.entries:
+            return
+        path = os.path.join(self.tmp_dir, f"{self.name}_{self.n_runs:06d}.run")
+        with open(path, "w", encoding="utf-8") as f:
+            for key in sorted(self.entries):
+                f.write(json.dumps([key, self.entries[key]], ensure_ascii=False) + "\n")
+        self.runs.append(path)
+        self.n_runs += 1
+        self.entries = {}
+
+    def _merge_runs(self, paths: list[str]):
+        # k-way merge of run files, the items of a key are concatenated in run order
+        files = [open(path, "r", encoding="utf-8") for path in paths]
+
+        def read_run(f, i: int):
+            for line in f:
+                key, items = json.loads(line)
+                yield key, i, items
+
+        try:
+            current, current_items = None, []
+            for key, _, items in heapq.merge(
+                *[read_run(f, i) for i, f in enumerate(files)]
+            ):
+                if key != current:
+                    if current is not None:
+                        yield current, current_items
+                    current, current_items = key, []
+                current_items += items
+            if current is not None:
+                yield current, current_items
+        finally:
+            for f in files:
+                f.close()
+
+    def merged(self):
+        """
+        k-way merges the run files (after spilling what is left in memory).
+
+        :return: Generator of (key, items) pairs sorted by key, the items being in document order.
+        """
+        self.spill()
+        # Consecutive runs are merged by groups so that not too many files are open at once
+        n_merged = 0
+        while len(self.runs) > MAX_OPEN_RUNS:
+            merged_runs = []
+            for start in range(0, len(self.runs), MAX_OPEN_RUNS):
+                group = self.runs[start : start + MAX_OPEN_RUNS]
+                path = os.path.join(self.tmp_dir, f"{self.name}_{n_merged:06d}.merged")
+                n_merged += 1
+                with open(path, "w", encoding="utf-8") as f:
+                    for key, items in self._merge_runs(group):
+                        f.write(json.dumps([key, items], ensure_ascii=False) + "\n")
+                for old_path in group:
+                    os.remove(old_path)
+                merged_runs.append(path)
+            self.runs = merged_runs
+        return self._merge_runs(self.runs)
+
+
+class DocTable:
+    """
+    Doc id to url table kept on disk, and number of tokens of each document in each field.
+    """
+
+    def __init__(self, tmp_dir: str):
+        """
+        :param tmp_dir: Folder of the table file.
+        :type tmp_dir: str
+        """
+        self.path = os.path.join(tmp_dir, "urls.bin")
+        self._file = open(self.path, "wb")
+        self._mm = None
+        self.offsets = array("Q", [0])
+        self.lengths = {field: array("I") for field in POSITION_FIELDS}
+
+    def add(self, url: str) -> int:
+        """
+        Adds a document and gives its doc id.
+        """
+        data = url.encode("utf-8")
+        self._file.write(data)
+        self.offsets.append(self.offsets[-1] + len(data))
+        return len(self.offsets) - 2
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def close_writing(self):
+        """
+        Ends the additions, and opens the table for lookups.
+        """
+        self._file.close()
+        if self.offsets[-1] > 0:
+            with open(self.path, "rb") as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def url(self, doc_id: int) -> str:
+        """
+        Gives the url of a doc id.
+        """
+        return self._mm[self.offsets[doc_id] : self.offsets[doc_id + 1]].decode("utf-8")
+
+    def close(self):
+        """
+        Releases the table.
+        """
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+
+def write_index(
+    buffer: RunBuffer,
+    docs: DocTable,
+    path_out: str,
+    with_position: bool,
+    index_format: str = "both",
+    tmp_dir: str = None,
+) -> dict:
+    """
+    Merges the runs of an inverted index and writes it in the same format as the in-memory build.
+
+    :param buffer: Runs of the index.
+    :type buffer: RunBuffer
+    :param docs: Doc table of the build.
+    :type docs: DocTable
+    :param path_out: Output folder.
+    :type path_out: str
+    :param with_position: True for the title and description indexes, False for the feature indexes.
+    :type with_position: bool
+    :param index_format: 'json', 'binary' or 'both'.
+    :type index_format: str
+    :param tmp_dir: Folder for the temporary postings of the binary file.
+    :type tmp_dir: str
+    :return: Document frequency of every token, in the order of the in-memory index (sorted for title and description, order of first appearance for features).
+    :rtype: dict
+    """
+    json_path = f"{path_out}/{buffer.name}_index.jsonl"
+    binary_path = f"{path_out}/{buffer.name}_index.bin"
+    postings_path = os.path.join(tmp_dir, f"{buffer.name}.postings")
+    write_json = index_format in ["json", "both"]
+    write_binary = index_format in ["binary", "both"]
+
+    terms = []
+    postings_offsets = [0]
+    doc_freqs = []
+    first_docs = []
+    f_json = open(json_path, "w", encoding="utf-8") if write_json else None
+    f_postings = open(postings_path, "wb") if write_binary else None
+    try:
+        for term, items in buffer.merged():
+            terms.append(term)
+            doc_freqs.append(len(items))
+            first_docs.append(items[0][0] if with_position else items[0])
+            if write_json:
+                if with_position:
+                    postings = [{docs.url(doc_id): pos} for doc_id, pos in items]
+                else:
+                    postings = [docs.url(doc_id) for doc_id in items]
+                line = json.dumps({str(term): postings}, ensure_ascii=False)
+                f_json.write(line + "\n")
+            if write_binary:
+                blob = bytearray()
+                if with_position:
+                    encode_postings(items, True, blob)
+                else:
+                    encode_postings([(doc_id, None) for doc_id in items], False, blob)
+                f_postings.write(blob)
+                postings_offsets.append(postings_offsets[-1] + len(blob))
+    finally:
+        if f_json is not None:
+            f_json.close()
+        if f_postings is not None:
+            f_postings.close()
+
+    if write_json:
+        print(f"The file has been saved to: {json_path}!")
+    if write_binary:
+        term_offsets, term_blob = string_table(terms)
+        sections = [
+            np.array(docs.offsets, dtype="<u8").tobytes(),
+            docs.path,
+            term_offsets,
+            term_blob,
+            np.array(postings_offsets, dtype="<u8").tobytes(),
+            np.array(doc_freqs, dtype="<u4").tobytes(),
+            postings_path,
+        ]
+        has_positions = with_position and len(terms) > 0
+        write_binary_index(binary_path, has_positions, len(docs), len(terms), sections)
+        os.remove(postings_path)
+        print(f"The file has been saved to: {binary_path}!")
+
+    if with_position:
+        return dict(zip(terms, doc_freqs))
+    # The in-memory feature index keeps the order of first appearance
+    order = sorted(range(len(terms)), key=lambda i: first_docs[i])
+    return {terms[i]: doc_freqs[i] for i in order}
+
+
+def write_reviews(buffer: RunBuffer, path_out: str):
+    """
+    Merges the runs of the reviews index and writes it, sorted by url.
+
+    :param buffer: Runs of the reviews index.
+    :type buffer: RunBuffer
+    :param path_out: Path of the JSONL file.
+    :type path_out: str
+    """
+    with open(path_out, "w", encoding="utf-8") as f:
+        for url, items in buffer.merged():
+            f.write(json.dumps({str(url): items[-1]}, ensure_ascii=False) + "\n")
+
+    print(f"The file has been saved to: {path_out}!")
+
+
+def write_stats(docs: DocTable, doc_freqs: dict, path_out: str):
+    """
+    Writes the collection statistics, in the same format as build_stats and save_index_to_json,
+    without holding the document lengths as a dict.
+
+    :param docs: Doc table of the build.
+    :type docs: DocTable
+    :param doc_freqs: Dict with the field names as keys and the document frequencies of their tokens as values.
+    :type doc_freqs: dict
+    :param path_out: Path of the JSONL file.
+    :type path_out: str
+    """
+
+    def dumps(value) -> str:
+        return json.dumps(value, ensure_ascii=False)
+
+    with open(path_out, "w", encoding="utf-8") as f:
+        f.write(dumps({"N": len(docs)}) + "\n")
+        for field in sorted(doc_freqs):
+            if field in docs.lengths:
+                lengths = docs.lengths[field]
+            else:
+                # A feature is a single value, so it counts as one token
+                lengths = [1] * len(docs)
+            avg_length = float(np.mean(lengths)) if len(lengths) else 0.0
+
+            f.write("{" + dumps(field) + ": {")
+            f.write('"avg_length": ' + dumps(avg_length) + ', "doc_length": {')
+            for doc_id in range(len(docs)):
+                if doc_id > 0:
+                    f.write(", ")
+                f.write(dumps(docs.url(doc_id)) + ": " + dumps(lengths[doc_id]))
+            f.write('}, "doc_freq": {')
+            f.write(
+                ", ".join(
+                    dumps(str(token)) + ": " + dumps(freq)
+                    for token, freq in doc_freqs[field].items()
+                )
+            )
+            f.write("}}}\n")
+
+    print(f"The file has been saved to: {path_out}!")
+
+
+def build_streaming(
+    path_in: str,
+    path_out: str,
+    memory_limit: int,
+    index_format: str = "both",
+    batch_size: int = BATCH_SIZE,
+    n_process: int = 1,
+    chunk_size: int = CHUNK_SIZE,
+    tmp_dir: str = None,
+    cache: TokenCache = None,
+) -> dict:
+    """
+    Builds every index by reading the catalog line by line (SPIMI): postings are gathered in memory
+    until 'memory_limit' is reached, then spilled to sorted runs, which are k-way merged at the end.
+    The files are the same as the ones of the in-memory build, for a catalog without duplicated urls.
+
+    :param path_in: Path of the JSONL catalog.
+    :type path_in: str
+    :param path_out: Output folder.
+    :type path_out: str
+    :param memory_limit: Approximate memory used by the buffered postings before spilling them, in bytes.
+    :type memory_limit: int
+    :param index_format: 'json', 'binary' or 'both'.
+    :type index_format: str
+    :param batch_size: Number of documents given to spaCy at once.
+    :type batch_size: int
+    :param n_process: Number of processes tokenizing the documents (-1 for one per CPU).
+    :type n_process: int
+    :param chunk_size: Number of products read and tokenized at once.
+    :type chunk_size: int
+    :param tmp_dir: Parent folder of the temporary run files (default is the system one).
+    :type tmp_dir: str
+    :param cache: Cache of the tokens, None to tokenize every text.
+    :type cache: TokenCache
+    :return: Dict with the number of documents and the number of runs of each index.
+    :rtype: dict
+    """
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        docs = DocTable(tmp)
+        buffers = {
+            name: RunBuffer(tmp, name)
+            for name in POSITION_FIELDS + FEATURE_FIELDS + ["reviews"]
+        }
+        used = 0
+
+        for chunk in tqdm(iter_chunks(iter_products(path_in), chunk_size)):
+            with span("tokenize", texts=len(chunk) * len(POSITION_FIELDS)):
+                tokens = {
+                    field: get_clean_tokens_batch(
+                        [product[field] for product in chunk],
+                        batch_size=batch_size,
+                        n_process=n_process,
+                        progress=False,
+                        cache=cache,
+                    )
+                    for field in POSITION_FIELDS
+                }
+            for i, product in enumerate(chunk):
+                doc_id = docs.add(product["url"])
+
+                for field in POSITION_FIELDS:
+                    doc_tokens = tokens[field][i]
+                    docs.lengths[field].append(len(doc_tokens))
+                    doc_positions = {}
+                    for position, token in enumerate(doc_tokens):
+                        if token not in doc_positions:
+                            doc_positions[token] = []
+                        doc_positions[token].append(position)
+                    for token, positions in doc_positions.items():
+                        buffers[field].add(token, [doc_id, positions])
+                        used += POSTING_BYTES + POSITION_BYTES * len(positions)
+
+                for name in FEATURE_FIELDS:
+                    column_name = get_feature_key(name)
+                    if column_name in product["product_features"]:
+                        feature = product["product_features"][column_name].lower()
+                        buffers[name].add(feature, doc_id)
+                        used += POSTING_BYTES
+
+                buffers["reviews"].add(
+                    product["url"], get_review_stats(product["product_reviews"])
+                )
+                used += POSTING_BYTES
+
+                if used >= memory_limit:
+                    with span("spill"):
+                        count("spills")
+                        for buffer in buffers.values():
+                            buffer.spill()
+                    used = 0
+
+        docs.close_writing()
+        doc_freqs = {}
+        for name in POSITION_FIELDS + FEATURE_FIELDS:
+            with span("write index", name=name):
+                doc_freqs[name] = write_index(
+                    buffers[name],
+                    docs,
+                    path_out,
+                    with_position=name in POSITION_FIELDS,
+                    index_format=index_format,
+                    tmp_dir=tmp,
+                )
+        with span("write index", name="reviews"):
+            write_reviews(buffers["reviews"], f"{path_out}/reviews_index.jsonl")
+        with span("stats"):
+            write_stats(docs, doc_freqs, f"{path_out}/stats.jsonl")
+        docs.close()
+
+    return {
+        "documents": len(docs),
+        "runs": {name: buffer.n_runs for name, buffer in buffers.items()},
+    }
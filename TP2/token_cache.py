@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import sqlite3
+import string
+import spacy
+
+TOKEN_CACHE_PATH = "TP2/cache/tokens.sqlite"
+TOKEN_CACHE_SIZE = 256  # Maximum size of the cached tokens, in MB
+# Everything that changes the output of get_clean_tokens, besides the text and the model
+CLEANING_CONFIG = {
+    "lowercase": True,
+    "punctuation": string.punctuation,
+    "filters": ["is_stop", "is_punct", "is_space"],
+}
+SQL_BATCH = 500  # Keys looked up per query (sqlite limits the number of parameters)
+
+
+class TokenCache:
+    """
+    Persistent cache of the tokens of the texts, stored in a sqlite file.
+
+    An entry is keyed by the SHA-1 of the text, the name and version of the spaCy model and the
+    cleaning configuration, so a new model or a new cleaning never reuses outdated tokens.
+    When the cached tokens go over 'max_size', the least recently used entries are evicted.
+    """
+
+    def __init__(
+        self,
+        path: str = TOKEN_CACHE_PATH,
+        model_name: str = "en_core_web_md",
+        max_size: float = TOKEN_CACHE_SIZE,
+    ):
+        """
+        :param path: Path of the sqlite file, created if needed.
+        :type path: str
+        :param model_name: Name of the spaCy model producing the tokens.
+        :type model_name: str
+        :param max_size: Maximum size of the cached tokens, in MB.
+        :type max_size: float
+        """
+        self.path = path
+        self.max_size = int(max_size * 2**20)
+        self.hits = 0
+        self.misses = 0
+        # The installed versions are read without loading the model
+        version = {
+            "model": model_name,
+            "model_version": spacy.util.get_package_version(model_name),
+            "spacy_version": spacy.__version__,
+            "cleaning": CLEANING_CONFIG,
+        }
+        self._prefix = json.dumps(version, sort_keys=True).encode("utf-8") + b"\0"
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tokens "
+            "(key BLOB PRIMARY KEY, tokens TEXT, size INTEGER, used INTEGER)"
+        )
+        self._clock = self._db.execute("SELECT MAX(used) FROM tokens").fetchone()[0]
+        self._clock = self._clock or 0
+
+    def key(self, text: str) -> bytes:
+        """
+        Gives the key of a text.
+        """
+        return hashlib.sha1(self._prefix + text.encode("utf-8")).digest()
+
+    def get_many(self, texts: list[str]) -> list[list[str]]:
+        """
+        Looks up the tokens of texts.
+
+        :param texts: Raw texts, before cleaning.
+        :type texts: list[str]
+        :return: Tokens of each text, None for a text which is not cached.
+        :rtype: list[list[str]]
+        """
+        keys = [self.key(text) for text in texts]
+        found = {}
+        for start in range(0, len(keys), SQL_BATCH):
+            batch = list(set(keys[start : start + SQL_BATCH]))
+            rows = self._db.execute(
+                f"SELECT key, tokens FROM tokens WHERE key IN ({','.join('?' * len(batch))})",
+                batch,
+            )
+            for key, tokens in rows:
+                found[key] = json.loads(tokens)
+
+        # The entries found are the most recently used ones
+        self._clock += 1
+        with self._db:
+            self._db.executemany(
+                "UPDATE tokens SET used = ? WHERE key = ?",
+                [(self._clock, key) for key in found],
+            )
+
+        results = [found.get(key) for key in keys]
+        n_hits = sum(tokens is not None for tokens in results)
+        self.hits += n_hits
+        self.misses += len(results) - n_hits
+        return results
+
+    def put_many(self, texts: list[str], all_tokens: list[list[str]]):
+        """
+        Saves the tokens of texts, then evicts the least recently used entries if the cache is too big.
+
+        :param texts: Raw texts, before cleaning.
+        :type texts: list[str]
+        :param all_tokens: Tokens of each text.
+        :type all_tokens: list[list[str]]
+        """
+        self._clock += 1
+        rows = []
+        for text, tokens in zip(texts, all_tokens):
+            value = json.dumps(tokens, ensure_ascii=False)
+            rows.append(
+                (self.key(text), value, len(value.encode("utf-8")), self._clock)
+            )
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?)", rows
+            )
+            self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cached tokens fit in 'max_size'.
+        """
+        total = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM tokens"
+        ).fetchone()[0]
+        if total <= self.max_size:
+            return
+        # Oldest entries first
+        removed = []
+        for key, size in self._db.execute(
+            "SELECT key, size FROM tokens ORDER BY used, rowid"
+        ).fetchall():
+            if total <= self.max_size:
+                break
+            removed.append((key,))
+            total -= size
+        self._db.executemany("DELETE FROM tokens WHERE key = ?", removed)
+
+    def __len__(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM tokens").fetchone()[0]
+
+    @property
+    def stats(self) -> dict:
+        """
+        Number of hits and misses, and hit rate of the cache.
+        """
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def close(self):
+        """
+        Closes the sqlite file.
+        """
+        self._db.close()
@@ -0,0 +1,329 @@
+import argparse
+import itertools
+import json
+import os
+import threading
+import time
+
+# A trace is a list of events, one per closed span:
+#   {"id", "parent", "name", "start_us", "duration_us", "pid", "tid", "args", "counts"}
+# 'parent' is the id of the enclosing span of the same process (None for a root span, e.g. a query),
+# or of the process 'parent_pid' for the root spans of a worker (see Tracer.merge),
+# and 'counts' holds the counters (e.g. 'index_loads') incremented inside the span and its children.
+
+
+class Span:
+    """
+    Stage of a traced run, timed between the start and the end of its 'with' block.
+    """
+
+    __slots__ = ("tracer", "name", "args", "counts", "id", "parent", "start")
+
+    def __init__(self, tracer: "Tracer", name: str, args: dict):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.counts = {}
+
+    def __enter__(self) -> "Span":
+        self.tracer._open(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer._close(self)
+        return False
+
+
+class NoSpan:
+    """
+    Span doing nothing, used when tracing is disabled.
+    """
+
+    def __enter__(self) -> "NoSpan":
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NO_SPAN = NoSpan()
+
+
+class Tracer:
+    """
+    Recorder of the spans and counters of a run, disabled by default.
+
+    Each thread has its own stack of open spans, so the spans of concurrent queries are not mixed.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self._local = threading.local()
+        self._ids = itertools.count()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        """
+        Drops the recorded events.
+        """
+        self.events = []
+
+    def reset(self):
+        """
+        Drops the recorded events and the open spans, e.g. the ones inherited by a forked worker.
+        """
+        self.events = []
+        self._local = threading.local()
+
+    def _stack(self) -> list:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _open(self, span: Span):
+        stack = self._stack()
+        span.id = next(self._ids)
+        span.parent = stack[-1].id if stack else None
+        stack.append(span)
+        span.start = time.perf_counter_ns()
+
+    def _close(self, span: Span):
+        end = time.perf_counter_ns()
+        stack = self._stack()
+        stack.pop()
+        if stack:
+            # The counters of a stage are also the ones of the stages around it
+            parent_counts = stack[-1].counts
+            for name, n in span.counts.items():
+                parent_counts[name] = parent_counts.get(name, 0) + n
+        self.events.append(
+            {
+                "id": span.id,
+                "parent": span.parent,
+                "name": span.name,
+                "start_us": span.start // 1000,
+                "duration_us": (end - span.start) / 1000,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": span.args,
+                "counts": span.counts,
+            }
+        )
+
+    def count(self, name: str, n: int = 1):
+        """
+        Increments a counter of the innermost open span (nothing happens outside of a span).
+        """
+        stack = self._stack()
+        if stack:
+            counts = stack[-1].counts
+            counts[name] = counts.get(name, 0) + n
+
+    def merge(self, events: list[dict]):
+        """
+        Adds the events recorded by a worker process: its root spans become children of the current span,
+        which also gets their counters.
+
+        :param events: Events of the worker (see take).
+        :type events: list[dict]
+        """
+        stack = self._stack()
+        for event in events:
+            if event["parent"] is None and stack:
+                event["parent"] = stack[-1].id
+                event["parent_pid"] = os.getpid()
+                for name, n in event["counts"].items():
+                    self.count(name, n)
+            self.events.append(event)
+
+    def take(self, pid: int) -> list[dict]:
+        """
+        Removes and gives the events recorded by a process, to send them from a worker to the main process.
+
+        :param pid: Id of the process.
+        :type pid: int
+        :return: Events of the process.
+        :rtype: list[dict]
+        """
+        taken = [event for event in self.events if event["pid"] == pid]
+        self.events = [event for event in self.events if event["pid"] != pid]
+        return taken
+
+
+# Tracer shared by TP2 and TP3
+TRACER = Tracer()
+
+
+def span(name: str, /, **args):
+    """
+    Gives a span timing the stage 'name' in a 'with' block, with optional arguments saved in the trace.
+    When tracing is disabled, the same span doing nothing is given.
+
+    :param name: Name of the stage.
+    :type name: str
+    :return: The span, to use as a context manager.
+    :rtype: Span
+    """
+    if not TRACER.enabled:
+        return NO_SPAN
+    return Span(TRACER, name, args)
+
+
+def count(name: str, n: int = 1):
+    """
+    Increments the counter 'name' of the current span when tracing is enabled.
+
+    :param name: Name of the counter.
+    :type name: str
+    :param n: Increment.
+    :type n: int
+    """
+    if TRACER.enabled:
+        TRACER.count(name, n)
+
+
+def chrome_path(path: str) -> str:
+    """
+    Gives the path of the Chrome trace saved next to a JSON lines trace.
+    """
+    return os.path.splitext(path)[0] + ".chrome.json"
+
+
+def save_trace(path: str, events: list[dict] = None):
+    """
+    Saves a trace as JSON lines (one event per line) and in the Chrome trace format (see chrome_path),
+    which can be opened with chrome://tracing or https://ui.perfetto.dev.
+
+    :param path: Path of the JSON lines trace.
+    :type path: str
+    :param events: Events to save, default is the ones of the shared tracer.
+    :type events: list[dict]
+    """
+    if events is None:
+        events = TRACER.events
+    with open(path, "w", encoding="utf-8") as f:
+        for event in events:
+            f.write(json.dumps(event, ensure_ascii=False, default=str) + "\n")
+
+    chrome_events = [
+        {
+            "name": event["name"],
+            "cat": "stage",
+            "ph": "X",  # Complete event, with its duration
+            "ts": event["start_us"],
+            "dur": event["duration_us"],
+            "pid": event["pid"],
+            "tid": event["tid"],
+            "args": {**event["args"], **event["counts"]},
+        }
+        for event in events
+    ]
+    with open(chrome_path(path), "w", encoding="utf-8") as f:
+        json.dump(
+            {"traceEvents": chrome_events, "displayTimeUnit": "ms"},
+            f,
+            ensure_ascii=False,
+            default=str,
+        )
+
+
+def load_trace(path: str) -> list[dict]:
+    """
+    Loads a JSON lines trace saved by save_trace.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(events: list[dict]) -> list[dict]:
+    """
+    Gives the breakdown of each root span (e.g. each query) by stage.
+
+    :param events: Events of a trace.
+    :type events: list[dict]
+    :return: For each root span, in start order: its name, arguments, wall time in seconds and counters, and the number of calls and the total wall time in seconds of each stage inside it.
+    :rtype: list[dict]
+    """
+    by_id = {(event["pid"], event["id"]): event for event in events}
+    roots = {}
+
+    def get_parent(event: dict) -> tuple:
+        return (event.get("parent_pid", event["pid"]), event["parent"])
+
+    def get_root(event: dict) -> tuple:
+        key = (event["pid"], event["id"])
+        while event["parent"] is not None and get_parent(event) in by_id:
+            key = get_parent(event)
+            event = by_id[key]
+        return key
+
+    for event in sorted(events, key=lambda event: event["start_us"]):
+        key = get_root(event)
+        if key == (event["pid"], event["id"]):
+            roots[key] = {
+                "name": event["name"],
+                "args": event["args"],
+                "seconds": event["duration_us"] / 1e6,
+                "counts": event["counts"],
+                "stages": {},
+            }
+    for event in events:
+        key = get_root(event)
+        if key == (event["pid"], event["id"]) or key not in roots:
+            continue
+        stage = roots[key]["stages"].setdefault(
+            event["name"], {"calls": 0, "seconds": 0.0}
+        )
+        stage["calls"] += 1
+        stage["seconds"] += event["duration_us"] / 1e6
+    return list(roots.values())
+
+
+def print_summary(summaries: list[dict]):
+    """
+    Prints the mean wall time of the root spans of each name (e.g. 'query') and of their stages.
+    The time of a stage includes the one of the stages inside it.
+    """
+    groups = {}
+    for summary in summaries:
+        groups.setdefault(summary["name"], []).append(summary)
+    for name, group in groups.items():
+        n = len(group)
+        counts = {}
+        for summary in group:
+            for counter, value in summary["counts"].items():
+                counts[counter] = counts.get(counter, 0) + value
+        counters = "".join(
+            f", {counter} {value / n:g}" for counter, value in counts.items()
+        )
+        print(
+            f"{name} (x{n}): {sum(s['seconds'] for s in group) / n * 1000:.3f} ms{counters}"
+        )
+        stages = {}
+        for summary in group:
+            for stage, values in summary["stages"].items():
+                total = stages.setdefault(stage, {"calls": 0, "seconds": 0.0})
+                total["calls"] += values["calls"]
+                total["seconds"] += values["seconds"]
+        for stage, total in sorted(
+            stages.items(), key=lambda item: item[1]["seconds"], reverse=True
+        ):
+            print(
+                f"  - {stage}: {total['seconds'] / n * 1000:.3f} ms, "
+                f"{total['calls'] / n:g} call(s)"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", help="JSON lines trace saved with --trace")
+    args = parser.parse_args()
+
+    print_summary(summarize(load_trace(args.path)))
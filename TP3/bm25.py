@@ -0,0 +1,326 @@
+import math
+import numpy as np
+import pandas as pd
+from TP3.config import *
+from TP3.processing import *
+from TP2.tracing import span
+
+
+class FieldPostings:
+    """
+    Postings of one field index stored as CSR arrays.
+
+    The documents containing the term of row 'r' are 'doc_ids[indptr[r]:indptr[r + 1]]',
+    and 'tf' holds the number of occurrences of the term in each of them.
+    """
+
+    def __init__(self, index: dict, doc_ids: dict):
+        """
+        :param index: Field index, either {token: {url: [positions]}} or {token: [urls]}, or a BinaryIndex.
+        :type index: dict
+        :param doc_ids: Mapping from the document URLs to their id in the engine.
+        :type doc_ids: dict
+        """
+        if isinstance(index, BinaryIndex):
+            self._from_binary(index, doc_ids)
+            return
+
+        self.terms = {}
+        indptr = [0]
+        all_ids = []
+        all_tf = []
+        for token, postings in index.items():
+            if isinstance(postings, dict):
+                # Title and description: the frequency is the number of saved positions
+                pairs = [
+                    (doc_ids[url], len(pos))
+                    for url, pos in postings.items()
+                    if url in doc_ids
+                ]
+            else:
+                # Features: the token appears once in the document
+                pairs = [(doc_ids[url], 1) for url in postings if url in doc_ids]
+            if not pairs:
+                continue
+            pairs.sort()
+            self.terms[token] = len(self.terms)
+            all_ids += [p[0] for p in pairs]
+            all_tf += [p[1] for p in pairs]
+            indptr.append(len(all_ids))
+
+        self.indptr = np.array(indptr, dtype=np.int64)
+        self.doc_ids = np.array(all_ids, dtype=np.int64)
+        self.tf = np.array(all_tf, dtype=np.float64)
+
+    def _from_binary(self, index: BinaryIndex, doc_ids: dict):
+        # Same arrays, built from the postings of the file without decoding each term into a dict
+        indptr, ids, tf = index.arrays()
+        rows = np.repeat(np.arange(index.n_terms), np.diff(indptr))
+        engine_ids = np.array(
+            [doc_ids.get(url, -1) for url in index.urls()], dtype=np.int64
+        )
+        ids = engine_ids[ids]
+        kept = ids >= 0
+        rows, ids, tf = rows[kept], ids[kept], tf[kept]
+        order = np.lexsort((ids, rows))
+
+        n_postings = np.bincount(rows, minlength=index.n_terms)
+        kept_terms = np.flatnonzero(n_postings)
+        terms = index.terms()
+        self.terms = {terms[i]: row for row, i in enumerate(kept_terms.tolist())}
+        self.indptr = np.zeros(len(kept_terms) + 1, dtype=np.int64)
+        np.cumsum(n_postings[kept_terms], out=self.indptr[1:])
+        self.doc_ids = ids[order]
+        self.tf = tf[order].astype(np.float64)
+
+    def postings(self, token: str) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Give the documents containing a token and the token frequency in each of them.
+
+        :param token: Word to look up.
+        :type token: str
+        :return: Sorted array of document ids and array of term frequencies (both empty if the token is unknown).
+        :rtype: tuple[np.ndarray, np.ndarray]
+        """
+        row = self.terms.get(token)
+        if row is None:
+            return self.doc_ids[:0], self.tf[:0]
+        start, end = self.indptr[row], self.indptr[row + 1]
+        return self.doc_ids[start:end], self.tf[start:end]
+
+
+class BM25Engine:
+    """
+    Vectorized BM25 scorer over the indexes of an IndexStore.
+
+    Documents are numbered in the order of 'df', and a query is scored with a few array
+    operations per token instead of a loop over all the documents. Document lengths and
+    frequencies come from the collection statistics of the store, so no document is
+    tokenized by the engine.
+    """
+
+    def __init__(self, store: IndexStore, df: pd.DataFrame):
+        """
+        :param store: Store holding the loaded indexes.
+        :type store: IndexStore
+        :param df: DataFrame containing the raw product data.
+        :type df: pd.DataFrame
+        """
+        self.store = store
+        self.urls = df["url"].to_list()
+        self.doc_ids = {url: i for i, url in enumerate(self.urls)}
+        self.n_docs = len(self.urls)
+
+        stats = store.stats
+        self.fields = {}
+        self.lengths = {}
+        self.avg_length = {}
+        self.idf = {}
+        for field in store.fields:
+            index = store.index(field)
+            with span("field postings", field=field):
+                postings = FieldPostings(index, self.doc_ids)
+            field_stats = stats[field]
+            doc_length = field_stats["doc_length"]
+            self.fields[field] = postings
+            self.lengths[field] = np.array(
+                [doc_length.get(url, 0) for url in self.urls], dtype=np.float64
+            )
+            self.avg_length[field] = field_stats["avg_length"]
+            # The document frequency of a token is the one of the field being scored
+            doc_freq = np.array(
+                [field_stats["doc_freq"][token] for token in postings.terms],
+                dtype=np.float64,
+            )
+            self.idf[field] = np.log(stats["N"] / doc_freq)
+
+        # Per (field, b, k) caches of the posting contributions and their maximum per token
+        self._impacts = {}
+        self._upper_bounds = {}
+        # Per (avg_mark, count_mark, index version) cache of the review boosts
+        self._reviews_boost = {}
+
+    def get_idf(self, token: str, field: str) -> float:
+        """
+        Give the inversed document frequency of a token in a field.
+
+        :param token: Word to look up.
+        :type token: str
+        :param field: Field index of the token.
+        :type field: str
+        :return: IDF of the token, or None if no document contains it.
+        :rtype: float
+        """
+        row = self.fields[field].terms.get(token)
+        return None if row is None else self.idf[field][row]
+
+    def prepare(self, b: float = 0.75, k: float = 1.2) -> "BM25Engine":
+        """
+        Compute the contributions and upper bounds of every field in advance.
+
+        Useful before forking worker processes, so that they share these arrays instead
+        of each computing its own copy.
+
+        :param b: Length normalization parameter (default 0.75).
+        :type b: float
+        :param k: Term frequency saturation parameter (default 1.2).
+        :type k: float
+        :return: The engine itself, to allow chaining.
+        :rtype: BM25Engine
+        """
+        for field in self.fields:
+            self.impacts(field, b, k)
+            self.upper_bound("", field, b, k)
+        return self
+
+    def impacts(self, field: str, b: float = 0.75, k: float = 1.2) -> np.ndarray:
+        """
+        Give the BM25 contribution of every posting of a field, computed once per (b, k).
+
+        :param field: Field index.
+        :type field: str
+        :param b: Length normalization parameter (default 0.75).
+        :type b: float
+        :param k: Term frequency saturation parameter (default 1.2).
+        :type k: float
+        :return: Array aligned with the 'doc_ids' array of the field postings.
+        :rtype: np.ndarray
+        """
+        key = (field, b, k)
+        if key not in self._impacts:
+            with span("impacts", field=field):
+                postings = self.fields[field]
+                # Row of the term of every posting, to get its idf
+                rows = np.repeat(
+                    np.arange(len(postings.terms)), np.diff(postings.indptr)
+                )
+                f = postings.tf
+                lengths = self.lengths[field][postings.doc_ids]
+                # Here, we just apply the formula from the course
+                num = f * (k + 1)
+                den = f + k * (1 - b + b * lengths / self.avg_length[field])
+                self._impacts[key] = self.idf[field][rows] * (num / den)
+        return self._impacts[key]
+
+    def token_impacts(
+        self, token: str, field: str, b: float = 0.75, k: float = 1.2
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Give the documents containing a token in a field and the BM25 contribution of the token to each of them.
+
+        :param token: Word to look up.
+        :type token: str
+        :param field: Field index.
+        :type field: str
+        :param b: Length normalization parameter (default 0.75).
+        :type b: float
+        :param k: Term frequency saturation parameter (default 1.2).
+        :type k: float
+        :return: Sorted array of document ids and array of contributions (both empty if the token is unknown).
+        :rtype: tuple[np.ndarray, np.ndarray]
+        """
+        postings = self.fields[field]
+        impacts = self.impacts(field, b, k)
+        row = postings.terms.get(token)
+        if row is None:
+            return postings.doc_ids[:0], impacts[:0]
+        start, end = postings.indptr[row], postings.indptr[row + 1]
+        return postings.doc_ids[start:end], impacts[start:end]
+
+    def upper_bound(
+        self, token: str, field: str, b: float = 0.75, k: float = 1.2
+    ) -> float:
+        """
+        Give the highest BM25 contribution of a token to a document of a field.
+
+        :param token: Word to look up.
+        :type token: str
+        :param field: Field index.
+        :type field: str
+        :param b: Length normalization parameter (default 0.75).
+        :type b: float
+        :param k: Term frequency saturation parameter (default 1.2).
+        :type k: float
+        :return: Maximum contribution of the token, 0 if the token is unknown.
+        :rtype: float
+        """
+        key = (field, b, k)
+        if key not in self._upper_bounds:
+            postings = self.fields[field]
+            impacts = self.impacts(field, b, k)
+            if len(impacts) > 0:
+                bounds = np.maximum.reduceat(impacts, postings.indptr[:-1])
+            else:
+                bounds = impacts
+            self._upper_bounds[key] = bounds
+        row = self.fields[field].terms.get(token)
+        return 0.0 if row is None else self._upper_bounds[key][row].item()
+
+    def score(
+        self,
+        tokens: list[str],
+        field: str,
+        b: float = 0.75,
+        k: float = 1.2,
+        term_weights: list[float] = None,
+    ) -> np.ndarray:
+        """
+        Calculate the BM25 score of every document for a processed query.
+
+        :param tokens: Processed query tokens (see process_query).
+        :type tokens: list[str]
+        :param field: Field index to score.
+        :type field: str
+        :param b: Length normalization parameter (default 0.75).
+        :type b: float
+        :param k: Term frequency saturation parameter (default 1.2).
+        :type k: float
+        :param term_weights: Weight of each token (e.g. lower for synonyms), None for all 1.
+        :type term_weights: list[float]
+        :return: Array of scores, in the order of the documents of the engine.
+        :rtype: np.ndarray
+        """
+        if term_weights is None:
+            term_weights = [1.0] * len(tokens)
+        scores = np.zeros(self.n_docs, dtype=np.float64)
+        for token, weight in zip(tokens, term_weights):
+            ids, impacts = self.token_impacts(token, field, b, k)
+            scores[ids] += impacts if weight == 1 else impacts * weight
+        return scores
+
+    def reviews_boost(
+        self, avg_mark: float, count_mark: float, index_name: str = DOC_REVIEWS
+    ) -> np.ndarray:
+        """
+        Give the review boost of every document, computed once per weights and reviews index.
+
+        A document without reviews, or without a mean mark, gets a mark factor of 1.
+
+        :param avg_mark: Weight of the mean mark.
+        :type avg_mark: float
+        :param count_mark: Weight of the number of reviews.
+        :type count_mark: float
+        :param index_name: Name of the JSON index file for reviews (default is 'reviews').
+        :type index_name: str
+        :return: Array of boost multipliers, in the order of the documents of the engine.
+        :rtype: np.ndarray
+        """
+        # The version changes when the indexes are reloaded
+        key = (avg_mark, count_mark, index_name, self.store.version)
+        if key not in self._reviews_boost:
+            index = self.store.index(index_name)
+            boost = np.ones(self.n_docs, dtype=np.float64)
+            for i, url in enumerate(self.urls):
+                marks = index.get(url, {})
+                mean_mark = marks.get("mean_mark")
+                count = marks.get("total_reviews") or 0
+
+                # Divide by 5 bc the rate is out of 5
+                mark_factor = 1 if mean_mark is None else 1 + (mean_mark / 5) * avg_mark
+                # Here we use the log to have a big difference between 1 and 10
+                # But smaller difference between 1001 and 1010
+                count_factor = 1 + math.log10(count + 1) * count_mark
+
+                boost[i] = mark_factor * count_factor
+            self._reviews_boost[key] = boost
+        return self._reviews_boost[key]
@@ -0,0 +1,129 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from TP3.config import *
+from TP3.processing import *
+
+
+class QueryCache:
+    """
+    Bounded LRU cache of query results.
+
+    Entries are keyed on the processed query tokens and a hash of the weights, so that two
+    queries with the same tokens (e.g. "Box of Chocolate!" and "box chocolate") share an entry.
+    All entries are dropped when the indexes of the store are reloaded or change on disk.
+    """
+
+    def __init__(
+        self,
+        store: IndexStore = None,
+        max_size: int = CACHE_SIZE,
+        ttl: float = CACHE_TTL,
+    ):
+        """
+        :param store: Store whose indexes the cached results come from. If None, the entries are never invalidated.
+        :type store: IndexStore
+        :param max_size: Maximum number of entries, the least recently used one is evicted first.
+        :type max_size: int
+        :param ttl: Lifetime of an entry in seconds, None for no expiration.
+        :type ttl: float
+        """
+        self.store = store
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._version = store.version if store is not None else None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(tokens: list[str], weights: dict, *options) -> tuple:
+        """
+        Build the cache key of a query.
+
+        :param tokens: Processed query tokens (see process_query).
+        :type tokens: list[str]
+        :param weights: Dictionary of scoring weights used for the query.
+        :type weights: dict
+        :param options: Other parameters changing the result (e.g. k).
+        :return: Hashable key.
+        :rtype: tuple
+        """
+        weights_hash = hashlib.sha1(
+            json.dumps(weights, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        return (tuple(tokens), weights_hash) + options
+
+    def _check_version(self) -> bool:
+        # Drop everything if the store was reloaded, and refuse to serve outdated results
+        if self.store is None:
+            return True
+        if self.store.version != self._version:
+            self._entries.clear()
+            self._version = self.store.version
+        if self.store.is_stale():
+            self._entries.clear()
+            return False
+        return True
+
+    def get(self, key: tuple) -> tuple[bool, object]:
+        """
+        Look up a key.
+
+        :param key: Key built with QueryCache.key.
+        :type key: tuple
+        :return: (True, value) if the key is cached, (False, None) otherwise.
+        :rtype: tuple[bool, object]
+        """
+        with self._lock:
+            if self._check_version() and key in self._entries:
+                value, created = self._entries[key]
+                if self.ttl is None or time.monotonic() - created < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key: tuple, value: object):
+        """
+        Save the value of a key, evicting the least recently used entry if the cache is full.
+
+        :param key: Key built with QueryCache.key.
+        :type key: tuple
+        :param value: Result of the query.
+        :type value: object
+        """
+        with self._lock:
+            if not self._check_version() or self.max_size <= 0:
+                return
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove every entry and reset the counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    @property
+    def stats(self) -> dict:
+        """
+        Number of entries, hits and misses, and hit rate of the cache.
+        """
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
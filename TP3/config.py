@@ -5,8 +5,15 @@ PATH = "TP3/input"
 INPUT_PATH = "TP3/input/rearranged_products.jsonl"
 OUTPUT_PATH = "TP3/output/responses.jsonl"
 SYNONYMS_PATH = "origin_synonyms.json"
+STATS_PATH = "stats.jsonl"
+CACHE_SIZE = 1024
+CACHE_TTL = None  # In seconds, None to keep the results until they are evicted
 DOC_FIELD = ["title", "description", "origin", "brand"]
 DOC_REVIEWS = "reviews"
+# Proximity signal: fields where the query is searched as a phrase, 'exact' (consecutive tokens),
+# 'ordered' or 'unordered' matching with at most 'slop' other tokens inside the phrase, and
+# 'graded' to score 1 / (1 + slack) instead of 1 for a match
+PROXIMITY = {"fields": ["title"], "mode": "exact", "slop": 0, "graded": False}
 DEFAULT_WEIGHTS = {
     "title": 3.0,
     "description": 1.5,
@@ -14,4 +21,5 @@ DEFAULT_WEIGHTS = {
     "proximity": 2.0,
     "avg_mark": 0.4,
     "count_mark": 0.2,
+    "synonym": 0.5,  # Weight of the synonyms added to the query, relative to its own words
 }
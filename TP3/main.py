@@ -1,55 +1,283 @@
-import sys
+import argparse
+import multiprocessing
+import os
+import time
 from TP3.processing import *
 from TP3.scoring import *
+from TP3.cache import QueryCache
 from TP3.config import INPUT_PATH
+from TP2.tracing import TRACER, count, print_summary, save_trace, span, summarize
 
+# Search state of a batch, inherited by the forked worker processes
+_BATCH_STATE = {}
 
-def main(queries: list[str], input_path: str, weights: dict) -> dict:
+
+def answer_query(
+    query: str,
+    df: pd.DataFrame,
+    weights: dict,
+    store: IndexStore,
+    engine: BM25Engine,
+    k: int = 5,
+    exhaustive: bool = False,
+    cache: QueryCache = None,
+) -> dict:
     """
-    Execute the search engine pipeline for a list of queries and save the results in a dict.
+    Run a single query and format its results.
 
-    :param queries: List of query strings to be processed.
-    :type queries: list[str]
-    :param input_path: Path to the JSONL file containing the product catalog.
-    :type input_path: str
-    :param weights: Dictionary of scoring weights for fields and boosts. Defaults to predefined values in config.py
+    :param query: Query string to be processed.
+    :type query: str
+    :param df: DataFrame containing the raw product data.
+    :type df: pd.DataFrame
+    :param weights: Dictionary of scoring weights for fields and boosts.
     :type weights: dict
-    :return: Dictionary where keys are queries and values are dict with the url, title, description and score for the top 5 results.
+    :param store: Store holding the loaded indexes.
+    :type store: IndexStore
+    :param engine: BM25 engine built on 'store' and 'df'.
+    :type engine: BM25Engine
+    :param k: Number of results kept (default 5).
+    :type k: int
+    :param exhaustive: True to score and sort every document instead of using the top-k retrieval, False otherwise.
+    :type exhaustive: bool
+    :param cache: Cache of the formatted results, None to always run the query.
+    :type cache: QueryCache
+    :return: Dict with the metadata and the top k results, or None if no document matches the query.
     :rtype: dict
     """
+    with span("query", query=query):
+        if cache is None:
+            return _search(query, df, weights, store, engine, k, exhaustive)
+        with span("cache lookup"):
+            key = cache.key(process_query(query, store), weights, k, exhaustive)
+            found, response = cache.get(key)
+        if found:
+            count("cache_hits")
+            return response
+        response = _search(query, df, weights, store, engine, k, exhaustive)
+        cache.put(key, response)
+        return response
 
-    df = load_json_as_df(input_path, lines=True)
-    total_docs = len(df)
-    responses = {}
-    for q in queries:
-        # Calculating the scores
-        results = calculate_linear_scoring(query=q, weights=weights, df=df)
-        top5 = list(results.items())[:5]  # Only keep the top5
-
-        if not top5 or top5[0][1] == 0:  # If all scores are 0, we return nothing
-            continue
-
-        list_urls = []
-        responses[q] = {}
-        filtered_docs = sum(1 for score in results.values() if score > 0)
-        responses[q]["metadata"] = {}
-        responses[q]["metadata"]["total_documents"] = total_docs
-        responses[q]["metadata"]["filtered_documents"] = filtered_docs
-
-        for i, (url, score) in enumerate(top5):
-            list_urls.append([url, score])
+
+def _search(
+    query: str,
+    df: pd.DataFrame,
+    weights: dict,
+    store: IndexStore,
+    engine: BM25Engine,
+    k: int,
+    exhaustive: bool,
+) -> dict:
+    # Run a query without the cache (see answer_query)
+    # Calculating the scores of the top k documents only
+    top, filtered_docs = retrieve_top_k(
+        query=query,
+        df=df,
+        weights=weights,
+        k=k,
+        store=store,
+        engine=engine,
+        exhaustive=exhaustive,
+    )
+
+    if not top or top[0][1] == 0:  # If all scores are 0, we return nothing
+        return None
+
+    response = {}
+    response["metadata"] = {}
+    response["metadata"]["total_documents"] = len(df)
+    response["metadata"]["filtered_documents"] = filtered_docs
+
+    with span("format results"):
+        for i, (url, score) in enumerate(top):
             product = df[df["url"] == url].iloc[0]
             title = product["title"]
             description = product["description"]
 
             # We enumerate each response
-            responses[q][str(i + 1)] = {
+            response[str(i + 1)] = {
                 "title": title,
                 "url": url,
                 "description": description,
                 "score": score,
             }
 
+    return response
+
+
+def _init_worker(input_path: str, path: str, trace: bool):
+    # Only used when processes cannot be forked: each worker loads its own copy
+    if trace:
+        TRACER.enable()
+    store = open_store(path).load()
+    df = load_products(store, input_path)
+    engine = BM25Engine(store, df).prepare()
+    _BATCH_STATE.update(df=df, store=store, engine=engine, cache=QueryCache(store))
+
+
+def _answer_in_worker(args: tuple) -> tuple[dict, list[dict]]:
+    query, weights, k, exhaustive = args
+    response = answer_query(
+        query, weights=weights, k=k, exhaustive=exhaustive, **_BATCH_STATE
+    )
+    # The spans recorded by the worker are sent back with the response
+    return response, TRACER.take(os.getpid())
+
+
+def run_batch(
+    queries: list[str],
+    input_path: str,
+    weights: dict,
+    store: IndexStore,
+    df: pd.DataFrame,
+    engine: BM25Engine,
+    k: int = 5,
+    exhaustive: bool = False,
+    workers: int = 1,
+    chunksize: int = 1,
+    cache: QueryCache = None,
+) -> tuple[list[dict], dict]:
+    """
+    Answer a batch of queries with a pool of worker processes.
+
+    The workers are forked after the indexes are loaded, so they share them (copy-on-write)
+    instead of parsing the JSON files again.
+
+    :param queries: List of query strings to be processed.
+    :type queries: list[str]
+    :param input_path: Path to the JSONL file containing the product catalog.
+    :type input_path: str
+    :param weights: Dictionary of scoring weights for fields and boosts.
+    :type weights: dict
+    :param store: Store holding the loaded indexes.
+    :type store: IndexStore
+    :param df: DataFrame containing the raw product data.
+    :type df: pd.DataFrame
+    :param engine: BM25 engine built on 'store' and 'df'.
+    :type engine: BM25Engine
+    :param k: Number of results kept for each query (default 5).
+    :type k: int
+    :param exhaustive: True to score and sort every document instead of using the top-k retrieval, False otherwise.
+    :type exhaustive: bool
+    :param workers: Number of worker processes (default 1, no pool).
+    :type workers: int
+    :param chunksize: Number of queries sent to a worker at once (default 1).
+    :type chunksize: int
+    :param cache: Cache of the results. With several workers, each one starts with a copy of it.
+    :type cache: QueryCache
+    :return: List of the responses in the order of the queries (None when nothing matches), and a summary with the throughput.
+    :rtype: tuple[list[dict], dict]
+    """
+    start = time.perf_counter()
+    tasks = [(q, weights, k, exhaustive) for q in queries]
+
+    if workers <= 1:
+        answers = [
+            answer_query(q, df, weights, store, engine, k, exhaustive, cache)
+            for q in queries
+        ]
+    else:
+        _BATCH_STATE.update(df=df, store=store, engine=engine.prepare(), cache=cache)
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+            pool = context.Pool(workers)
+        else:
+            context = multiprocessing.get_context()
+            pool = context.Pool(
+                workers, _init_worker, (input_path, store.path, TRACER.enabled)
+            )
+        with pool:
+            # imap keeps the order of the queries
+            answers = []
+            for response, events in pool.imap(
+                _answer_in_worker, tasks, chunksize=chunksize
+            ):
+                answers.append(response)
+                TRACER.merge(events)
+        _BATCH_STATE.clear()
+
+    elapsed = time.perf_counter() - start
+    summary = {
+        "queries": len(queries),
+        "workers": workers,
+        "chunksize": chunksize,
+        "seconds": elapsed,
+        "queries_per_second": len(queries) / elapsed if elapsed > 0 else 0.0,
+    }
+    if cache is not None and workers <= 1:
+        summary["cache"] = cache.stats
+    return answers, summary
+
+
+def main(
+    queries: list[str],
+    input_path: str,
+    weights: dict,
+    store: IndexStore = None,
+    k: int = 5,
+    exhaustive: bool = False,
+    workers: int = 1,
+    chunksize: int = 1,
+    cache: QueryCache = None,
+) -> dict:
+    """
+    Execute the search engine pipeline for a list of queries and save the results in a dict.
+
+    :param queries: List of query strings to be processed.
+    :type queries: list[str]
+    :param input_path: Path to the JSONL file containing the product catalog.
+    :type input_path: str
+    :param weights: Dictionary of scoring weights for fields and boosts. Defaults to predefined values in config.py
+    :type weights: dict
+    :param store: Store holding the loaded indexes. If None, the indexes of config.py's PATH are loaded once for all queries. The products of a SegmentStore are used instead of 'input_path'.
+    :type store: IndexStore
+    :param k: Number of results kept for each query (default 5).
+    :type k: int
+    :param exhaustive: True to score and sort every document instead of using the top-k retrieval, False otherwise.
+    :type exhaustive: bool
+    :param workers: Number of worker processes answering the queries (default 1).
+    :type workers: int
+    :param chunksize: Number of queries sent to a worker at once (default 1).
+    :type chunksize: int
+    :param cache: Cache of the results. If None, a new cache (see config.py) is used for the queries.
+    :type cache: QueryCache
+    :return: Dictionary where keys are queries and values are dict with the url, title, description and score for the top k results.
+    :rtype: dict
+    """
+
+    if store is None:
+        store = open_store(PATH).load()
+    df = load_products(store, input_path)
+    engine = BM25Engine(store, df)
+    if cache is None:
+        cache = QueryCache(store)
+    answers, summary = run_batch(
+        queries=queries,
+        input_path=input_path,
+        weights=weights,
+        store=store,
+        df=df,
+        engine=engine,
+        k=k,
+        exhaustive=exhaustive,
+        workers=workers,
+        chunksize=chunksize,
+        cache=cache,
+    )
+    print(
+        f"{summary['queries']} queries answered in {summary['seconds']:.3f}s "
+        f"({summary['queries_per_second']:.1f} queries/s, {workers} worker(s), "
+        f"chunksize {chunksize})"
+    )
+    if "cache" in summary:
+        print(
+            f"Cache: {summary['cache']['hits']} hits, {summary['cache']['misses']} misses"
+        )
+
+    responses = {}
+    for q, response in zip(queries, answers):
+        if response is not None:
+            responses[q] = response
+
     return responses
 
 
@@ -62,15 +290,40 @@ if __name__ == "__main__":
         "kids shoes",
     ]
 
-    input_path = INPUT_PATH
-    output_path = OUTPUT_PATH
-    weights = DEFAULT_WEIGHTS
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_path", nargs="?", default=INPUT_PATH)
+    parser.add_argument("output_path", nargs="?", default=OUTPUT_PATH)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--chunksize", type=int, default=1)
+    parser.add_argument("--queries", help="File with one query per line")
+    parser.add_argument(
+        "--index-path",
+        default=PATH,
+        help="Folder of the indexes, or of a segmented index (see TP2.segments)",
+    )
+    parser.add_argument(
+        "--trace",
+        help="JSON lines file saving the time of each stage of the queries, "
+        "a Chrome trace is saved next to it (the spans of the workers included)",
+    )
+    args = parser.parse_args()
+    if args.trace:
+        TRACER.enable()
 
-    if len(sys.argv) > 1:
-        input_path = sys.argv[1]
+    if args.queries:
+        with open(args.queries, "r", encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
 
-    if len(sys.argv) > 2:
-        output_path = sys.argv[2]
+    results = main(
+        queries=queries,
+        input_path=args.input_path,
+        weights=DEFAULT_WEIGHTS,
+        store=open_store(args.index_path).load(),
+        workers=args.workers,
+        chunksize=args.chunksize,
+    )
+    save_json(data=results, file_path=args.output_path)
 
-    results = main(queries=queries, input_path=input_path, weights=weights)
-    save_json(data=results, file_path=output_path)
+    if args.trace:
+        save_trace(args.trace)
+        print_summary(summarize(TRACER.events))
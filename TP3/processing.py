@@ -1,7 +1,12 @@
+import bisect
+import heapq
 import json
 import pandas as pd
 import string
 import os
+from TP2.binary_index import BinaryIndex
+from TP2.segments import MANIFEST, load_live_segments
+from TP2.tracing import count, span
 from TP3.config import *
 
 
@@ -62,6 +67,315 @@ def save_json(data: dict, file_path: str):
         json.dump(existing_data, f, indent=4, ensure_ascii=False)
 
 
+class IndexStore:
+    """
+    In-memory store of the indexes and synonyms table of an input folder.
+
+    Every file is parsed once, on first use, and kept in memory until 'invalidate' is called.
+    If an index also exists in the binary format ('<name>_index.bin'), it is opened with mmap
+    instead of parsing the JSON file.
+    """
+
+    def __init__(
+        self,
+        path: str = PATH,
+        fields: list[str] = DOC_FIELD,
+        reviews_name: str = DOC_REVIEWS,
+        synonyms_path: str = SYNONYMS_PATH,
+    ):
+        """
+        :param path: Folder containing the '<name>_index.json' files and the synonyms table.
+        :type path: str
+        :param fields: Names of the field indexes to load.
+        :type fields: list[str]
+        :param reviews_name: Name of the reviews index (default is 'reviews').
+        :type reviews_name: str
+        :param synonyms_path: Name of the synonyms JSON file inside 'path'.
+        :type synonyms_path: str
+        """
+        self.path = path
+        self.fields = list(fields)
+        self.reviews_name = reviews_name
+        self.synonyms_path = synonyms_path
+        self._indexes = {}
+        self._synonyms = None
+        self._synonym_trie = None
+        self._stats = None
+        self._mtimes = {}
+
+    def _index_path(self, name: str) -> str:
+        return os.path.join(self.path, name + "_index.json")
+
+    def _track(self, path: str):
+        # Keep the modification time of every loaded file to detect changes on disk
+        self._mtimes[path] = os.stat(path).st_mtime_ns
+        count("index_loads")
+
+    def load(self) -> "IndexStore":
+        """
+        Load every field index, the reviews index and the synonyms table.
+
+        :return: The store itself, to allow chaining.
+        :rtype: IndexStore
+        """
+        for name in self.fields + [self.reviews_name]:
+            self.index(name)
+        self.synonym_trie
+        self.stats
+        return self
+
+    def index(self, name: str) -> dict:
+        """
+        Give the index called 'name', loading it from disk if needed.
+
+        :param name: Name of the index ('title', 'description', 'brand', 'origin' or 'reviews').
+        :type name: str
+        :return: The index as a dict.
+        :rtype: dict
+        """
+        if name not in self._indexes:
+            path = self._index_path(name)
+            binary_path = os.path.join(self.path, name + "_index.bin")
+            with span("load index", name=name):
+                if os.path.exists(binary_path):
+                    self._indexes[name] = BinaryIndex(binary_path)
+                    self._track(binary_path)
+                else:
+                    self._indexes[name] = load_json(path)
+                    self._track(path)
+        return self._indexes[name]
+
+    @property
+    def synonyms(self) -> dict:
+        """
+        Synonyms table, loaded from disk if needed.
+        """
+        if self._synonyms is None:
+            path = os.path.join(self.path, self.synonyms_path)
+            with span("load index", name="synonyms"):
+                self._synonyms = load_json(path)
+                self._track(path)
+        return self._synonyms
+
+    @property
+    def synonym_trie(self) -> "SynonymTrie":
+        """
+        Synonyms table compiled for the query expansion (see SynonymTrie).
+        """
+        if self._synonym_trie is None:
+            self._synonym_trie = SynonymTrie(self.synonyms)
+        return self._synonym_trie
+
+    @property
+    def stats(self) -> dict:
+        """
+        Collection statistics of the field indexes (see compute_stats for the format).
+
+        They are read from the stats file written with the indexes, or computed from
+        the loaded indexes if there is no such file (it is required with binary indexes).
+        """
+        if self._stats is None:
+            path = os.path.join(self.path, STATS_PATH)
+            with span("load index", name="stats"):
+                if os.path.exists(path):
+                    # Written by TP2 with one statistic per line
+                    self._stats = {}
+                    for line in load_json(path, lines=True):
+                        self._stats.update(line)
+                    self._track(path)
+                elif any(
+                    os.path.exists(os.path.join(self.path, name + "_index.bin"))
+                    for name in self.fields
+                ):
+                    # Computing them would decode every posting of the binary indexes
+                    raise FileNotFoundError(
+                        f"'{path}' is required with binary indexes, it is written by TP2 with them."
+                    )
+                else:
+                    self._stats = compute_stats(self)
+        return self._stats
+
+    def is_stale(self) -> bool:
+        """
+        Check if one of the loaded files has changed on disk since it was loaded.
+
+        :return: True if the store should be invalidated, False otherwise.
+        :rtype: bool
+        """
+        for path, mtime in self._mtimes.items():
+            if not os.path.exists(path) or os.stat(path).st_mtime_ns != mtime:
+                return True
+        return False
+
+    @property
+    def version(self) -> tuple:
+        """
+        Version of the loaded data: the modification times of the files read so far.
+        """
+        return tuple(sorted(self._mtimes.items()))
+
+    def invalidate(self):
+        """
+        Drop everything loaded so far, the files will be read again on next access.
+        """
+        self._indexes = {}
+        self._synonyms = None
+        self._synonym_trie = None
+        self._stats = None
+        self._mtimes = {}
+
+
+class SegmentStore(IndexStore):
+    """
+    Store of a segmented index folder written by TP2.segments.
+
+    The live documents of all the segments are merged in memory when the store is loaded,
+    so the indexes, the statistics and the products are the ones of a full rebuild of the
+    live catalog. The manifest is tracked like an index file: any update of the folder
+    makes the store stale. The segments are immutable, so the ones already read are kept
+    and only the new segments are read again when the store is reloaded.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        fields: list[str] = DOC_FIELD,
+        reviews_name: str = DOC_REVIEWS,
+        synonyms_path: str = os.path.join(PATH, SYNONYMS_PATH),
+    ):
+        """
+        :param path: Folder of the segmented index.
+        :type path: str
+        :param fields: Names of the field indexes to load.
+        :type fields: list[str]
+        :param reviews_name: Name of the reviews index (default is 'reviews').
+        :type reviews_name: str
+        :param synonyms_path: Path of the synonyms JSON file (not stored with the segments).
+        :type synonyms_path: str
+        """
+        super().__init__(path, fields, reviews_name, os.path.abspath(synonyms_path))
+        self._products = None
+        self._segments = {}  # Segments read so far, see TP2.segments.read_segment
+
+    def _load_segments(self):
+        manifest_path = os.path.join(self.path, MANIFEST)
+        if os.path.exists(manifest_path):
+            self._track(manifest_path)
+        with span("load segments"):
+            _, live = load_live_segments(self.path, self._segments)
+        self._indexes = dict(live["indexes"])
+        # TP2 saves the mean rating as 'mean_marks', TP3 reads 'mean_mark'
+        self._indexes[self.reviews_name] = {
+            url: {
+                "total_reviews": marks["total_reviews"],
+                "mean_mark": marks.get("mean_mark", marks.get("mean_marks")),
+                "last_rating": marks["last_rating"],
+            }
+            for url, marks in live["reviews"].items()
+        }
+        self._products = live["products"]
+
+    def index(self, name: str) -> dict:
+        """
+        Give the index called 'name', merging the live segments if needed.
+
+        :param name: Name of the index ('title', 'description', 'brand', 'origin' or 'reviews').
+        :type name: str
+        :return: The index as a dict.
+        :rtype: dict
+        """
+        if self._products is None:
+            self._load_segments()
+        return self._indexes[name]
+
+    def products(self) -> pd.DataFrame:
+        """
+        Give the live products, in catalog order.
+
+        :return: A dataframe with the same columns as the product catalog.
+        :rtype: pd.DataFrame
+        """
+        if self._products is None:
+            self._load_segments()
+        return pd.DataFrame(self._products)
+
+    def invalidate(self):
+        """
+        Drop everything loaded so far, the segments will be merged again on next access
+        (the segments already read are kept).
+        """
+        super().invalidate()
+        self._products = None
+
+
+def open_store(path: str = PATH) -> IndexStore:
+    """
+    Give the store of an index folder: a SegmentStore if it holds a segmented index, an IndexStore otherwise.
+
+    :param path: Folder containing the indexes.
+    :type path: str
+    :return: The store, not loaded yet.
+    :rtype: IndexStore
+    """
+    if os.path.exists(os.path.join(path, MANIFEST)):
+        return SegmentStore(path)
+    return IndexStore(path)
+
+
+def load_products(store: IndexStore, input_path: str = INPUT_PATH) -> pd.DataFrame:
+    """
+    Load the products searched with a store: the live products of a segmented index, or the catalog file otherwise.
+
+    :param store: Store holding the indexes.
+    :type store: IndexStore
+    :param input_path: Path to the JSONL file containing the product catalog.
+    :type input_path: str
+    :return: A dataframe of the products.
+    :rtype: pd.DataFrame
+    """
+    if isinstance(store, SegmentStore):
+        return store.products()
+    return load_json_as_df(input_path, lines=True)
+
+
+def compute_stats(store: IndexStore) -> dict:
+    """
+    Compute the collection statistics of the field indexes of a store, without tokenizing any document.
+
+    :param store: Store holding the loaded indexes.
+    :type store: IndexStore
+    :return: Dict with the number of documents 'N' and, for each field, the length of every document ('doc_length'), the average length ('avg_length') and the document frequency of every token ('doc_freq').
+    :rtype: dict
+    """
+    # The reviews index has an entry for every document of the collection
+    urls = list(store.index(store.reviews_name).keys())
+    stats = {"N": len(urls)}
+
+    for field in store.fields:
+        index = store.index(field)
+        if any(isinstance(postings, dict) for postings in index.values()):
+            # The length is the number of indexed tokens, i.e. of saved positions
+            doc_length = {url: 0 for url in urls}
+            for postings in index.values():
+                for url, positions in postings.items():
+                    doc_length[url] = doc_length.get(url, 0) + len(positions)
+        else:
+            # A feature is a single value, so it counts as one token
+            doc_length = {url: 1 for url in urls}
+
+        stats[field] = {
+            "avg_length": sum(doc_length.values()) / len(doc_length) if urls else 0.0,
+            "doc_length": doc_length,
+            "doc_freq": {token: len(postings) for token, postings in index.items()},
+        }
+
+    return stats
+
+
+# Shared store used when no store is given to the lookup functions
+DEFAULT_STORE = IndexStore()
+
+
 def tokenize(text: str) -> list[str]:
     """
     Tranforms the text into a list of words, removing any punctuation or special characters.
@@ -112,48 +426,146 @@ def process_doc(doc: str) -> list[str]:
     return remove_stopwords(standardize(tokenize(doc)))
 
 
-def get_synonyms(token: str) -> list[str]:
+class SynonymTrie:
+    """
+    Synonyms table compiled into a trie over the processed words of each phrase.
+
+    Every phrase of an entry (the key and its values) leads to the other phrases of the entry,
+    so the lookup works in both directions, and multi-word phrases such as
+    "united states of america" are matched in the query. The table is compiled once,
+    so the expansion of a query reads no file.
+    """
+
+    # Key of a node holding the synonyms of the phrase ending there
+    _END = None
+
+    def __init__(self, synonyms: dict):
+        """
+        :param synonyms: Synonyms table, {phrase: [synonym phrases]}.
+        :type synonyms: dict
+        """
+        self._root = {}
+        for key, values in synonyms.items():
+            group = list(values) + [key]
+            for phrase in group:
+                tokens = process_doc(phrase)
+                if not tokens:
+                    continue
+                node = self._root
+                for token in tokens:
+                    node = node.setdefault(token, {})
+                # The phrase as written in the table, and its synonyms
+                _, expansions = node.setdefault(self._END, (phrase, []))
+                expansions += [x for x in group if x != phrase and x not in expansions]
+
+    def get(self, tokens: list[str]) -> list[str]:
+        """
+        Give the synonyms of a phrase.
+
+        :param tokens: Processed words of the phrase.
+        :type tokens: list[str]
+        :return: List of synonyms, or None.
+        :rtype: list[str]
+        """
+        node = self._root
+        for token in tokens:
+            node = node.get(token)
+            if node is None:
+                return None
+        if self._END not in node or not node[self._END][1]:
+            return None
+        return list(node[self._END][1])
+
+    def expand(self, tokens: list[str]) -> tuple[list[str], list[str]]:
+        """
+        Find the phrases of the table in a query and their synonyms, in one pass from left to right.
+
+        At each position, the longest phrase of the table starting there is matched,
+        and the search goes on after it.
+
+        :param tokens: Processed query tokens.
+        :type tokens: list[str]
+        :return: List of the matched multi-word phrases, as written in the table (e.g. "south korea"), and list of their synonyms.
+        :rtype: tuple[list[str], list[str]]
+        """
+        phrases = []
+        synonyms = []
+        i = 0
+        while i < len(tokens):
+            node = self._root
+            match, end = None, i + 1
+            for j in range(i, len(tokens)):
+                node = node.get(tokens[j])
+                if node is None:
+                    break
+                if self._END in node:
+                    match, end = node[self._END], j + 1
+            if match is None:
+                i += 1
+                continue
+            phrase, expansions = match
+            # Single words are already in the query
+            if end - i > 1:
+                phrases.append(phrase)
+            synonyms += expansions
+            i = end
+        return phrases, synonyms
+
+
+def get_synonyms(token: str, store: IndexStore = DEFAULT_STORE) -> list[str]:
     """
     Find all related synonyms for a given word.
 
     :param token: Word to find synonyms.
     :type token: str
+    :param store: Store holding the synonyms table.
+    :type store: IndexStore
     :return: List of synonyms, or None.
     :rtype: list[str]
     """
-    origin_synonyms = load_json(PATH + "/" + SYNONYMS_PATH)
-    synonyms = None
-    # We need to check within both the keys and the values
-    for k, v in origin_synonyms.items():
-        if k == token:
-            synonyms = origin_synonyms[token]
-        if token in v:
-            synonyms = origin_synonyms[k]
-            synonyms.append(k)
-            synonyms.remove(token)
-    return synonyms
+    return store.synonym_trie.get([token])
 
 
-def process_query(query: str) -> list[str]:
+def expand_query(
+    query: str, store: IndexStore = DEFAULT_STORE
+) -> tuple[list[str], list[str], list[str]]:
+    """
+    Process the user query and find the synonyms of its words and phrases.
+
+    The multi-word phrases of the synonyms table found in the query are kept whole as well,
+    since the feature indexes (e.g. origin) use whole phrases as keys.
+
+    :param query: Text corresponding to the query.
+    :type query: str
+    :param store: Store holding the synonyms table.
+    :type store: IndexStore
+    :return: List of tokens corresponding to the query words, list of the phrases of the table found in the query, and list of their synonyms.
+    :rtype: tuple[list[str], list[str], list[str]]
+    """
+    q = process_doc(query)
+    phrases, synonyms = store.synonym_trie.expand(q)
+    return q, phrases, synonyms
+
+
+def process_query(query: str, store: IndexStore = DEFAULT_STORE) -> list[str]:
     """
     Process the user query and expand it with synonyms.
 
     :param query: Text corresponding to the query.
     :type query: str
+    :param store: Store holding the synonyms table.
+    :type store: IndexStore
     :return: List of tokens corresponding to the query words and their synonyms.
     :rtype: list[str]
     """
-    q = process_doc(query)
-    augment = []
-    for token in q:
-        synonyms = get_synonyms(token)
-        if synonyms:
-            augment += synonyms
+    q, phrases, augment = expand_query(query, store)
     # Same as processing any text, but we add synonyms
-    return q + augment
+    return q + phrases + augment
 
 
-def get_reviews(doc_url: str, index_name: str = DOC_REVIEWS) -> dict:
+def get_reviews(
+    doc_url: str, index_name: str = DOC_REVIEWS, store: IndexStore = DEFAULT_STORE
+) -> dict:
     """
     Retrieve review statistics and ratings for a specific document.
 
@@ -161,17 +573,21 @@ def get_reviews(doc_url: str, index_name: str = DOC_REVIEWS) -> dict:
     :type doc_url: str
     :param index_name: Name of the JSON index file for reviews (default is 'reviews').
     :type index_name: str
+    :param store: Store holding the loaded indexes.
+    :type store: IndexStore
     :return: Dictionary containing 'total_reviews', 'mean_mark', and 'last_rating'.
     :rtype: dict
     """
-    index = load_json(PATH + "/" + index_name + "_index.json")
+    index = store.index(index_name)
     if doc_url in index.keys():
         return index[doc_url]
     else:
         return {"total_reviews": 0, "mean_mark": None, "last_rating": None}
 
 
-def get_pos_in_doc(token: str, doc_url: str, field: str) -> list[int]:
+def get_pos_in_doc(
+    token: str, doc_url: str, field: str, store: IndexStore = DEFAULT_STORE
+) -> list[int]:
     """
     Retrieve the occurrence positions of a token within a specific document field.
 
@@ -181,13 +597,15 @@ def get_pos_in_doc(token: str, doc_url: str, field: str) -> list[int]:
     :type doc_url: str
     :param field: Index to search in ('title' or 'description).
     :type field: str
+    :param store: Store holding the loaded indexes.
+    :type store: IndexStore
     :return: List of integer positions where the token is found, or an empty list.
     :rtype: list[int]
     """
     # Bc there are only position for title and description
     if field not in ["title", "description"]:
         raise ValueError("'field' should be 'title' or 'description'.")
-    index = load_json(PATH + "/" + field + "_index.json")
+    index = store.index(field)
     # First check if the word is known
     # Then check if there is a document for this word
     if token in index.keys() and doc_url in index[token]:
@@ -196,7 +614,12 @@ def get_pos_in_doc(token: str, doc_url: str, field: str) -> list[int]:
         return []
 
 
-def get_occ_in_doc(token: str, doc_url: str, field: list[str] = DOC_FIELD) -> int:
+def get_occ_in_doc(
+    token: str,
+    doc_url: str,
+    field: list[str] = DOC_FIELD,
+    store: IndexStore = DEFAULT_STORE,
+) -> int:
     """
     Count total occurrences of a token across multiple document fields.
 
@@ -206,12 +629,14 @@ def get_occ_in_doc(token: str, doc_url: str, field: list[str] = DOC_FIELD) -> in
     :type doc_url: str
     :param field: List of document indexes to search.
     :type field: list[str]
+    :param store: Store holding the loaded indexes.
+    :type store: IndexStore
     :return: Total number of occurences of the token.
     :rtype: int
     """
     occ = 0
     for f in field:
-        index = load_json(PATH + "/" + f + "_index.json")
+        index = store.index(f)
         if token in index.keys() and doc_url in index[token]:
             if isinstance(index[token], dict):
                 # If it's title or description, we keep the number of saved positions
@@ -222,7 +647,7 @@ def get_occ_in_doc(token: str, doc_url: str, field: list[str] = DOC_FIELD) -> in
     return occ
 
 
-def is_in_doc(token: str, doc_url: str) -> bool:
+def is_in_doc(token: str, doc_url: str, store: IndexStore = DEFAULT_STORE) -> bool:
     """
     Check if a token exists in the document.
 
@@ -230,11 +655,13 @@ def is_in_doc(token: str, doc_url: str) -> bool:
     :type token: str
     :param doc_url: URL identifying the document.
     :type doc_url: str
+    :param store: Store holding the loaded indexes.
+    :type store: IndexStore
     :return: True if the token is found, False otherwise.
     :rtype: bool
     """
-    for field in DOC_FIELD:
-        index = load_json(PATH + "/" + field + "_index.json")
+    for field in store.fields:
+        index = store.index(field)
         # First check if the word is known
         # Then check if there is the wanted document
         if token in index.keys() and doc_url in index[token]:
@@ -242,7 +669,9 @@ def is_in_doc(token: str, doc_url: str) -> bool:
     return False
 
 
-def contain_1_token(query: str, doc_url: str) -> bool:
+def contain_1_token(
+    query: str, doc_url: str, store: IndexStore = DEFAULT_STORE
+) -> bool:
     """
     Verify if at least one token from the query exists in the document.
 
@@ -250,16 +679,20 @@ def contain_1_token(query: str, doc_url: str) -> bool:
     :type query: str
     :param doc_url: URL identifying the document.
     :type doc_url: str
+    :param store: Store holding the loaded indexes.
+    :type store: IndexStore
     :return: True if at least one query term is present in the document, False otherwise.
     :rtype: bool
     """
-    query = process_query(query)
+    query = process_query(query, store)
     # Creates a list with is_in_doc result for all token of the query
     # True if there is at least one True
-    return any([is_in_doc(x, doc_url) for x in query])
+    return any([is_in_doc(x, doc_url, store) for x in query])
 
 
-def contain_all_tokens(query: str, doc_url: str) -> bool:
+def contain_all_tokens(
+    query: str, doc_url: str, store: IndexStore = DEFAULT_STORE
+) -> bool:
     """
     Check if every single token from the query is present in the document.
 
@@ -267,13 +700,15 @@ def contain_all_tokens(query: str, doc_url: str) -> bool:
     :type query: str
     :param doc_url: URL identifying the document.
     :type doc_url: str
+    :param store: Store holding the loaded indexes.
+    :type store: IndexStore
     :return: True if all query terms are present in the document, False otherwise.
     :rtype: bool
     """
-    query = process_query(query)
+    query = process_query(query, store)
     # Creates a list with is_in_doc result for all token of the query
     # True if all of them are True
-    return all([is_in_doc(x, doc_url) for x in query])
+    return all([is_in_doc(x, doc_url, store) for x in query])
 
 
 def get_len_content(
@@ -303,6 +738,92 @@ def get_len_content(
     return len_content
 
 
+def intersect_sorted(a: list[int], b: list[int]) -> list[int]:
+    """
+    Intersect two sorted lists by merging them.
+
+    :param a: First sorted list.
+    :type a: list[int]
+    :param b: Second sorted list.
+    :type b: list[int]
+    :return: Sorted list of the values found in both lists.
+    :rtype: list[int]
+    """
+    i, j = 0, 0
+    common = []
+    while i < len(a) and j < len(b):
+        if a[i] < b[j]:
+            i += 1
+        elif a[i] > b[j]:
+            j += 1
+        else:
+            common.append(a[i])
+            i += 1
+            j += 1
+    return common
+
+
+def match_positions(all_positions: list[list[int]], mode: str = "exact") -> int:
+    """
+    Find the closest occurrence of a sequence of tokens in a text.
+
+    The result is the slack of the best occurrence: the number of other tokens inside the
+    smallest window containing every token of the sequence (0 for an exact phrase).
+
+    :param all_positions: A list of sorted position lists, where each inner list contains the indices of a token in the document.
+    :type all_positions: list[list[int]]
+    :param mode: 'exact' for consecutive tokens, 'ordered' for tokens in the same order with other tokens between them, 'unordered' for tokens in any order.
+    :type mode: str
+    :return: Slack of the best occurrence, or None if the tokens do not appear (in this mode).
+    :rtype: int
+    """
+    if mode not in ["exact", "ordered", "unordered"]:
+        raise ValueError(
+            "'mode' should take value in ['exact', 'ordered', 'unordered']."
+        )
+    if not all_positions or any(not positions for positions in all_positions):
+        return None
+    n = len(all_positions)
+
+    if mode == "exact":
+        # Start positions of the phrase: shift the positions of the i-th token by i and intersect
+        starts = all_positions[0]
+        for i in range(1, n):
+            starts = intersect_sorted(starts, [pos - i for pos in all_positions[i]])
+            if not starts:
+                return None
+        return 0
+
+    if mode == "ordered":
+        best = None
+        for start in all_positions[0]:
+            # From each start, take the first occurrence of the next token after the previous one
+            last = start
+            for positions in all_positions[1:]:
+                j = bisect.bisect_right(positions, last)
+                if j == len(positions):
+                    return best  # Later starts cannot find an occurrence either
+                last = positions[j]
+            slack = last - start - (n - 1)
+            best = slack if best is None else min(best, slack)
+        return best
+
+    # Unordered: smallest window with one position of each token, moving the smallest position
+    heap = [(positions[0], i, 0) for i, positions in enumerate(all_positions)]
+    heapq.heapify(heap)
+    highest = max(pos for pos, _, _ in heap)
+    best = None
+    while True:
+        lowest, i, j = heapq.heappop(heap)
+        slack = max(highest - lowest - (n - 1), 0)
+        best = slack if best is None else min(best, slack)
+        if j + 1 == len(all_positions[i]):
+            return best
+        following = all_positions[i][j + 1]
+        highest = max(highest, following)
+        heapq.heappush(heap, (following, i, j + 1))
+
+
 def are_positions_successive(all_positions: list[list[int]]) -> bool:
     """
     Check if a sequence of tokens appears consecutively in the text.
@@ -312,16 +833,4 @@ def are_positions_successive(all_positions: list[list[int]]) -> bool:
     :return: rue if the tokens form a continuous sequence, False otherwise.
     :rtype: bool
     """
-    if not all_positions or not all_positions[0]:
-        return False
-
-    for pos in all_positions[0]:
-        match = True
-        for i in range(1, len(all_positions)):
-            if (pos + i) not in all_positions[i]:
-                match = False
-                break
-        if match:
-            return True
-
-    return False
+    return match_positions(all_positions, "exact") is not None
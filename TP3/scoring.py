@@ -1,12 +1,44 @@
-import math
+import heapq
 import pandas as pd
 import numpy as np
 from TP3.config import *
 from TP3.processing import *
+from TP3.bm25 import BM25Engine
+from TP2.tracing import count, span
+
+
+def weigh_query_terms(
+    query: str, weights: dict, store: IndexStore = DEFAULT_STORE
+) -> tuple[list[str], list[str], list[float]]:
+    """
+    Process a query and give the weight of each of its terms: 1 for the words and phrases
+    of the query, and the 'synonym' weight for the synonyms added by the expansion.
+
+    :param query: Text corresponding to the query.
+    :type query: str
+    :param weights: Dictionary of importance weights for various scoring factors.
+    :type weights: dict
+    :param store: Store holding the synonyms table.
+    :type store: IndexStore
+    :return: Words of the query, all the terms (words, phrases then synonyms) and the weight of each term.
+    :rtype: tuple[list[str], list[str], list[float]]
+    """
+    tokens, phrases, synonyms = expand_query(query, store)
+    synonym_weight = weights.get("synonym", DEFAULT_WEIGHTS["synonym"])
+    terms = tokens + phrases + synonyms
+    term_weights = [1.0] * len(tokens + phrases) + [synonym_weight] * len(synonyms)
+    return tokens, terms, term_weights
 
 
 def calculate_bm25(
-    query: str, field: str, df: pd.DataFrame, b: float = 0.75, k: float = 1.2
+    query: str,
+    field: str,
+    df: pd.DataFrame,
+    b: float = 0.75,
+    k: float = 1.2,
+    store: IndexStore = DEFAULT_STORE,
+    engine: BM25Engine = None,
+    weights: dict = DEFAULT_WEIGHTS,
 ) -> dict:
     """
     Calculate the BM25 relevance score for each document against a query.
@@ -21,36 +53,83 @@ def calculate_bm25(
     :type b: float
     :param k: Term frequency saturation parameter (default 1.2).
     :type k: float
+    :param store: Store holding the loaded indexes.
+    :type store: IndexStore
+    :param engine: BM25 engine built on 'store' and 'df'. If None, a new one is built.
+    :type engine: BM25Engine
+    :param weights: Dictionary of scoring weights, only the 'synonym' weight is used.
+    :type weights: dict
     :return: Dictionary mapping document URLs to their calculated BM25 scores.
     :rtype: dict
     """
-    query = process_query(query)
-    n_docs = len(df)
-    all_lengths = df["url"].apply(
-        lambda x: get_len_content(doc_url=x, df=df, field=[field])
-    )
-    avg_len = all_lengths.mean()
+    if engine is None:
+        engine = BM25Engine(store, df)
+    with span("bm25", field=field):
+        _, terms, term_weights = weigh_query_terms(query, weights, store)
+        scores = engine.score(terms, field, b=b, k=k, term_weights=term_weights)
+    return dict(zip(engine.urls, scores.tolist()))
 
-    bm25 = {url: 0 for url in df["url"]}
 
-    for token in query:
-        doc_freq = sum(df["url"].apply(lambda x: is_in_doc(token, x)))
-        if doc_freq != 0:
-            # Inversed doc frequency
-            idf = np.log(n_docs / doc_freq)
-            for i, url in enumerate(df["url"]):
-                f = get_occ_in_doc(token, url, [field])
-                if f > 0:
-                    # Here, we just apply the formula from the course
-                    len_doc = all_lengths.iloc[i]
-                    num = f * (k + 1)
-                    den = f + k * (1 - b + b * len_doc / avg_len)
-                    bm25[url] += idf * (num / den)
+def calculate_proximity(
+    tokens: list[str],
+    field: str,
+    store: IndexStore = DEFAULT_STORE,
+    mode: str = "exact",
+    slop: int = 0,
+    graded: bool = False,
+) -> dict:
+    """
+    Score the documents containing the query tokens close to each other in a field.
 
-    return bm25
+    Only the documents containing all the tokens are checked, by intersecting the postings
+    of the tokens, and their sorted position lists are then matched (see match_positions).
 
+    :param tokens: Processed query tokens (see process_query).
+    :type tokens: list[str]
+    :param field: Index to search in ('title' or 'description').
+    :type field: str
+    :param store: Store holding the loaded indexes.
+    :type store: IndexStore
+    :param mode: 'exact', 'ordered' or 'unordered' (see match_positions).
+    :type mode: str
+    :param slop: Maximum number of other tokens inside an occurrence (ignored for 'exact').
+    :type slop: int
+    :param graded: True to score 1 / (1 + slack) instead of 1 for a match.
+    :type graded: bool
+    :return: Dictionary mapping the URLs of the matching documents to their proximity score.
+    :rtype: dict
+    """
+    # Bc there are only position for title and description
+    if field not in ["title", "description"]:
+        raise ValueError("'field' should be 'title' or 'description'.")
+    if not tokens:
+        return {}
+    if mode == "unordered":
+        # Each distinct token only needs to appear once
+        tokens = list(dict.fromkeys(tokens))
+
+    index = store.index(field)
+    postings = {}
+    for token in tokens:
+        if token not in index:
+            return {}
+        postings[token] = index[token]
 
-def is_exact_match(query: str, field: str, df: pd.DataFrame) -> dict:
+    # Documents containing all the tokens, starting from the rarest token
+    rarest = min(postings.values(), key=len)
+    candidates = [url for url in rarest if all(url in p for p in postings.values())]
+
+    scores = {}
+    for url in candidates:
+        slack = match_positions([postings[token][url] for token in tokens], mode)
+        if slack is not None and (mode == "exact" or slack <= slop):
+            scores[url] = 1 / (1 + slack) if graded else 1.0
+    return scores
+
+
+def is_exact_match(
+    query: str, field: str, df: pd.DataFrame, store: IndexStore = DEFAULT_STORE
+) -> dict:
     """
     Identify documents containing the query as an exact consecutive phrase.
 
@@ -60,27 +139,59 @@ def is_exact_match(query: str, field: str, df: pd.DataFrame) -> dict:
     :type field: str
     :param df: DataFrame containing the raw product data.
     :type df: pd.DataFrame
+    :param store: Store holding the loaded indexes.
+    :type store: IndexStore
     :return: Dictionary mapping URLs to 1 (match found) or 0 (no match).
     :rtype: dict
     """
-    match = {url: 0 for url in df["url"]}
-    query = process_query(query)
+    with span("exact match", field=field):
+        match = {url: 0 for url in df["url"]}
+        # The synonyms are not part of the phrase
+        query, _, _ = expand_query(query, store)
 
-    for url in df["url"]:
-        all_positions = []
-        for token in query:
-            positions = get_pos_in_doc(token, url, field)
-            all_positions.append(positions)
-        # We have the list of positions from words of the query,
-        # such as first list = positions for the first token of the query
-        if are_positions_successive(all_positions):
-            match[url] = 1
+        for url in calculate_proximity(query, field, store, mode="exact"):
+            if url in match:
+                match[url] = 1
 
     return match
 
 
+def get_proximity_scores(
+    tokens: list[str], store: IndexStore, proximity: dict = PROXIMITY
+) -> dict:
+    """
+    Sum the proximity scores of the documents over the fields of the proximity settings.
+
+    :param tokens: Processed query tokens (see process_query).
+    :type tokens: list[str]
+    :param store: Store holding the loaded indexes.
+    :type store: IndexStore
+    :param proximity: Proximity settings (see PROXIMITY in config.py).
+    :type proximity: dict
+    :return: Dictionary mapping the URLs of the matching documents to their proximity score.
+    :rtype: dict
+    """
+    scores = {}
+    for field in proximity["fields"]:
+        field_scores = calculate_proximity(
+            tokens,
+            field,
+            store,
+            mode=proximity["mode"],
+            slop=proximity["slop"],
+            graded=proximity["graded"],
+        )
+        for url, score in field_scores.items():
+            scores[url] = scores.get(url, 0.0) + score
+    return scores
+
+
 def calculate_reviews_boost(
-    df: pd.DataFrame, weights: dict, index_name: str = DOC_REVIEWS
+    df: pd.DataFrame,
+    weights: dict,
+    index_name: str = DOC_REVIEWS,
+    store: IndexStore = DEFAULT_STORE,
+    engine: BM25Engine = None,
 ) -> dict:
     """
     Calculate a boost factor for documents based on user ratings and popularity.
@@ -91,29 +202,30 @@ def calculate_reviews_boost(
     :type weights: dict
     :param index_name: Name of the JSON index file for reviews (default is 'reviews').
     :type index_name: str
+    :param store: Store holding the loaded indexes.
+    :type store: IndexStore
+    :param engine: BM25 engine built on 'store' and 'df'. If None, a new one is built.
+    :type engine: BM25Engine
     :return: Dictionary mapping document URLs to their calculated boost multipliers.
     :rtype: dict
     """
-    boost = {}
-
-    for _, row in df.iterrows():
-        url = row["url"]
-        marks = get_reviews(url, index_name)
-        mean_mark = marks["mean_mark"]
-        count = marks["total_reviews"]
-
-        # Divide by 5 bc the rate is out of 5
-        mark_factor = 1 + (mean_mark / 5) * weights["avg_mark"]
-        # Here we use the log to have a big difference between 1 and 10
-        # But smaller difference between 1001 and 1010
-        count_factor = 1 + math.log10(count + 1) * weights["count_mark"]
-
-        boost[url] = mark_factor * count_factor
+    if engine is None:
+        engine = BM25Engine(store, df)
+    with span("reviews boost"):
+        boost = engine.reviews_boost(
+            weights["avg_mark"], weights["count_mark"], index_name
+        )
+    return dict(zip(engine.urls, boost.tolist()))
 
-    return boost
 
-
-def calculate_linear_scoring(query: str, df: pd.DataFrame, weights: dict) -> dict:
+def calculate_linear_scoring(
+    query: str,
+    df: pd.DataFrame,
+    weights: dict,
+    store: IndexStore = DEFAULT_STORE,
+    engine: BM25Engine = None,
+    proximity: dict = PROXIMITY,
+) -> dict:
     """
     Calculate a weighted final relevance score and rank all documents.
 
@@ -123,38 +235,238 @@ def calculate_linear_scoring(query: str, df: pd.DataFrame, weights: dict) -> dic
     :type df: pd.DataFrame
     :param weights: Dictionary of importance weights for various scoring factors.
     :type weights: dict
+    :param store: Store holding the loaded indexes.
+    :type store: IndexStore
+    :param engine: BM25 engine built on 'store' and 'df'. If None, a new one is built.
+    :type engine: BM25Engine
+    :param proximity: Proximity settings (see PROXIMITY in config.py).
+    :type proximity: dict
     :return: Dictionary of URLs and their final scores, sorted from highest to lowest.
     :rtype: dict
     """
+    if engine is None:
+        engine = BM25Engine(store, df)
+    with span("process query"):
+        tokens, terms, term_weights = weigh_query_terms(query, weights, store)
 
     # Scores associated to the field
-    all_score_title = calculate_bm25(query=query, field="title", df=df)
-    all_score_desc = calculate_bm25(query=query, field="description", df=df)
-    all_score_brand = calculate_bm25(query=query, field="brand", df=df)
-    all_score_origin = calculate_bm25(query=query, field="origin", df=df)
+    with span("bm25", field="title"):
+        all_score_title = engine.score(terms, "title", term_weights=term_weights)
+    with span("bm25", field="description"):
+        all_score_desc = engine.score(terms, "description", term_weights=term_weights)
+    with span("bm25", field="brand"):
+        all_score_brand = engine.score(terms, "brand", term_weights=term_weights)
+    with span("bm25", field="origin"):
+        all_score_origin = engine.score(terms, "origin", term_weights=term_weights)
     # Scores associated to the proximity of word in the query
     # especially if it exactly corresponds to a title
-    all_score_proximity = is_exact_match(query=query, field="title", df=df)
+    with span("proximity"):
+        all_score_proximity = get_proximity_scores(tokens, store, proximity)
     # Boost associated to the reviews
     # If a pertinent document is well-rated, we boost it
-    all_review_boost = calculate_reviews_boost(weights=weights, df=df)
+    with span("reviews boost"):
+        review_boost = engine.reviews_boost(weights["avg_mark"], weights["count_mark"])
 
-    scores = {}
+    score_proximity = np.array(
+        [all_score_proximity.get(url, 0) for url in engine.urls], dtype=np.float64
+    )
+
+    scores = (
+        all_score_title * weights["title"]
+        + all_score_desc * weights["description"]
+        + (all_score_brand + all_score_origin) * weights["features"]
+        + score_proximity * weights["proximity"]
+    ) * review_boost
+
+    with span("sort"):
+        # Stable sort, so that documents with the same score keep the order of df
+        order = np.argsort(-scores, kind="stable")
+    return {engine.urls[i]: scores[i].item() for i in order}
+
+
+def retrieve_top_k(
+    query: str,
+    df: pd.DataFrame,
+    weights: dict,
+    k: int = 5,
+    store: IndexStore = DEFAULT_STORE,
+    engine: BM25Engine = None,
+    exhaustive: bool = False,
+    proximity: dict = PROXIMITY,
+) -> tuple[list[tuple[str, float]], int]:
+    """
+    Give the k best documents for a query, skipping the documents that cannot reach the top k (MaxScore).
+
+    Each query token gets an upper bound, its highest weighted BM25 contribution over the fields.
+    Documents are visited in increasing id order and only the ones whose bound, multiplied by
+    the highest review boost, can beat the current k-th score are fully scored. The result is
+    the same as the first k items of calculate_linear_scoring.
 
-    for url in df["url"]:
-        score_title = all_score_title.get(url, 0)
-        score_desc = all_score_desc.get(url, 0)
-        score_brand = all_score_brand.get(url, 0)
-        score_origin = all_score_origin.get(url, 0)
-        score_proximity = all_score_proximity.get(url, 0)
-        review_boost = all_review_boost.get(url, 1)
+    :param query: Text corresponding to the query.
+    :type query: str
+    :param df: DataFrame containing the raw product data.
+    :type df: pd.DataFrame
+    :param weights: Dictionary of importance weights for various scoring factors.
+    :type weights: dict
+    :param k: Number of documents to return (default 5).
+    :type k: int
+    :param store: Store holding the loaded indexes.
+    :type store: IndexStore
+    :param engine: BM25 engine built on 'store' and 'df'. If None, a new one is built.
+    :type engine: BM25Engine
+    :param exhaustive: True to score every document and sort them (verification mode), False otherwise.
+    :type exhaustive: bool
+    :param proximity: Proximity settings (see PROXIMITY in config.py).
+    :type proximity: dict
+    :return: List of the k best (url, score) pairs sorted from highest to lowest, and the number of documents with a score > 0.
+    :rtype: tuple[list[tuple[str, float]], int]
+    """
+    if engine is None:
+        engine = BM25Engine(store, df)
+    # The bounds only hold for non-negative weights
+    if exhaustive or any(weights[w] < 0 for w in weights):
+        results = calculate_linear_scoring(query, df, weights, store, engine, proximity)
+        filtered_docs = sum(1 for score in results.values() if score > 0)
+        return list(results.items())[:k], filtered_docs
 
+    with span("process query"):
+        tokens, query_terms, term_weights = weigh_query_terms(query, weights, store)
+    # Total weight of each distinct term in the query
+    total_weights = {}
+    for term, weight in zip(query_terms, term_weights):
+        total_weights[term] = total_weights.get(term, 0) + weight
+    with span("reviews boost"):
+        review_boost = engine.reviews_boost(weights["avg_mark"], weights["count_mark"])
+    max_boost = review_boost.max().item() if len(review_boost) > 0 else 0
+    fields = {
+        "title": weights["title"],
+        "description": weights["description"],
+        "brand": weights["features"],
+        "origin": weights["features"],
+    }
+    with span("postings"):
+        postings = {
+            (t, f): engine.token_impacts(t, f) for t in total_weights for f in fields
+        }
+    # Only the documents containing all the tokens can have a proximity score
+    with span("proximity"):
+        all_score_proximity = get_proximity_scores(tokens, store, proximity)
+    # Each field gives a proximity score of at most 1
+    max_proximity = weights["proximity"] * len(proximity["fields"])
+
+    def exact_score(doc_id: int) -> float:
+        # Same operations, in the same order, as calculate_linear_scoring
+        field_scores = {}
+        for f in fields:
+            score = 0.0
+            for token, weight in zip(query_terms, term_weights):
+                ids, impacts = postings[(token, f)]
+                i = np.searchsorted(ids, doc_id)
+                if i < len(ids) and ids[i] == doc_id:
+                    score += impacts[i] if weight == 1 else impacts[i] * weight
+            field_scores[f] = score
         score = (
-            score_title * weights["title"]
-            + score_desc * weights["description"]
-            + (score_brand + score_origin) * weights["features"]
-            + score_proximity * weights["proximity"]
-        ) * review_boost
-        scores[url] = score
-
-    return dict(sorted(scores.items(), key=lambda item: item[1], reverse=True))
+            field_scores["title"] * weights["title"]
+            + field_scores["description"] * weights["description"]
+            + (field_scores["brand"] + field_scores["origin"]) * weights["features"]
+            + all_score_proximity.get(engine.urls[doc_id], 0) * weights["proximity"]
+        ) * review_boost[doc_id]
+        return float(score)
+
+    with span("maxscore"):
+        # Upper bound and documents of each distinct token, sorted by increasing bound
+        terms = []
+        for token in total_weights:
+            bound = total_weights[token] * sum(
+                w * engine.upper_bound(token, f) for f, w in fields.items()
+            )
+            ids = np.unique(np.concatenate([postings[(token, f)][0] for f in fields]))
+            if len(ids) > 0:
+                terms.append((bound, token, ids))
+        terms.sort(key=lambda term: term[0])
+        # Highest score (before the review boost) of a document only found in the tokens 0..i
+        cumulative = np.cumsum([term[0] for term in terms]) + max_proximity
+        margin = 1 + 1e-9  # To stay an upper bound despite rounding errors
+
+        heap = []  # Min-heap of (score, -doc_id): the worst kept document is on top
+        threshold = 0.0
+        # Documents only found in these tokens cannot enter the top k
+        n_non_essential = 0
+        cursors = [0] * len(terms)
+        while k > 0:
+            essential = [
+                i
+                for i in range(n_non_essential, len(terms))
+                if cursors[i] < len(terms[i][2])
+            ]
+            if not essential:
+                break
+            doc_id = min(terms[i][2][cursors[i]] for i in essential)
+            if n_non_essential:
+                bound = cumulative[n_non_essential - 1]
+            else:
+                bound = max_proximity
+            for i in essential:
+                if terms[i][2][cursors[i]] == doc_id:
+                    bound += terms[i][0]
+                    cursors[i] += 1
+            if len(heap) == k and bound * max_boost * margin <= threshold:
+                continue
+
+            count("scored_docs")
+            score = exact_score(doc_id)
+            # Documents are visited by increasing id, so a tie never beats a kept document
+            if score > 0 and (len(heap) < k or score > threshold):
+                if len(heap) == k:
+                    heapq.heapreplace(heap, (score, -doc_id))
+                else:
+                    heapq.heappush(heap, (score, -doc_id))
+                if len(heap) == k:
+                    threshold = heap[0][0]
+                    while (
+                        n_non_essential < len(terms)
+                        and cumulative[n_non_essential] * max_boost * margin
+                        <= threshold
+                    ):
+                        n_non_essential += 1
+
+        top = [
+            (engine.urls[-neg_id], score)
+            for score, neg_id in sorted(heap, reverse=True)
+        ]
+    # Like the exhaustive ranking, complete with documents of score 0 in the order of df
+    kept = {url for url, _ in top}
+    for url in engine.urls:
+        if len(top) >= k:
+            break
+        if url not in kept:
+            top.append((url, 0.0))
+
+    with span("count matching"):
+        # The documents with a score > 0 contain a token with a positive contribution,
+        # or a proximity score
+        matching = [
+            postings[(t, f)][0]
+            for t in total_weights
+            for f, w in fields.items()
+            if w > 0 and total_weights[t] > 0 and engine.upper_bound(t, f) > 0
+        ]
+        if weights["proximity"] > 0:
+            matching.append(
+                np.array(
+                    [
+                        engine.doc_ids[url]
+                        for url in all_score_proximity
+                        if url in engine.doc_ids
+                    ],
+                    dtype=np.int64,
+                )
+            )
+        matching = (
+            np.unique(np.concatenate(matching))
+            if matching
+            else np.array([], dtype=np.int64)
+        )
+        filtered_docs = int(np.count_nonzero(review_boost[matching] > 0))
+
+    return top, filtered_docs
@@ -0,0 +1,225 @@
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from TP3.config import *
+from TP3.processing import *
+from TP3.bm25 import BM25Engine
+from TP3.cache import QueryCache
+from TP3.main import answer_query
+
+LOCAL_HOSTS = ["127.0.0.1", "localhost"]
+MAX_K = 100
+
+
+class SearchService:
+    """
+    Search engine kept warm between queries, with atomic hot reload of the indexes.
+
+    Everything a query needs (store, product table, engine, cache) lives in one snapshot.
+    A reload builds a complete new snapshot on the side and then replaces the reference,
+    so requests already running keep using the snapshot they started with.
+    """
+
+    def __init__(
+        self, input_path: str = INPUT_PATH, path: str = PATH, weights: dict = None
+    ):
+        """
+        :param input_path: Path to the JSONL file containing the product catalog.
+        :type input_path: str
+        :param path: Folder containing the indexes, or a segmented index (see TP2.segments).
+        :type path: str
+        :param weights: Dictionary of scoring weights, defaults to the ones of config.py.
+        :type weights: dict
+        """
+        self.input_path = input_path
+        self.path = path
+        self.weights = weights if weights is not None else DEFAULT_WEIGHTS
+        self._reload_lock = threading.Lock()
+        self.snapshot = self._build_snapshot()
+
+    def _build_snapshot(self) -> dict:
+        store = open_store(self.path).load()
+        df = load_products(store, self.input_path)
+        engine = BM25Engine(store, df).prepare()
+        return {"store": store, "df": df, "engine": engine, "cache": QueryCache(store)}
+
+    def reload(self) -> float:
+        """
+        Load the indexes and the catalog again and switch to them once they are ready.
+        If the loading fails, the current snapshot is kept and the error is raised.
+
+        :return: Time spent building the new snapshot, in seconds.
+        :rtype: float
+        """
+        # Only one reload at a time, queries are not blocked
+        with self._reload_lock:
+            start = time.perf_counter()
+            snapshot = self._build_snapshot()
+            self.snapshot = snapshot
+            return time.perf_counter() - start
+
+    def is_stale(self) -> bool:
+        """
+        Check if the index files have changed since the current snapshot was loaded.
+
+        :return: True if the service should be reloaded, False otherwise.
+        :rtype: bool
+        """
+        return self.snapshot["store"].is_stale()
+
+    def search(self, query: str, k: int = 5) -> dict:
+        """
+        Answer a query, with the same format as main.
+
+        :param query: Query string to be processed.
+        :type query: str
+        :param k: Number of results (default 5).
+        :type k: int
+        :return: Dict with the query as key and its metadata and results as value, empty if nothing matches.
+        :rtype: dict
+        """
+        snapshot = self.snapshot  # The same snapshot is used for the whole request
+        response = answer_query(
+            query,
+            df=snapshot["df"],
+            weights=self.weights,
+            store=snapshot["store"],
+            engine=snapshot["engine"],
+            k=k,
+            cache=snapshot["cache"],
+        )
+        return {} if response is None else {query: response}
+
+
+class SearchHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler answering '/search?q=...&k=...' and '/reload'.
+    """
+
+    # Set by make_server
+    service = None
+
+    def _send_json(self, status: int, data: dict):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/search":
+            self._send_json(404, {"error": f"Unknown path '{url.path}'."})
+            return
+
+        params = parse_qs(url.query)
+        query = params.get("q", [""])[0]
+        if not query.strip():
+            self._send_json(400, {"error": "The 'q' parameter is required."})
+            return
+        try:
+            k = int(params.get("k", ["5"])[0])
+        except ValueError:
+            k = 0
+        if not 1 <= k <= MAX_K:
+            self._send_json(400, {"error": f"'k' should be an int in [1, {MAX_K}]."})
+            return
+
+        self._send_json(200, self.service.search(query, k))
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/reload":
+            self._send_json(404, {"error": f"Unknown path '{self.path}'."})
+            return
+        try:
+            seconds = self.service.reload()
+        except Exception as e:
+            # The current snapshot is still the one answering the queries
+            print(f"Reload failed, keeping the current indexes: {e!r}")
+            self._send_json(500, {"reloaded": False, "error": repr(e)})
+            return
+        self._send_json(200, {"reloaded": True, "seconds": seconds})
+
+
+def make_server(
+    service: SearchService, host: str = "127.0.0.1", port: int = 8000
+) -> ThreadingHTTPServer:
+    """
+    Create the HTTP server of a search service. Each request is handled in its own thread.
+
+    :param service: Search service answering the queries.
+    :type service: SearchService
+    :param host: Local address to listen on.
+    :type host: str
+    :param port: Port to listen on (0 for any free port).
+    :type port: int
+    :return: The server, not started yet.
+    :rtype: ThreadingHTTPServer
+    """
+    if host not in LOCAL_HOSTS:
+        raise ValueError(f"'host' should take value in {LOCAL_HOSTS}.")
+    handler = type("Handler", (SearchHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def watch_indexes(service: SearchService, interval: float) -> threading.Thread:
+    """
+    Start a background thread reloading the service when the index files change.
+    A failed reload keeps the current snapshot and is tried again at the next check.
+
+    :param service: Search service to reload.
+    :type service: SearchService
+    :param interval: Time between two checks, in seconds.
+    :type interval: float
+    :return: The started thread.
+    :rtype: threading.Thread
+    """
+
+    def watch():
+        while True:
+            time.sleep(interval)
+            try:
+                if service.is_stale():
+                    print(f"Indexes reloaded in {service.reload():.3f}s")
+            except Exception as e:
+                # E.g. files read while being rebuilt: the store stays stale, so it is tried again
+                print(f"Reload failed, keeping the current indexes: {e!r}")
+
+    thread = threading.Thread(target=watch, daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_path", nargs="?", default=INPUT_PATH)
+    parser.add_argument("--index-path", default=PATH)
+    parser.add_argument("--host", default="127.0.0.1", choices=LOCAL_HOSTS)
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--watch",
+        type=float,
+        default=0,
+        help="Seconds between index checks, 0 to disable",
+    )
+    args = parser.parse_args()
+
+    print("Loading indexes...")
+    service = SearchService(input_path=args.input_path, path=args.index_path)
+    if args.watch > 0:
+        watch_indexes(service, args.watch)
+
+    server = make_server(service, host=args.host, port=args.port)
+    print(f"Listening on http://{args.host}:{args.port}/search?q=...&k=...")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,291 @@
+import argparse
+import json
+import random
+import re
+
+FIXTURE_PATH = "TP3/input/rearranged_products.jsonl"
+BASE_URL = "https://web-scraping.dev"
+# Syllables of the synthetic words: 24 syllables give 24**2 + 24**3 + 24**4 possible words
+SYLLABLES = [consonant + vowel for consonant in "bdklmrst" for vowel in "aio"]
+VOCABULARY_SIZE = 50000  # Synthetic words added to the words of the fixture
+ZIPF_EXPONENT = 1.1
+SYNTHETIC_RATE = 0.3  # Share of the words of a text drawn from the synthetic vocabulary
+MAX_VARIANTS = 4
+# Kind of query -> share of the query mix
+QUERY_MIX = {
+    "title_term": 0.3,
+    "title_phrase": 0.25,
+    "description": 0.2,
+    "brand": 0.1,
+    "origin": 0.1,
+    "miss": 0.05,
+}
+ORIGIN_QUERIES = ["made in {}", "{}", "{} product"]
+
+
+def load_fixture(path: str = FIXTURE_PATH) -> dict:
+    """
+    Reads the words, sentences, features and reviews of the products of the fixture, used to generate products shaped like them.
+
+    :param path: Path of a JSONL catalog (like TP3's 'rearranged_products.jsonl').
+    :type path: str
+    :return: Dict of lists: 'title_words', 'sentences', 'brands', 'origins', 'features' (other (key, value) pairs), 'reviews' and 'ratings'.
+    :rtype: dict
+    """
+    pools = {
+        "title_words": [],
+        "sentences": [],
+        "brands": [],
+        "origins": [],
+        "features": [],
+        "reviews": [],
+        "ratings": [],
+    }
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            product = json.loads(line)
+            pools["title_words"] += product["title"].split()
+            pools["sentences"] += [
+                sentence.strip()
+                for sentence in re.split(r"(?<=[.!?])\s+", product["description"])
+                if sentence.strip()
+            ]
+            for key, value in product["product_features"].items():
+                if key == "brand":
+                    pools["brands"].append(value)
+                elif key == "made in":
+                    pools["origins"].append(value)
+                else:
+                    pools["features"].append((key, value))
+            for review in product["product_reviews"]:
+                pools["reviews"].append(review["text"])
+                pools["ratings"].append(review["rating"])
+    return pools
+
+
+def make_vocabulary(size: int, rng: random.Random) -> list[str]:
+    """
+    Creates distinct pseudo-words, so that the vocabulary of a large catalog keeps growing with its size.
+
+    :param size: Number of words.
+    :type size: int
+    :param rng: Random generator.
+    :type rng: random.Random
+    :return: List of words, in random order.
+    :rtype: list[str]
+    """
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choices(SYLLABLES, k=rng.randint(2, 4))))
+    # Sorted first so that the order only depends on the seed, the rank of a word gives its frequency
+    words = sorted(words)
+    rng.shuffle(words)
+    return words
+
+
+class CatalogGenerator:
+    """
+    Generator of synthetic products with the fields of TP3's catalog (title, description, product_features,
+    links, product_reviews).
+
+    The words come from the fixture and from a synthetic vocabulary drawn with a Zipf law, so that the
+    frequent words are shared by many products while rare words keep appearing as the catalog grows.
+    A product has up to MAX_VARIANTS variants sharing its title and description, like on web-scraping.dev.
+    """
+
+    def __init__(self, fixture_path: str = FIXTURE_PATH, seed: int = 0):
+        """
+        :param fixture_path: Path of the catalog giving the words, features and reviews.
+        :type fixture_path: str
+        :param seed: Seed of the random generator, the same seed gives the same catalog.
+        :type seed: int
+        """
+        self.rng = random.Random(seed)
+        self.pools = load_fixture(fixture_path)
+        self.vocabulary = make_vocabulary(VOCABULARY_SIZE, self.rng)
+        weights = [1 / rank**ZIPF_EXPONENT for rank in range(1, VOCABULARY_SIZE + 1)]
+        self._cum_weights = []
+        total = 0.0
+        for weight in weights:
+            total += weight
+            self._cum_weights.append(total)
+        # Brands of the fixture plus synthetic ones, so that a brand is not shared by too many products
+        self.brands = self.pools["brands"] + [
+            word.capitalize() + self.rng.choice(["Gear", "Wear", "Foods", "Home"])
+            for word in self.rng.sample(self.vocabulary, 500)
+        ]
+
+    def words(self, pool: list[str], n: int) -> list[str]:
+        """
+        Draws 'n' words, from 'pool' or (with probability SYNTHETIC_RATE) from the synthetic vocabulary.
+        """
+        synthetic = self.rng.choices(
+            self.vocabulary, cum_weights=self._cum_weights, k=n
+        )
+        return [
+            (
+                synthetic[i]
+                if self.rng.random() < SYNTHETIC_RATE
+                else self.rng.choice(pool)
+            )
+            for i in range(n)
+        ]
+
+    def description(self) -> str:
+        sentences = []
+        for _ in range(self.rng.randint(2, 6)):
+            if self.rng.random() < 0.5:
+                sentences.append(self.rng.choice(self.pools["sentences"]))
+            else:
+                words = self.words(self.pools["title_words"], self.rng.randint(6, 18))
+                sentences.append(" ".join(words).capitalize() + ".")
+        return " ".join(sentences)
+
+    def features(self) -> dict:
+        features = dict(self.rng.sample(self.pools["features"], self.rng.randint(2, 6)))
+        if self.rng.random() < 0.85:  # Like the fixture, some products have no brand
+            features["brand"] = self.rng.choice(self.brands)
+        features["made in"] = self.rng.choice(self.pools["origins"])
+        return features
+
+    def reviews(self, product_id: int) -> list[dict]:
+        if self.rng.random() < 0.15:
+            return []
+        return [
+            {
+                "date": f"2022-{self.rng.randint(1, 12):02d}-{self.rng.randint(1, 28):02d}",
+                "id": f"product-{product_id}-{i + 1}",
+                "rating": self.rng.choice(self.pools["ratings"]),
+                "text": self.rng.choice(self.pools["reviews"]),
+            }
+            for i in range(self.rng.randint(3, 5))
+        ]
+
+    def products(self, n_docs: int):
+        """
+        Generates 'n_docs' products.
+
+        :param n_docs: Number of products (variants included).
+        :type n_docs: int
+        :return: Generator of products, as dicts.
+        :rtype: Generator
+        """
+        n = 0
+        product_id = 0
+        while n < n_docs:
+            product_id += 1
+            url = f"{BASE_URL}/product/{product_id}"
+            title = " ".join(
+                self.words(self.pools["title_words"], self.rng.randint(2, 5))
+            ).title()
+            description = self.description()
+            features = self.features()
+            reviews = self.reviews(product_id)
+            links = [
+                f"{BASE_URL}/product/{self.rng.randint(1, product_id)}"
+                for _ in range(self.rng.randint(3, 8))
+            ]
+
+            variants = [url] + [
+                f"{url}?variant={variant}"
+                for variant in self.rng.sample(
+                    ["small", "medium", "large", "red", "blue", "black", "white"],
+                    self.rng.randint(0, MAX_VARIANTS),
+                )
+            ]
+            for variant_url in variants[: n_docs - n]:
+                yield {
+                    "url": variant_url,
+                    "title": title,
+                    "description": description,
+                    "product_features": features,
+                    "links": links,
+                    "product_reviews": reviews,
+                }
+                n += 1
+
+
+def generate_catalog(
+    path_out: str, n_docs: int, fixture_path: str = FIXTURE_PATH, seed: int = 0
+):
+    """
+    Writes a synthetic catalog of 'n_docs' products as JSONL, one product at a time.
+
+    :param path_out: Path of the catalog.
+    :type path_out: str
+    :param n_docs: Number of products (variants included).
+    :type n_docs: int
+    :param fixture_path: Path of the catalog giving the words, features and reviews.
+    :type fixture_path: str
+    :param seed: Seed of the random generator.
+    :type seed: int
+    """
+    generator = CatalogGenerator(fixture_path, seed)
+    with open(path_out, "w", encoding="utf-8") as f:
+        for product in generator.products(n_docs):
+            f.write(json.dumps(product, ensure_ascii=False) + "\n")
+
+
+def make_queries(catalog_path: str, n_queries: int, seed: int = 0) -> list[str]:
+    """
+    Creates a query mix (see QUERY_MIX) from products sampled in a catalog: words and phrases of the titles,
+    words of the descriptions, brands, origins and queries matching nothing.
+
+    :param catalog_path: Path of the JSONL catalog.
+    :type catalog_path: str
+    :param n_queries: Number of queries.
+    :type n_queries: int
+    :param seed: Seed of the random generator.
+    :type seed: int
+    :return: List of queries.
+    :rtype: list[str]
+    """
+    rng = random.Random(seed)
+    # Reservoir sampling, so that the catalog is read once without being kept in memory
+    sample = []
+    with open(catalog_path, "r", encoding="utf-8") as f:
+        for i, line in enumerate(f):
+            if len(sample) < n_queries:
+                sample.append(line)
+            else:
+                j = rng.randint(0, i)
+                if j < n_queries:
+                    sample[j] = line
+
+    kinds = rng.choices(list(QUERY_MIX), weights=list(QUERY_MIX.values()), k=n_queries)
+    queries = []
+    for kind, line in zip(kinds, sample * (n_queries // len(sample) + 1)):
+        product = json.loads(line)
+        title = product["title"].split()
+        description = product["description"].split()
+        features = product["product_features"]
+        if kind == "title_term":
+            query = rng.choice(title)
+        elif kind == "title_phrase":
+            start = rng.randint(0, max(len(title) - 2, 0))
+            query = " ".join(title[start : start + rng.randint(2, 3)])
+        elif kind == "description" and description:
+            start = rng.randint(0, max(len(description) - 2, 0))
+            query = " ".join(description[start : start + rng.randint(2, 4)])
+        elif kind == "brand" and "brand" in features:
+            query = features["brand"]
+        elif kind == "origin":
+            query = rng.choice(ORIGIN_QUERIES).format(features["made in"])
+        elif kind == "miss":
+            query = "".join(rng.choices("qxzjv", k=8))
+        else:
+            query = rng.choice(title)
+        queries.append(query)
+    return queries
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path_out")
+    parser.add_argument("--n-docs", type=int, default=1000)
+    parser.add_argument("--fixture", default=FIXTURE_PATH)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    generate_catalog(args.path_out, args.n_docs, args.fixture, args.seed)
+    print(f"{args.n_docs} products saved to {args.path_out}")
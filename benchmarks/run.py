@@ -0,0 +1,460 @@
+import argparse
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from benchmarks.catalog import FIXTURE_PATH, generate_catalog, make_queries
+
+try:
+    import resource
+except ImportError:  # Not available on Windows, the peak memory is not measured
+    resource = None
+
+SIZES = [1000, 10000]  # 100000 and 1000000 documents take much longer to build
+DATA_PATH = "benchmarks/data"
+RESULTS_PATH = "benchmarks/results"
+BASELINE_PATH = "benchmarks/baseline.json"
+SYNONYMS_PATH = "TP3/input/origin_synonyms.json"
+N_QUERIES = 200
+N_WARMUP = 10  # Queries run before measuring the latencies
+PAGE_REPEAT = 5
+TOLERANCE = 0.2  # Relative increase of a metric reported as a regression
+# Metrics compared with the baseline, lower is better for all of them
+METRICS = [
+    "build.seconds",
+    "build.peak_rss",
+    "search.load_seconds",
+    "search.products_seconds",
+    "search.latency_p50",
+    "search.latency_p95",
+    "search.latency_p99",
+    "tp1.selective_ms",
+]
+
+
+def peak_rss() -> int:
+    """
+    Gives the peak resident memory of this process and of its finished child processes, in bytes.
+
+    :return: Peak memory in bytes, None if it cannot be measured.
+    :rtype: int
+    """
+    if resource is None:
+        return None
+    unit = 1 if sys.platform == "darwin" else 1024  # ru_maxrss is in KB on Linux
+    return unit * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+def run_isolated(function, *args):
+    """
+    Runs a function in a new (spawned) process, so that its peak memory and its load times are not
+    affected by what was already imported or loaded by the suite.
+
+    :param function: Function at the top level of a module, returning a picklable result.
+    :type function: Callable
+    :return: The result of the function.
+    """
+    # Unlike a multiprocessing.Pool worker, it can start the processes of the parallel build
+    with ProcessPoolExecutor(
+        1, mp_context=multiprocessing.get_context("spawn")
+    ) as pool:
+        return pool.submit(function, *args).result()
+
+
+def prepare_search_folder(build_path: str, search_path: str):
+    """
+    Puts the indexes built by TP2 in the layout read by TP3's IndexStore: the binary indexes and the statistics
+    as they are, and the reviews index turned from JSON lines into a JSON object.
+
+    :param build_path: Output folder of the TP2 build.
+    :type build_path: str
+    :param search_path: Folder read by TP3.
+    :type search_path: str
+    """
+    os.makedirs(search_path, exist_ok=True)
+    for name in os.listdir(build_path):
+        if name.endswith(".bin"):
+            shutil.copy(os.path.join(build_path, name), search_path)
+    shutil.copy(os.path.join(build_path, "stats.jsonl"), search_path)
+    data = {}
+    with open(
+        os.path.join(build_path, "reviews_index.jsonl"), "r", encoding="utf-8"
+    ) as f:
+        for line in f:
+            data.update(json.loads(line))
+    with open(
+        os.path.join(search_path, "reviews_index.json"), "w", encoding="utf-8"
+    ) as f:
+        json.dump(data, f, ensure_ascii=False)
+    shutil.copy(SYNONYMS_PATH, search_path)
+
+
+def measure_build(
+    catalog_path: str,
+    build_path: str,
+    memory_limit: float = None,
+    n_workers: int = None,
+    n_process: int = 1,
+) -> dict:
+    """
+    Builds the TP2 indexes of a catalog (binary format, without token cache) and measures it. Run in its own process.
+
+    :param catalog_path: Path of the JSONL catalog.
+    :type catalog_path: str
+    :param build_path: Output folder.
+    :type build_path: str
+    :param memory_limit: Memory limit of a streaming build in MB, None for the parallel build.
+    :type memory_limit: float
+    :param n_workers: Number of processes building the indexes (parallel build).
+    :type n_workers: int
+    :param n_process: Number of tokenization processes.
+    :type n_process: int
+    :return: Dict with the wall time in seconds, the peak memory in bytes and the size of the files.
+    :rtype: dict
+    """
+    from TP2.parallel import build_parallel
+    from TP2.streaming import build_streaming
+
+    os.makedirs(build_path, exist_ok=True)
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        if memory_limit is not None:
+            build_streaming(
+                catalog_path,
+                build_path,
+                memory_limit=int(memory_limit * 2**20),
+                index_format="binary",
+                n_process=n_process,
+            )
+        else:
+            build_parallel(
+                catalog_path,
+                build_path,
+                index_format="binary",
+                n_process=n_process,
+                n_workers=n_workers,
+            )
+    seconds = time.perf_counter() - start
+    return {
+        "seconds": seconds,
+        "peak_rss": peak_rss(),
+        "index_bytes": sum(
+            os.path.getsize(os.path.join(build_path, name))
+            for name in os.listdir(build_path)
+        ),
+    }
+
+
+def measure_search(
+    search_path: str, catalog_path: str, queries: list[str], k: int = 5
+) -> dict:
+    """
+    Loads the indexes with TP3 and measures the latency of each query (without result cache). Run in its own process.
+
+    :param search_path: Folder of the indexes (see prepare_search_folder).
+    :type search_path: str
+    :param catalog_path: Path of the JSONL catalog.
+    :type catalog_path: str
+    :param queries: Queries, the first N_WARMUP ones are also run once before measuring.
+    :type queries: list[str]
+    :param k: Number of results of each query.
+    :type k: int
+    :return: Dict with the load times in seconds, the latency percentiles in milliseconds, the throughput and the peak memory in bytes.
+    :rtype: dict
+    """
+    from TP3.main import answer_query
+    from TP3.processing import IndexStore, load_products
+    from TP3.bm25 import BM25Engine
+    from TP3.config import DEFAULT_WEIGHTS
+
+    start = time.perf_counter()
+    store = IndexStore(search_path).load()
+    load_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    df = load_products(store, catalog_path)
+    engine = BM25Engine(store, df).prepare()
+    products_seconds = time.perf_counter() - start
+
+    for query in queries[:N_WARMUP]:
+        answer_query(query, df, DEFAULT_WEIGHTS, store, engine, k)
+    latencies = []
+    found = 0
+    for query in queries:
+        start = time.perf_counter()
+        response = answer_query(query, df, DEFAULT_WEIGHTS, store, engine, k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        found += response is not None
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "load_seconds": load_seconds,
+        "products_seconds": products_seconds,
+        "queries": len(queries),
+        "queries_with_results": found,
+        "latency_mean": float(np.mean(latencies)),
+        "latency_p50": float(p50),
+        "latency_p95": float(p95),
+        "latency_p99": float(p99),
+        "queries_per_second": len(latencies) / (sum(latencies) / 1000),
+        "peak_rss": peak_rss(),
+    }
+
+
+def measure_tp1(repeat: int = PAGE_REPEAT) -> dict:
+    """
+    Measures the parse time per page of the TP1 extractions on the pages of the local shop.
+
+    :param repeat: Number of runs over all the pages.
+    :type repeat: int
+    :return: Dict with the time per page in milliseconds of the BeautifulSoup and of the selective extraction.
+    :rtype: dict
+    """
+    from TP1.extraction import benchmark, load_pages
+
+    times = benchmark(load_pages(), repeat)
+    return {"soup_ms": times["soup"], "selective_ms": times["selective"]}
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(
+    sizes: list[int] = SIZES,
+    data_path: str = DATA_PATH,
+    n_queries: int = N_QUERIES,
+    seed: int = 0,
+    memory_limit: float = None,
+    n_workers: int = None,
+    n_process: int = 1,
+) -> dict:
+    """
+    Runs the benchmarks for each catalog size: generation of the catalog (kept in 'data_path' for the next runs),
+    TP2 build, TP3 load and query latencies, plus the TP1 parse time.
+
+    :param sizes: Numbers of documents of the catalogs.
+    :type sizes: list[int]
+    :param data_path: Folder of the catalogs and of the indexes.
+    :type data_path: str
+    :param n_queries: Number of queries of the query mix.
+    :type n_queries: int
+    :param seed: Seed of the catalogs and of the queries.
+    :type seed: int
+    :param memory_limit: Memory limit of a streaming build in MB, None for the parallel build.
+    :type memory_limit: float
+    :param n_workers: Number of processes building the indexes (parallel build).
+    :type n_workers: int
+    :param n_process: Number of tokenization processes.
+    :type n_process: int
+    :return: Results, with the commit, the environment, the configuration and the metrics of each size.
+    :rtype: dict
+    """
+    results = {
+        "commit": get_commit(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "seed": seed,
+            "n_queries": n_queries,
+            "memory_limit": memory_limit,
+            "n_workers": n_workers,
+            "n_process": n_process,
+        },
+        "sizes": {},
+    }
+    os.makedirs(data_path, exist_ok=True)
+
+    for size in sizes:
+        catalog_path = os.path.join(data_path, f"catalog_{size}_{seed}.jsonl")
+        if not os.path.exists(catalog_path):
+            print(f"Generating a catalog of {size} products...")
+            generate_catalog(catalog_path, size, FIXTURE_PATH, seed)
+        build_path = os.path.join(data_path, f"build_{size}")
+        search_path = os.path.join(data_path, f"search_{size}")
+        for path in [build_path, search_path]:
+            shutil.rmtree(path, ignore_errors=True)
+
+        print(f"[{size}] Building the indexes...")
+        build = run_isolated(
+            measure_build, catalog_path, build_path, memory_limit, n_workers, n_process
+        )
+        prepare_search_folder(build_path, search_path)
+        print(f"[{size}] Loading the indexes and running {n_queries} queries...")
+        queries = make_queries(catalog_path, n_queries, seed)
+        search = run_isolated(measure_search, search_path, catalog_path, queries)
+        results["sizes"][str(size)] = {"build": build, "search": search}
+        print_size(size, results["sizes"][str(size)])
+
+    print("Parsing the TP1 pages...")
+    results["tp1"] = measure_tp1()
+    return results
+
+
+def print_size(size: int, result: dict):
+    """
+    Prints the main metrics of one catalog size.
+    """
+    build, search = result["build"], result["search"]
+    memory = (
+        f", peak RSS {build['peak_rss'] / 2**20:.0f} MB"
+        if build["peak_rss"] is not None
+        else ""
+    )
+    print(f"[{size}] Build: {build['seconds']:.2f}s{memory}")
+    print(
+        f"[{size}] Load: {search['load_seconds']:.3f}s, queries: "
+        f"p50 {search['latency_p50']:.2f} ms, p95 {search['latency_p95']:.2f} ms, "
+        f"p99 {search['latency_p99']:.2f} ms ({search['queries_per_second']:.0f} queries/s)"
+    )
+
+
+def get_metric(result: dict, metric: str):
+    """
+    Gives a metric ('section.name') of the results of a size, None if it is missing.
+    """
+    section, name = metric.split(".")
+    return result.get(section, {}).get(name)
+
+
+def compare(results: dict, baseline: dict, tolerance: float = TOLERANCE) -> list[dict]:
+    """
+    Compares results with a baseline, for the sizes and metrics (see METRICS) found in both.
+
+    :param results: Results of run_suite.
+    :type results: dict
+    :param baseline: Results of a previous run_suite.
+    :type baseline: dict
+    :param tolerance: Relative increase of a metric above which it is a regression (0.2 for +20%).
+    :type tolerance: float
+    :return: List of the comparisons, each one with the size, the metric, both values, the ratio and a 'regression' flag.
+    :rtype: list[dict]
+    """
+    sections = {size: result for size, result in results["sizes"].items()}
+    baseline_sections = dict(baseline["sizes"])
+    # The TP1 metrics do not depend on the size of the catalog
+    sections["tp1"] = {"tp1": results.get("tp1", {})}
+    baseline_sections["tp1"] = {"tp1": baseline.get("tp1", {})}
+
+    comparisons = []
+    for size, result in sections.items():
+        if size not in baseline_sections:
+            continue
+        for metric in METRICS:
+            value = get_metric(result, metric)
+            reference = get_metric(baseline_sections[size], metric)
+            if value is None or not reference:
+                continue
+            ratio = value / reference
+            comparisons.append(
+                {
+                    "size": size,
+                    "metric": metric,
+                    "value": value,
+                    "baseline": reference,
+                    "ratio": ratio,
+                    "regression": ratio > 1 + tolerance,
+                }
+            )
+    return comparisons
+
+
+def print_comparisons(comparisons: list[dict]):
+    """
+    Prints the comparisons with the baseline, one line per metric.
+    """
+    for comparison in comparisons:
+        flag = "REGRESSION" if comparison["regression"] else "ok"
+        print(
+            f"{comparison['size']:>8} {comparison['metric']:<20} "
+            f"{comparison['baseline']:>14.4g} -> {comparison['value']:<14.4g} "
+            f"x{comparison['ratio']:.2f} {flag}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=SIZES,
+        help="Numbers of documents of the catalogs, e.g. 1000 10000 100000 1000000",
+    )
+    parser.add_argument("--queries", type=int, default=N_QUERIES)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-path", default=DATA_PATH)
+    parser.add_argument(
+        "--memory-limit",
+        type=float,
+        default=None,
+        help="Benchmark the streaming build with this memory limit in MB instead of the parallel build",
+    )
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--n-process", type=int, default=1)
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="JSON file of the results (default is a new file in benchmarks/results/)",
+    )
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Save the results as the new baseline",
+    )
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    results = run_suite(
+        sizes=args.sizes,
+        data_path=args.data_path,
+        n_queries=args.queries,
+        seed=args.seed,
+        memory_limit=args.memory_limit,
+        n_workers=args.workers,
+        n_process=args.n_process,
+    )
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_PATH, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = os.path.join(RESULTS_PATH, f"{stamp}_{results['commit']}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {output}")
+
+    if args.save_baseline:
+        shutil.copy(output, args.baseline)
+        print(f"Baseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        comparisons = compare(results, baseline, args.tolerance)
+        print(f"Comparison with the baseline of commit {baseline.get('commit')}:")
+        print_comparisons(comparisons)
+        if any(comparison["regression"] for comparison in comparisons):
+            print("Regressions found!")
+            raise SystemExit(1)
+    else:
+        print(f"No baseline ({args.baseline}), run with --save-baseline to create it")